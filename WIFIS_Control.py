@@ -13,8 +13,7 @@ from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 import matplotlib.pyplot as mpl
 
-from astropy.visualization import (PercentileInterval, LinearStretch,
-                                    ImageNormalize, ZScaleInterval)
+from astropy.visualization import ZScaleInterval
 from astropy import units as u
 from astropy.coordinates import SkyCoord
 from astropy.io import fits
@@ -25,6 +24,10 @@ import WIFIStelescope as wt
 import WIFISdetector as wd
 import WIFISguider as wg
 import WIFISastrometry as wa
+import WIFISframestore as wf
+import WIFIStiming as wtm
+import WIFISarchiver as war
+import WIFISdisplay as wdi
 from WIFIScalibration import CalibrationControl
 
 import traceback
@@ -39,15 +42,6 @@ from pymodbus.client.sync import ModbusSerialClient as ModbusClient
 # with the GuI code. 
 motors = True
 
-class Formatter(object):
-    '''Class that formats the mouseover readout for matplotlib plots'''
-
-    def __init__(self, im):
-        self.im = im
-    def __call__(self, x, y):
-        z = self.im.get_array()[int(y), int(x)]
-	return 'x={:.01f}, y={:.01f}, z={:.01f}'.format(x, y, z)
-
 class CustomWIFISToolbar(NavigationToolbar):
     '''Custom matplotlib toolbar that removes some unncessary functions. 
     Ultimately used to save space on the monitor in order to see mouseover'''
@@ -71,6 +65,9 @@ class DoublePlotWindow(QDialog):
         self.guidecanvas = FigureCanvas(self.guidefigure)
         #self.guidetoolbar = NavigationToolbar(self.guidecanvas, self)
         self.guidetoolbar = CustomWIFISToolbar(self.guidecanvas, self)
+        #Persistent displays updating the images in place
+        self.objdisplay = wdi.ImageDisplay(self.objfigure, self.objcanvas)
+        self.guidedisplay = wdi.ImageDisplay(self.guidefigure, self.guidecanvas)
         self.ObjPlotLabel = QLabel()
         self.ObjPlotLabel.setText("Detector Plot")
         self.GuidePlotLabel = QLabel()
@@ -145,7 +142,7 @@ class WIFISUI(QMainWindow, Ui_MainWindow):
         # Flag for update thread
         self.updateon = False
 
-        self.coords = [self.RALabel, self.DECLabel]
+        self.coords = [self.RALabel, self.DECLabel, self.ELLabel]
 
         # Defining GUI Variables to feed into the different control classes
         # Important that the classes only read the variables and never try to adjust them.
@@ -200,6 +197,11 @@ class WIFISUI(QMainWindow, Ui_MainWindow):
         self.labelsThread.updateText.connect(self._handleUpdateLabels)
         self.labelsThread.start()
         self.updateon = True
+
+        # Background catalog fetches for the guider field of the next target
+        self.catalogPrefetch = wa.CatalogPrefetchThread()
+        self.catalogPrefetch.updateText.connect(self._handleOutputTextUpdate)
+        self.catalogPrefetch.start()
         
         # Defining settings for exposure progress bar
         self.ExpProgressBar.setMinimum(0)
@@ -261,10 +263,8 @@ class WIFISUI(QMainWindow, Ui_MainWindow):
         self.ResetExposureFlagButton.clicked.connect(self.resetExposureFlag)
         self.SetGuideOffset.clicked.connect(self.setGuideOffset)
 
-        # Load guider bias frame to remove from images
-        guidebiasff = fits.open(self.dirpath+'/data/GuiderBias.fits')
-        self.guidebias = guidebiasff[0].data
-        self.guidebias = self.guidebias.astype('float')
+        # Shared read-only guider bias frame to remove from images
+        self.guidebias = wf.get_framestore().bias()
 
     def read_defaults(self):
         '''Loads the saved guider offset values'''
@@ -307,6 +307,23 @@ class WIFISUI(QMainWindow, Ui_MainWindow):
         self.RAObj.setText(self.tars[i][1])
         self.DECObj.setText(self.tars[i][2])
 
+        self.prefetchCatalog()
+
+    def prefetchCatalog(self):
+        '''Queues a background catalog fetch for the guider field of the object
+        RA and DEC, using the current IIS to place the guider field'''
+
+        RA, DEC = parseRADECText(self.RAObj.text(), self.DECObj.text())
+        if RA == False:
+            return
+
+        try:
+            rotangle = float(self.IISLabel.text())
+        except ValueError:
+            rotangle = None
+
+        self.catalogPrefetch.request(RA, DEC, rotangle)
+
     def setGuideOffset(self):
         '''Function that handles setting new guider offsets'''
 
@@ -802,7 +819,8 @@ class WIFISUI(QMainWindow, Ui_MainWindow):
         self.guideThread.start()
 
     def focusCamera(self):
-        self.fcthread = wg.FocusCamera(self.guider.cam, self.guider.foc, self.ExpTime)
+        self.fcthread = wg.FocusCamera(self.guider.cam, self.guider.foc, self.ExpTime,\
+                self.guider.getFilterType())
         self.fcthread.plotSignal.connect(self._handleGuidingPlotting)
         self.fcthread.updateText.connect(self._handleGuidingTextUpdate)
         self.fcthread.start()
@@ -839,6 +857,8 @@ class WIFISUI(QMainWindow, Ui_MainWindow):
             self._handleOutputTextUpdate(DEC)
             return
 
+        self.prefetchCatalog()
+
         RAText = float(RAText)
         DECText = float(DECText)
         RAText = '%.1f' % (RAText)
@@ -1083,87 +1103,57 @@ class WIFISUI(QMainWindow, Ui_MainWindow):
             self.OutputText.append("SOMETHING WENT WRONG WITH THE ARC PLOTTING")
 
 
+    @wtm.timed('plot detector')
     def _handlePlotting(self, image, flname):
 
         try:
-            norm = ImageNormalize(image, interval=PercentileInterval(99.5),stretch=LinearStretch())
-
-            self.plotwindow.objfigure.clear()
-
-            ax = self.plotwindow.objfigure.add_subplot(1,1,1)
-            im = ax.imshow(image, origin='lower', norm=norm, interpolation='none')
-            ax.format_coord = Formatter(im)
-            ax.set_title(flname)
-            self.plotwindow.objfigure.colorbar(im)
-            self.plotwindow.objfigure.tight_layout()
-
-            self.plotwindow.objcanvas.draw()
+            self.plotwindow.objdisplay.show(image, flname, percentile=99.5)
         except Exception as e:
             print e
             print traceback.print_exc()
             self.OutputText.append("SOMETHING WENT WRONG WITH THE PLOTTING")
 
-    def _handleGuidePlotting(self, image, flname):
-        try:
-            image = image.astype('float') - self.guidebias
-            norm = ImageNormalize(image, interval=PercentileInterval(98.5),stretch=LinearStretch())
+    def _drawGuideCompass(self, ax, rotAng):
+        '''N and E arrows on the guider image for rotator angle rotAng'''
 
-            self.plotwindow.guidefigure.clear()
+        rotMat = np.asarray([[np.cos(rotAng*np.pi/180.),np.sin(rotAng*np.pi/180.)],\
+                [-np.sin(rotAng*np.pi/180.),np.cos(rotAng*np.pi/180.)]])
 
-            ax = self.plotwindow.guidefigure.add_subplot(1,1,1)
-            #im = ax.imshow(image, origin='lower', norm=norm, interpolation='none', cmap='gray')
-            im = ax.imshow(image, origin='lower', norm=norm, interpolation='none')
+        decAx = np.dot([-70,0], rotMat)
+        raAx = np.dot([0,-70], rotMat)
 
-            rotAng = float(self.IISLabel.text()) - 90.
-            rotMat = np.asarray([[np.cos(rotAng*np.pi/180.),np.sin(rotAng*np.pi/180.)],\
-                    [-np.sin(rotAng*np.pi/180.),np.cos(rotAng*np.pi/180.)]])
+        cent = np.asarray([150,780])
+        artists = [ax.arrow(cent[0],cent[1], raAx[0],raAx[1], width = 5,\
+                head_width=15, head_length=15, fc='w', ec='k'),\
+                ax.arrow(cent[0],cent[1], decAx[0],decAx[1], width = 5,\
+                head_width=15, head_length=15, fc='w', ec='k')]
 
-            decAx = np.dot([-70,0], rotMat)
-            raAx = np.dot([0,-70], rotMat)
-
-            cent = np.asarray([150,780])
-            ax.arrow(cent[0],cent[1], raAx[0],raAx[1], width = 5,\
-                    head_width=15, head_length=15, fc='w', ec='k')
-            ax.arrow(cent[0],cent[1], decAx[0],decAx[1], width = 5,\
-                    head_width=15, head_length=15, fc='w', ec='k')
-
-            #ax.text((cent+decAx+10)[0]+1, (cent+decAx+10)[1]+1,\
-            #        "N",ha="left", va="top", rotation=rotAng, color='w', fontsize=20)
-            #ax.text((cent+raAx+10)[0]+1, (cent+raAx+10)[1]+1,\
-            #        "E",ha="left", va="bottom", rotation=rotAng, color='w', fontsize=20)
-            ax.text((cent+decAx-50)[0], (cent+decAx-10)[1],\
-                    "N",ha="left", va="top", rotation=rotAng, color='k', fontsize=17)
-            ax.text((cent+raAx+10)[0], (cent+raAx-50)[1],\
-                    "E",ha="left", va="bottom", rotation=rotAng, color='k', fontsize=17)
-            print cent, decAx, raAx
-
-            ax.format_coord = Formatter(im)
-            ax.set_title(flname)
-            self.plotwindow.guidefigure.colorbar(im)
-            self.plotwindow.guidefigure.tight_layout()
+        artists.append(ax.text((cent+decAx-50)[0], (cent+decAx-10)[1],\
+                "N",ha="left", va="top", rotation=rotAng, color='k', fontsize=17))
+        artists.append(ax.text((cent+raAx+10)[0], (cent+raAx-50)[1],\
+                "E",ha="left", va="bottom", rotation=rotAng, color='k', fontsize=17))
 
-            self.plotwindow.guidecanvas.draw()
+        return artists
+
+    @wtm.timed('plot guider')
+    def _handleGuidePlotting(self, image, flname):
+        try:
+            image = image.astype('float') - self.guidebias
+            rotAng = float(self.IISLabel.text()) - 90.
+
+            #The compass is only drawn again when the rotator moves
+            self.plotwindow.guidedisplay.show(image, flname, percentile=98.5,\
+                    overlays=lambda ax: self._drawGuideCompass(ax, rotAng), overlaykey=rotAng)
 
         except Exception as e:
             print e
             print traceback.print_exc()
             self.OutputText.append("SOMETHING WENT WRONG WITH THE PLOTTING")
 
+    @wtm.timed('plot guiding')
     def _handleGuidingPlotting(self, image, flname):
         try:
-            norm = ImageNormalize(image, interval=PercentileInterval(98.5),stretch=LinearStretch())
-
-            self.plotwindow.guidefigure.clear()
-
-            ax = self.plotwindow.guidefigure.add_subplot(1,1,1)
-            #im = ax.imshow(image, origin='lower', norm=norm, interpolation='none', cmap='gray')
-            im = ax.imshow(image, origin='lower', norm=norm, interpolation='none')
-            ax.format_coord = Formatter(im)
-            ax.set_title(flname)
-            self.plotwindow.guidefigure.colorbar(im)
-            self.plotwindow.guidefigure.tight_layout()
-
-            self.plotwindow.guidecanvas.draw()
+            self.plotwindow.guidedisplay.show(image, flname, percentile=98.5)
 
         except Exception as e:
             print e
@@ -1430,8 +1420,8 @@ class WIFISUI(QMainWindow, Ui_MainWindow):
         hdr['FOffDEC'] = (FOffsetdms, '//Arcsec from Telescope to WIFIS')
         hdr['GRAOff'] = (str(guideroffsets[0]), '//Guider RA Offset')
         hdr['GDECOff'] = (str(guideroffsets[1]), '//Guider DEC Offset')
-        fits.writeto('/Data/WIFISGuider/astrometry/'+todaydate+'T'+\
-                        time.strftime('%H%M%S')+'.fits', image, hdr, clobber=True)
+        war.archive('/Data/WIFISGuider/astrometry/'+todaydate+'T'+\
+                        time.strftime('%H%M%S')+'.fits', image, hdr)
 
     def _handleAstrometricPlotting(self, plotting):
         try:
@@ -1464,6 +1454,7 @@ class WIFISUI(QMainWindow, Ui_MainWindow):
 
         if reply == QMessageBox.Close:
             event.accept()
+            self.catalogPrefetch.stop()
             self.plotwindow.fullclose = True
             #self.guideplotwindow.fullclose = True
 
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFISarchiver.py
+# Purpose:          Background writer of compressed guider FITS frames
+#------------------------------------------------------------------------------
+
+"""
+Writes guider frames to disk on a background thread so the thread taking the
+images never waits for the disk. Frames go into a bounded queue with
+archive(path, data, header); when the queue is full the frame is dropped with
+a warning instead of blocking.
+
+Frames are written as tile compressed FITS: the image is in extension 1 (a
+CompImageHDU after an empty primary HDU) and the header keywords are in the
+header of that extension. Integer frames use RICE_1, which is lossless for
+integers and halves the size of the raw 16 bit guider frames (more for
+frames with little sky).
+Float frames (calibrated images) use GZIP_2 without quantization, which is
+also lossless. fits.getdata reads either kind without changes; code opening
+the file itself finds the image in f[1].
+
+The files written are fsynced together, every syncevery files or after
+syncinterval seconds, instead of once per file.
+"""
+
+import numpy as np
+import os, time, threading, atexit, Queue
+from astropy.io import fits
+
+class FrameArchiver(object):
+    '''Bounded queue of frames and the thread writing them'''
+
+    def __init__(self, maxqueue = 16, syncevery = 8, syncinterval = 30.):
+
+        self.queue = Queue.Queue(maxqueue)
+        self.syncevery = syncevery
+        self.syncinterval = syncinterval
+
+        self.unsynced = []
+        self.firstunsynced = None
+        self.nwritten = 0
+        self.ndropped = 0
+        self.nbytes = 0
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.worker, name='framearchiver')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def archive(self, path, data, header = None):
+        '''Queues data (not to be changed afterwards) to be written to path with
+        header. Returns False if the queue is full and the frame was dropped'''
+
+        try:
+            self.queue.put_nowait((path, data, header))
+        except Queue.Full:
+            self.ndropped += 1
+            print "### Frame archive queue full, dropping %s" % (path)
+            return False
+
+        return True
+
+    def flush(self):
+        '''Waits until every queued frame is written and synced'''
+
+        self.queue.put((None, None, None))
+        self.queue.join()
+
+    def close(self):
+        '''Writes the queued frames and stops the thread'''
+
+        if self.stopped:
+            return
+        self.flush()
+        self.stopped = True
+        self.thread.join(5.)
+
+    def worker(self):
+
+        while not self.stopped:
+            try:
+                path, data, header = self.queue.get(timeout = 1.)
+            except Queue.Empty:
+                if self.unsynced and (time.time() - self.firstunsynced > self.syncinterval):
+                    self.sync()
+                continue
+
+            try:
+                if path is None:
+                    self.sync()
+                else:
+                    self.write(path, data, header)
+                    if (len(self.unsynced) >= self.syncevery) or \
+                            (time.time() - self.firstunsynced > self.syncinterval):
+                        self.sync()
+            except Exception as e:
+                print "### Could not archive %s: %s" % (path, e)
+            finally:
+                self.queue.task_done()
+
+    def write(self, path, data, header):
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        data = np.asarray(data)
+        if data.dtype.kind not in 'iub':
+            data = data.astype(np.float32)
+
+        #The image header completes the structural keywords header may lack
+        header = fits.ImageHDU(data, header).header
+        if data.dtype.kind in 'iub':
+            hdu = fits.CompImageHDU(data, header, compression_type='RICE_1')
+        else:
+            hdu = fits.CompImageHDU(data, header, compression_type='GZIP_2', quantize_level=0.)
+
+        f = open(path, 'wb')
+        try:
+            fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(f)
+            f.flush()
+        except Exception:
+            f.close()
+            raise
+
+        if not self.unsynced:
+            self.firstunsynced = time.time()
+        self.unsynced.append(f)
+        self.nwritten += 1
+        self.nbytes += f.tell()
+
+    def sync(self):
+        '''fsyncs and closes the files written since the last sync'''
+
+        for f in self.unsynced:
+            try:
+                os.fsync(f.fileno())
+            except OSError as e:
+                print "### Could not sync %s: %s" % (f.name, e)
+            f.close()
+        self.unsynced = []
+
+archiver = None
+archiverlock = threading.Lock()
+
+def get_archiver():
+    '''The frame archiver shared by all of the code saving guider frames'''
+
+    global archiver
+    with archiverlock:
+        if archiver is None:
+            archiver = FrameArchiver()
+            #Write the frames still queued when the program exits
+            atexit.register(archiver.close)
+
+    return archiver
+
+def archive(path, data, header = None):
+    '''Queues a frame in the shared archiver'''
+
+    return get_archiver().archive(path, data, header)
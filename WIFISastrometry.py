@@ -3,14 +3,19 @@ import numpy as np
 import urllib as url
 from astropy.io import fits
 from scipy.optimize import curve_fit
+from scipy import ndimage
+from scipy.spatial import cKDTree
 from astropy import units as u
 from astropy.coordinates import SkyCoord
 import WIFIStelescope as WG
+import WIFIScatalog as WC
+import WIFISframestore as WF
+import WIFISarchiver as WAR
 from sys import exit
 from scipy.stats import mode
 from numpy.linalg import inv
 import traceback
-import time, os
+import time, os, Queue, thread, threading
 
 from PyQt5.QtCore import QThread, QCoreApplication, QTimer, pyqtSlot, pyqtSignal
 
@@ -40,9 +45,16 @@ def read_defaults():
     return valuesdict
 
 def getAstrometricSoln(fl, telSock, head, rotangleget, verbose = False, catalog = 'sdss',
-        force_IIS = False):
+        force_IIS = False, matcher = 'kdtree', solver = 'translation', blind_fov = 15,
+        distortion = True, learndistortion = False):
     """Takes an ra and dec as grabbed from the telemetry and returns a field
-    from UNSO for use in solving the guider field"""
+    from UNSO for use in solving the guider field. matcher selects the
+    catalog cross-match: 'kdtree' (compareFieldsKD) or 'loop' (compareFields3).
+    solver = 'asterism' instead matches triangles of stars without using the
+    rotator angle (compareFieldsAsterism) over a blind_fov arcmin catalog field.
+    The plate is solved with solvePlateRobust; distortion adds the 2nd order terms using
+    the stored distortion for the rotator angle as a prior. The stored distortion is
+    only updated from the solution when learndistortion is set"""
 
     #Get the image data and the location of the stars in the image
     data, head, RA, DEC, centroids = load_img(fl, head, telSock)
@@ -77,7 +89,12 @@ def getAstrometricSoln(fl, telSock, head, rotangleget, verbose = False, catalog
 
     offsets = get_rotation_solution_offset(rotangle, guider_offsets, dec_deg)
 
-    name, rad, ded, rmag, ra_deg, dec_deg, fov_am ,coord, newcoord, newcatalog = grabUNSOfield(RA, DEC, offsets=offsets, catalog = catalog)
+    if solver == 'asterism':
+        fov_am = blind_fov
+    else:
+        fov_am = 5
+    name, rad, ded, rmag, ra_deg, dec_deg, fov_am ,coord, newcoord, newcatalog = grabUNSOfield(RA, DEC, offsets=offsets, catalog = catalog,\
+            fov_am = fov_am)
     catalog = newcatalog
     print "There are "+str(len(rad))+" stars in the catalog."
 
@@ -93,19 +110,20 @@ def getAstrometricSoln(fl, telSock, head, rotangleget, verbose = False, catalog
     xproj = np.array(xproj)
     yproj = np.array(yproj)
 
+    magval = catalogs[catalog]['maglimit']
     if len(rmag[np.isnan(rmag)]) > len(rmag)/2.: 
         k = rmag != 0
         print 'lots of nan'
-    elif catalog == 'unso':
-        magval = 17.5
-        #magval = 19
-        k = rmag < magval
-    elif catalog == 'sdss':
-        magval = 20
+    else:
         k = rmag < magval
 
     #compareresults = compareFieldsNew(x, y, xproj, yproj, rad, ded, k)
-    compareresults = compareFields3(x, y, xproj, yproj, rad, ded, k, Iarr)
+    if solver == 'asterism':
+        compareresults = compareFieldsAsterism(xorig, yorigflip, xproj, yproj, rad, ded, k, Iarr, rmag)
+    elif matcher == 'kdtree':
+        compareresults = compareFieldsKD(x, y, xproj, yproj, rad, ded, k, Iarr)
+    else:
+        compareresults = compareFields3(x, y, xproj, yproj, rad, ded, k, Iarr)
 
     if compareresults == None:
         return [False]
@@ -130,12 +148,21 @@ def getAstrometricSoln(fl, telSock, head, rotangleget, verbose = False, catalog
     xorigmatch = np.array(xorigmatch)
     yorigmatch = np.array(yorigmatch) 
     
-    platesolve = solvePlate(xorigmatch,yorigmatch,Xmatch,Ymatch)
+    if distortion:
+        prior = read_distortion(rotangle)
+        platesolve = solvePlateRobust(xorigmatch, yorigmatch, Xmatch, Ymatch,\
+                weights = Iarr[np.array(posi, dtype=int)], order = 2, prior = prior)
+        if learndistortion and (type(platesolve) == list) and (len(platesolve[0]) > 3) and \
+                (np.sum(platesolve[4]) >= 12):
+            update_distortion(rotangle, platesolve)
+    else:
+        platesolve = solvePlateRobust(xorigmatch, yorigmatch, Xmatch, Ymatch,\
+                weights = Iarr[np.array(posi, dtype=int)])
 
-    if not platesolve:
+    if platesolve is False:
         print "NO SOLVE"
         return [False]
-    elif platesolve == 'Offsets':
+    elif type(platesolve) == str:
         print "TOO FEW STARS"
         print xorig
         print yorig
@@ -148,6 +175,8 @@ def getAstrometricSoln(fl, telSock, head, rotangleget, verbose = False, catalog
         #print xmatch, ymatch
         print xsolve
         print ysolve
+        print "Plate solution RMS: %.2f\" using %i of %i stars" % (platesolve[3], \
+                np.sum(platesolve[4]), len(platesolve[4]))
         #print rotangle - 90. - 0.26
         #print np.arccos(xsolve[0] * flength / 0.013) * 180. / np.pi
         #print 0.013 / np.sqrt(np.abs(xsolve[0]*ysolve[1] - xsolve[1]*ysolve[0]))
@@ -186,16 +215,21 @@ def getAstrometricSoln(fl, telSock, head, rotangleget, verbose = False, catalog
             mpl.legend()
             mpl.show()
         
+        results = [platesolve, fieldoffset, realcenter, solvecenter, offsets,[x,y,k,xproj,yproj,data,head,coord]]
         if verbose:
-            return [platesolve, fieldoffset, realcenter, solvecenter, offsets,[x,y,k,xproj,yproj,data,head,coord],[xorig, yorig, cxrot, cyrot, cxrotneg, cyrotneg, Iarr]]
-        else:
-            return [platesolve, fieldoffset, realcenter, solvecenter, offsets,[x,y,k,xproj,yproj,data,head,coord]]
+            results.append([xorig, yorig, cxrot, cyrot, cxrotneg, cyrotneg, Iarr])
+
+        return results
 
 def returnXY(platesolve, x, y):
 
     xsolve = platesolve[0]
     ysolve = platesolve[1]
 
+    if len(xsolve) > 3:
+        terms = plate_terms(x, y, order=2)
+        return np.dot(terms, xsolve), np.dot(terms, ysolve)
+
     Xnew = xsolve[0]*x + xsolve[1]*y + xsolve[2]
     Ynew = ysolve[0]*x + ysolve[1]*y + ysolve[2]
 
@@ -451,6 +485,189 @@ def compareFields3(x, y, xp, yp,rad, ded, k, Iarr):
     return np.array(xmatch), np.array(ymatch), np.array(Xmatch), np.array(Ymatch), \
             np.array(ramatch), np.array(decmatch), xdist, ydist, distsimatch, posi
 
+def compareFieldsKD(x, y, xp, yp, rad, ded, k, Iarr, nbright = 5, tol = 15):
+    """Matches the image stars to the catalog stars like compareFields3, but
+    scores every trial translation with KD-tree neighbour queries instead of
+    looping over the catalog in python. Returns the same match tuple."""
+
+    xpk = xp[k]
+    ypk = yp[k]
+    if (len(xpk) == 0) or (len(x) == 0):
+        return None
+
+    brighti = np.argsort(Iarr)[::-1][:nbright]
+    xb = x[brighti]
+    yb = y[brighti]
+
+    #Each trial translation puts one of the brightest image stars onto a 
+    #catalog star. Trials are ordered by distance for each bright star
+    xtrials = xpk[np.newaxis,:] - xb[:,np.newaxis]
+    ytrials = ypk[np.newaxis,:] - yb[:,np.newaxis]
+    order = np.argsort(xtrials**2 + ytrials**2, axis=1)
+    rows = np.arange(len(xb))[:,np.newaxis]
+    xtrials = xtrials[rows, order].ravel()
+    ytrials = ytrials[rows, order].ravel()
+
+    #The offsets between every image/catalog pair. A trial scores one for 
+    #each catalog star that has an image star within tol in x and y of it 
+    #after the trial translation, i.e. each pair offset within tol of the trial
+    pairdx = (xpk[np.newaxis,:] - x[:,np.newaxis]).ravel()
+    pairdy = (ypk[np.newaxis,:] - y[:,np.newaxis]).ravel()
+    paircat = np.tile(np.arange(len(xpk)), len(x))
+
+    pairtree = cKDTree(np.transpose([pairdx, pairdy]))
+    trialtree = cKDTree(np.transpose([xtrials, ytrials]))
+    close = trialtree.sparse_distance_matrix(pairtree, tol, p=np.inf, output_type='coo_matrix')
+
+    #Count each catalog star only once per trial
+    ncat = len(xpk)
+    trialcat = np.unique(close.row.astype(int)*ncat + paircat[close.col])
+    nsmalls = np.bincount(trialcat // ncat, minlength=len(xtrials))
+
+    best = np.argmax(nsmalls)
+    xdist = xtrials[best]
+    ydist = ytrials[best]
+
+    xnew = x + xdist
+    ynew = y + ydist
+
+    #Nearest catalog star to each shifted image star
+    cattree = cKDTree(np.transpose([xpk, ypk]))
+    dist, mini = cattree.query(np.transpose([xnew, ynew]))
+
+    good = (np.abs(xpk[mini] - xnew) < tol) & (np.abs(ypk[mini] - ynew) < tol)
+    posi = np.where(good)[0]
+    distsimatch = mini[good]
+
+    return x[good], y[good], xpk[distsimatch], ypk[distsimatch], \
+            rad[k][distsimatch], ded[k][distsimatch], xdist, ydist, \
+            distsimatch.tolist(), posi.tolist()
+
+def triangle_hashes(x, y, minside = 20., maxside = 1450., minsep = 0.02):
+    """Returns the shape of every triangle of the points as (shortest/longest,
+    middle/longest) side ratios, which do not change with rotation, scale or 
+    reflection. Also returns the triangle vertices ordered by the length of 
+    the opposite side and the longest side length. Triangles that are small,
+    larger than the guider field or have nearly equal sides (ambiguous vertex
+    order) are dropped"""
+
+    if len(x) < 3:
+        return np.zeros((0,2)), np.zeros((0,3), dtype=int), np.zeros(0)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    #Only triangles whose sides all fit in the guider field
+    near = np.triu(np.hypot(x[:,np.newaxis] - x, y[:,np.newaxis] - y) < maxside, 1)
+    tri = np.transpose(np.nonzero(near[:,:,np.newaxis] & near[:,np.newaxis,:] & near[np.newaxis,:,:]))
+    px = x[tri]
+    py = y[tri]
+
+    #Length of the side opposite each vertex
+    sides = np.transpose([np.hypot(px[:,1]-px[:,2], py[:,1]-py[:,2]),\
+                          np.hypot(px[:,0]-px[:,2], py[:,0]-py[:,2]),\
+                          np.hypot(px[:,0]-px[:,1], py[:,0]-py[:,1])])
+
+    order = np.argsort(sides, axis=1)
+    rows = np.arange(len(tri))[:,np.newaxis]
+    sides = sides[rows, order]
+    verts = tri[rows, order]
+
+    good = (sides[:,2] > minside) & (sides[:,1] - sides[:,0] > minsep*sides[:,2]) & \
+            (sides[:,2] - sides[:,1] > minsep*sides[:,2])
+    sides = sides[good]
+    hashes = np.transpose([sides[:,0]/sides[:,2], sides[:,1]/sides[:,2]])
+
+    return hashes, verts[good], sides[:,2]
+
+def compareFieldsAsterism(x, y, xp, yp, rad, ded, k, Iarr, magp, nimg = 15, maxcat = 200,\
+        hashtol = 0.01, tol = 5, scalerange = (0.8, 1.25), minmatch = 4, batch = 200):
+    """Blind field matcher that does not need the rotator angle or a close pointing.
+    Triangles of the brightest image and catalog stars are matched by their
+    shape in a KD-tree of the catalog triangle hashes. Each candidate triangle
+    pair gives an affine transform which is verified by counting the image stars
+    that land within tol pixels of a catalog star. The number of catalog stars
+    used scales with the catalog field area so that about nimg of them fall in
+    the guider field. Returns the same match tuple
+    as compareFields3, with xdist, ydist the mean offset of the matched stars"""
+
+    xpk = xp[k]
+    ypk = yp[k]
+    if (len(xpk) < 3) or (len(x) < 3):
+        return None
+
+    imgi = np.argsort(Iarr)[::-1][:nimg]
+    arearatio = np.ptp(xpk) * np.ptp(ypk) / 1024.**2
+    ncat = min(maxcat, int(nimg * max(1., arearatio)))
+    cati = np.argsort(magp[k])[:ncat]
+
+    imghash, imgverts, imglong = triangle_hashes(x[imgi], y[imgi])
+    cathash, catverts, catlong = triangle_hashes(xpk[cati], ypk[cati])
+    if (len(imghash) == 0) or (len(cathash) == 0):
+        return None
+
+    close = cKDTree(imghash).sparse_distance_matrix(cKDTree(cathash), hashtol,\
+            output_type='coo_matrix')
+    imgtri = close.row.astype(int)
+    cattri = close.col.astype(int)
+
+    scale = catlong[cattri] / imglong[imgtri]
+    keep = (scale > scalerange[0]) & (scale < scalerange[1])
+    best = np.argsort(close.data[keep])
+    imgtri = imgtri[keep][best]
+    cattri = cattri[keep][best]
+    if len(imgtri) == 0:
+        return None
+
+    cattree = cKDTree(np.transpose([xpk, ypk]))
+    allpoints = np.transpose([x, y, np.ones(len(x))])
+    enough = max(6, len(x) / 2)
+
+    bestcount = 0
+    bestcoeffs = None
+    for start in range(0, len(imgtri), batch):
+        ti = imgtri[start:start+batch]
+        tc = cattri[start:start+batch]
+
+        #Affine transform from the three vertex pairs of each candidate
+        iv = imgi[imgverts[ti]]
+        cv = cati[catverts[tc]]
+        A = np.concatenate([x[iv][:,:,np.newaxis], y[iv][:,:,np.newaxis],\
+                np.ones(iv.shape + (1,))], axis=2)
+        B = np.concatenate([xpk[cv][:,:,np.newaxis], ypk[cv][:,:,np.newaxis]], axis=2)
+        try:
+            coeffs = np.linalg.solve(A, B)
+        except np.linalg.LinAlgError:
+            continue
+
+        #Count the image stars that land on a catalog star for every candidate
+        moved = np.einsum('ij,cjk->cik', allpoints, coeffs).reshape(-1, 2)
+        dist, mini = cattree.query(moved, distance_upper_bound = tol)
+        counts = np.sum(np.isfinite(dist).reshape(len(coeffs), len(x)), axis=1)
+
+        c = np.argmax(counts)
+        if counts[c] > bestcount:
+            bestcount = counts[c]
+            bestcoeffs = coeffs[c]
+        if bestcount >= enough:
+            break
+
+    if bestcount < minmatch:
+        return None
+
+    moved = np.dot(allpoints, bestcoeffs)
+    dist, mini = cattree.query(moved, distance_upper_bound = tol)
+    good = np.isfinite(dist)
+    posi = np.where(good)[0]
+    distsimatch = mini[good]
+
+    xdist = np.mean(xpk[distsimatch] - x[good])
+    ydist = np.mean(ypk[distsimatch] - y[good])
+
+    return x[good], y[good], xpk[distsimatch], ypk[distsimatch], \
+            rad[k][distsimatch], ded[k][distsimatch], xdist, ydist, \
+            distsimatch.tolist(), posi.tolist()
+
 def solvePlate(x,y, X, Y):
 
     #Get number of matches/degrees of freedom
@@ -480,9 +697,170 @@ def solvePlate(x,y, X, Y):
     else:
         return False
 
-def grabUNSOfield(RA, DEC, offsets=False, deg = False, catalog = 'unso'):
+def plate_terms(x, y, order = 1):
+    """Columns of the plate model for image positions x, y: x, y, 1 and for
+    order 2 also the distortion terms u^2, uv, v^2 where u, v are the
+    positions relative to the detector centre in units of half the detector"""
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    terms = [x, y, np.ones(x.shape)]
+    if order == 2:
+        u = (x - 512.) / 512.
+        v = (y - 512.) / 512.
+        terms += [u**2, u*v, v**2]
+
+    return np.transpose(terms)
+
+def solvePlateRobust(x, y, X, Y, weights = None, order = 1, prior = None, priorweight = 10.,\
+        nsigma = 3., minclip = 0.2, maxiter = 5, minquad = 12):
+    """Weighted least squares plate solution with iterative sigma clipping.
+
+    weights are the relative weights of the stars (e.g. their fluxes), scaled
+    to a median of 1 and limited to 0.2-5 so no single star dominates. order 2
+    adds the distortion terms of plate_terms. prior is a [xdist, ydist] pair
+    of distortion coefficients from earlier solves; the fit is pulled towards
+    it as strongly as priorweight stars. Without a prior the distortion terms
+    are only fit with at least minquad stars. Stars within minclip arcsec of
+    the solution are never clipped.
+
+    Returns [finalX, finalY, residuals, rms, used] where residuals are the
+    (X, Y) residuals of every star and rms the rms of the used stars, both in
+    arcsec, and used flags the stars kept by the clipping. Like solvePlate,
+    returns 'Offsets' with fewer than 3 stars and False with none."""
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+
+    ndf = len(x)
+    if ndf == 0:
+        return False
+    elif ndf < 3:
+        return "Offsets"
+
+    if weights is None:
+        w = np.ones(ndf)
+    else:
+        w = np.asarray(weights, dtype=float)
+        w = np.clip(w / np.median(w), 0.2, 5.)
+
+    if (order == 2) and (prior is None) and (ndf < minquad):
+        order = 1
+
+    A = plate_terms(x, y, order)
+    nterms = A.shape[1]
+
+    #Rows that tie the distortion coefficients to the prior
+    if (order == 2) and (prior is not None):
+        priorrows = np.hstack([np.zeros((3,3)), np.eye(3)]) * np.sqrt(priorweight)
+        priorX = np.asarray(prior[0], dtype=float) * np.sqrt(priorweight)
+        priorY = np.asarray(prior[1], dtype=float) * np.sqrt(priorweight)
+    else:
+        priorrows = np.zeros((0, nterms))
+        priorX = np.zeros(0)
+        priorY = np.zeros(0)
+
+    #Without a prior every term must be constrained by the stars
+    if len(priorX):
+        minkeep = 3
+    else:
+        minkeep = max(3, nterms)
+
+    used = np.ones(ndf, dtype=bool)
+    for i in range(maxiter):
+        sw = np.sqrt(w[used])[:,np.newaxis]
+        M = np.vstack([A[used] * sw, priorrows])
+        finalX = np.linalg.lstsq(M, np.concatenate([X[used] * sw[:,0], priorX]), rcond=-1)[0]
+        finalY = np.linalg.lstsq(M, np.concatenate([Y[used] * sw[:,0], priorY]), rcond=-1)[0]
+
+        #Robust sigma from the median of the 2D (Rayleigh distributed) residuals,
+        #scaled by the weights since faint stars have larger centroid errors
+        resid = np.hypot(np.dot(A, finalX) - X, np.dot(A, finalY) - Y)
+        wresid = resid * np.sqrt(w)
+        sigma = np.median(wresid[used]) / np.sqrt(2. * np.log(2.))
+        newused = (wresid <= nsigma * sigma) | (resid <= minclip / 206264.8)
+
+        if np.sum(newused) < minkeep:
+            break
+        if np.all(newused == used):
+            break
+        used = newused
+
+    residuals = np.transpose([np.dot(A, finalX) - X, np.dot(A, finalY) - Y]) * 180. / np.pi * 3600.
+    rms = np.sqrt(np.mean(np.sum(residuals[used]**2, axis=1)))
+
+    return [finalX, finalY, residuals, rms, used]
+
+#Serializes the read-modify-write of the distortion file between threads
+distortionlock = threading.Lock()
+
+def distortion_bin(rotangle, binsize = 10.):
+    """Rotator angle bin used to store the distortion solutions"""
+
+    return int(np.floor((rotangle % 360.) / binsize) * binsize)
+
+def read_distortion(rotangle, distfile = homedir + '/data/platedistortion.txt'):
+    """Returns the stored [xdist, ydist] distortion coefficients for the bin of
+    rotangle, or None if there is no solution for it yet. Each line of the
+    file is: bin n x_uu x_uv x_vv y_uu y_uv y_vv"""
+
+    if not os.path.exists(distfile):
+        return None
+
+    rotbin = distortion_bin(rotangle)
+    f = open(distfile, 'r')
+    for line in f:
+        spl = line.split()
+        if (len(spl) == 8) and not line.startswith('#') and (int(spl[0]) == rotbin):
+            f.close()
+            coeffs = [float(c) for c in spl[2:]]
+            return [coeffs[:3], coeffs[3:]]
+    f.close()
+
+    return None
+
+def update_distortion(rotangle, platesolve, distfile = homedir + '/data/platedistortion.txt',\
+        maxn = 20):
+    """Averages the distortion coefficients of a 2nd order plate solution into
+    the stored solution for the bin of rotangle. The average runs over at most
+    the last maxn solves so slow changes are followed"""
+
+    rotbin = distortion_bin(rotangle)
+    newcoeffs = np.concatenate([platesolve[0][3:], platesolve[1][3:]])
+
+    with distortionlock:
+        entries = {}
+        if os.path.exists(distfile):
+            f = open(distfile, 'r')
+            for line in f:
+                spl = line.split()
+                if (len(spl) == 8) and not line.startswith('#'):
+                    entries[int(spl[0])] = [int(spl[1]), np.array([float(c) for c in spl[2:]])]
+            f.close()
+
+        if rotbin in entries:
+            n, coeffs = entries[rotbin]
+            n = min(n + 1, maxn)
+            entries[rotbin] = [n, coeffs + (newcoeffs - coeffs) / n]
+        else:
+            entries[rotbin] = [1, newcoeffs]
+
+        #Write to a temporary file and rename so readers never see a partial file
+        tmpfile = distfile + '.%i.%i.tmp' % (os.getpid(), thread.get_ident())
+        f = open(tmpfile, 'w')
+        f.write('#IIS_bin N x_uu x_uv x_vv y_uu y_uv y_vv\n')
+        for rotbin in sorted(entries):
+            n, coeffs = entries[rotbin]
+            f.write('%i %i ' % (rotbin, n) + ' '.join(['%.6e' % c for c in coeffs]) + '\n')
+        f.close()
+        os.rename(tmpfile, distfile)
+
+def grabUNSOfield(RA, DEC, offsets=False, deg = False, catalog = 'unso', usecache = True, fov_am = 5):
     """Takes an ra and dec as grabbed from the telemetry and returns a field
-    from UNSO for use in solving the guider field"""
+    from UNSO for use in solving the guider field. The field is read from the
+    local catalog cache and VizieR is only queried for missing tiles"""
     
     if deg:
         coord = SkyCoord(RA, DEC, unit='deg')
@@ -498,99 +876,203 @@ def grabUNSOfield(RA, DEC, offsets=False, deg = False, catalog = 'unso'):
 
     newcoord = SkyCoord(ra_deg, dec_deg, unit='deg')
 
-    fov_am = 5
-    if catalog == 'unso':
-        name, rad, ded, rmag = unso(ra_deg,dec_deg, fov_am)
+    if catalog != 'sdss':
+        name, rad, ded, rmag = catalog_field(catalog, ra_deg,dec_deg, fov_am, usecache)
     else:
-        name, rad, ded, rmag = sdss(ra_deg,dec_deg, fov_am)
+        name, rad, ded, rmag = catalog_field('sdss', ra_deg,dec_deg, fov_am, usecache)
         if len(rad) == 0:
             print "NO STARS IN SDSS, TRYING UNSO"
-            name, rad, ded, rmag = unso(ra_deg,dec_deg, fov_am)
+            name, rad, ded, rmag = catalog_field('unso', ra_deg,dec_deg, fov_am, usecache)
             catalog = 'unso'
 
 
     return [name, rad, ded, rmag, ra_deg, dec_deg, fov_am, coord, newcoord, catalog]
 
+catalogcaches = {}
+
+#Catalogs that can be used to solve the guider field. Each entry is the
+#function returning a catalogdtype record array for (radeg, decdeg, fovam),
+#whether the catalog goes through the on-disk cache and the magnitude limit
+#of the stars used for matching
+catalogs = {}
+
+def register_catalog(catalog, fetch, cache = True, maglimit = 20.):
+    """Adds a catalog that grabUNSOfield and getAstrometricSoln can use"""
+
+    catalogs[catalog] = {'fetch': fetch, 'cache': cache, 'maglimit': maglimit}
+    catalogcaches.pop(catalog, None)
+
+def get_catalog_cache(catalog):
+    """Returns the on-disk tile cache for a registered catalog"""
+
+    if catalog not in catalogcaches:
+        catalogcaches[catalog] = WC.CatalogCache(catalog, catalogs[catalog]['fetch'])
+
+    return catalogcaches[catalog]
+
+def catalog_field(catalog, radeg, decdeg, fovam, usecache = True):
+    """Returns name, ra, dec, mag of the catalog stars in the fovam box around
+    radeg, decdeg, from the catalog cache if usecache is set"""
+
+    if usecache and catalogs[catalog]['cache']:
+        try:
+            return get_catalog_cache(catalog).get_field(radeg, decdeg, fovam)
+        except (OSError, IOError) as e:
+            #IOError is also what a failed or truncated query raises
+            print "### Catalog cache unavailable, querying the catalog directly"
+            print e
+
+    stars = catalogs[catalog]['fetch'](radeg, decdeg, fovam)
+
+    return stars['name'], stars['ra'], stars['dec'], stars['mag'].astype(float)
+
+vizierurl = 'http://vizier.hia.nrc.ca/viz-bin/asu-tsv/?-source='
+#vizierurl = 'http://webviz.u-strasbg.fr/viz-bin/asu-tsv/?-source='
+
+#VizieR column names for the name, ra, dec, and magnitude of each catalog,
+#with the column index used if the name is not found in the TSV header
+unsocolumns = [('name', 'USNO-B1.0', 0), ('ra', 'RAJ2000', 1), ('dec', 'DEJ2000', 2),\
+        ('mag', 'R2mag', 12)]
+sdsscolumns = [('name', 'SDSS12', 5), ('ra', 'RA_ICRS', 0), ('dec', 'DE_ICRS', 1),\
+        ('mag', 'zmag', 17)]
+
 def unso(radeg,decdeg,fovam): # RA/Dec in decimal degrees/J2000.0 FOV in arc min. import urllib as url
     
-    #str1 = 'http://webviz.u-strasbg.fr/viz-bin/asu-tsv/?-source=USNO-B1'
-    str1 = 'http://vizier.hia.nrc.ca/viz-bin/asu-tsv/?-source=USNO-B1'
+    stars = unso_records(radeg, decdeg, fovam)
+        
+    return stars['name'],stars['ra'],stars['dec'],stars['mag']
+
+def sdss(radeg,decdeg,fovam): # RA/Dec in decimal degrees/J2000.0 FOV in arc min. import urllib as url
+    
+    stars = sdss_records(radeg, decdeg, fovam)
+        
+    return stars['name'],stars['ra'],stars['dec'],stars['mag']
+
+def unso_records(radeg, decdeg, fovam):
+    """Queries USNO-B1 and returns a record array with name, ra, dec, mag (R2)"""
+
+    return query_vizier('USNO-B1', radeg, decdeg, fovam, unsocolumns)
+
+def sdss_records(radeg, decdeg, fovam):
+    """Queries SDSS DR12 and returns a record array with name, ra, dec, mag (z)"""
+
+    #return query_vizier('SDSS-DR12', radeg, decdeg, fovam, sdsscolumns)
+    return query_vizier('V/147', radeg, decdeg, fovam, sdsscolumns)
+
+def query_vizier(source, radeg, decdeg, fovam, columns):
+    """Queries a fovam x fovam arcmin box around radeg, decdeg from a VizieR 
+    source and parses the TSV response as it streams in"""
+
     str2 = '&-c.ra={:4.6f}&-c.dec={:4.6f}&-c.bm={:4.7f}/{:4.7f}&-out.max=unlimited'.format(\
             radeg,decdeg,fovam,fovam)
 
     # Make sure str2 does not have any spaces or carriage returns/line 
     #feeds when you # cut and paste into your code
-    URLstr = str1+str2
+    URLstr = vizierurl+source+str2
     #print URLstr
 
     f = url.urlopen(URLstr)
-    # Read from the object, storing the page's contents in 's'.
-    s = f.read()
-    f.close()
-   
-    sl = s.splitlines()
-    sl = sl[45:-1]
-    name = np.array([])
-    rad = np.array([])
-    ded = np.array([])
-    rmag = np.array([])
-    for k in sl:
-        kw = k.split('\t')
-        name = np.append(name,kw[0])
-        rad = np.append(rad,float(kw[1]))
-        ded = np.append(ded,float(kw[2]))
-        if kw[12] != '     ': # deal with case where no mag is reported
-            rmag = np.append(rmag,float(kw[12]))
-        else:
-            rmag = np.append(rmag,np.nan) 
-        
-    return name,rad,ded,rmag
+    try:
+        stars = parse_vizier_tsv(f, columns)
+    finally:
+        f.close()
+
+    return stars
+
+register_catalog('unso', unso_records, maglimit = 17.5)
+register_catalog('sdss', sdss_records, maglimit = 20.)
+
+def parse_vizier_tsv(lines, columns, chunk = 1024):
+    """Parses VizieR asu-tsv lines in a single pass. The column layout is taken
+    from the header line above the units and dashes lines. The rows are
+    written into preallocated columns that double in size when full.
+
+    columns is a list of (field, column name, fallback column index).
+    Returns a record array with the fields name, ra, dec, mag. Raises IOError
+    if the response has no table or no column header (an error page) or ends
+    before the blank line closing the table (a dropped connection)"""
+
+    stars = np.zeros(chunk, dtype=WC.catalogdtype)
+    nstars = 0
+
+    previous = []
+    colidx = None
+    closed = False
+    for line in lines:
+        line = line.rstrip('\r\n')
+
+        if colidx is None:
+            #The line of dashes under the units marks the start of the data
+            if line.startswith('#') or (len(line.strip()) == 0):
+                continue
+            if line.strip('-\t ') == '':
+                #The column names and units lines must come before the dashes
+                if len(previous) < 2:
+                    raise IOError("VizieR response has no column header above the table")
+                names = [n.strip() for n in previous[-2].split('\t')]
+                colidx = []
+                for field, colname, fallback in columns:
+                    if colname in names:
+                        colidx.append((field, names.index(colname)))
+                    else:
+                        colidx.append((field, fallback))
+            else:
+                previous = previous[-1:] + [line]
+            continue
 
-def sdss(radeg,decdeg,fovam): # RA/Dec in decimal degrees/J2000.0 FOV in arc min. import urllib as url
-    
-    #str1 = 'http://vizier.hia.nrc.ca/viz-bin/asu-tsv/?-source=SDSS-DR12'
-    str1 = 'http://vizier.hia.nrc.ca/viz-bin/asu-tsv/?-source=V/147'
-    str2 = '&-c.ra={:4.6f}&-c.dec={:4.6f}&-c.bm={:4.7f}/{:4.7f}&-out.max=unlimited'.format(\
-            radeg,decdeg,fovam,fovam)
+        #A blank or comment line ends the table
+        if line.startswith('#') or (len(line.strip()) == 0):
+            closed = True
+            break
 
-    # Make sure str2 does not have any spaces or carriage returns/line feeds when you # cut 
-    #and paste into your code
-    URLstr = str1+str2
-    print URLstr
+        if nstars == len(stars):
+            stars = np.resize(stars, 2*len(stars))
 
-    f = url.urlopen(URLstr)
-    # Read from the object, storing the page's contents in 's'.
-    s = f.read()
-    f.close()
-   
-    sl = s.splitlines()
-    sl = sl[54:-1]
-    name = np.array([])
-    rad = np.array([])
-    ded = np.array([])
-    zmag = np.array([])
-    for k in sl:
-        kw = k.split('\t')
-        name = np.append(name,kw[5])
-        rad = np.append(rad,float(kw[0]))
-        ded = np.append(ded,float(kw[1]))
-        if kw[12] != '     ': # deal with case where no mag is reported
-            zmag = np.append(zmag,float(kw[17]))
-        else:
-            zmag = np.append(zmag,np.nan) 
-        
-    return name,rad,ded,zmag
+        kw = line.split('\t')
+        try:
+            for field, i in colidx:
+                val = kw[i].strip()
+                if field == 'name':
+                    stars['name'][nstars] = val
+                elif val == '': # deal with case where no mag is reported
+                    stars[field][nstars] = np.nan
+                else:
+                    stars[field][nstars] = float(val)
+        except (IndexError, ValueError):
+            raise IOError("Malformed VizieR row: %s" % (line))
+        nstars += 1
+
+    if colidx is None:
+        raise IOError("VizieR response has no table")
+    if not closed:
+        raise IOError("VizieR response ended inside the table after %i stars" % (nstars))
+
+    return stars[:nstars].view(np.recarray)
+
+def frame_calib_keys(head):
+    """Returns the exposure time and CCD temperature of a guider frame from its
+    header for the dark correction, None where they are not recorded"""
+
+    try:
+        exptime = float(head['EXPTIME'])
+    except (KeyError, ValueError, TypeError):
+        exptime = None
+    try:
+        ccdtemp = float(head['CCDTEMP'])
+    except (KeyError, ValueError, TypeError):
+        ccdtemp = None
+
+    return exptime, ccdtemp
 
 def load_img(fl, head, telSock):
-    biasff = fits.open(homedir+'/data/GuiderBias.fits')
-    bias = biasff[0].data
-    bias = bias.astype('float')
+    framestore = WF.get_framestore()
 
     if type(fl) == str:
         f = fits.open(fl)
-        data = f[0].data
-        data = data.astype('float') - bias
-        flhead = f[0].header
+        #Archived frames are compressed in extension 1
+        hdu = f[1] if (len(f) > 1) and (f[0].data is None) else f[0]
+        flhead = hdu.header
+        data = framestore.calibrate(hdu.data, *frame_calib_keys(flhead))
         RA = flhead['RA']
         DEC = flhead['DEC']
         RA = RA[0:2] + ' ' + RA[2:4] + ' ' + RA[4:]
@@ -598,7 +1080,7 @@ def load_img(fl, head, telSock):
 
         cresult = centroid_finder(data)
     else:
-        data = fl.astype('float') - bias
+        data = framestore.calibrate(fl, *frame_calib_keys(head))
         #telem = WG.get_telemetry(telSock)
         RA = head['RA']
         DEC = head['DEC']
@@ -610,7 +1092,18 @@ def load_img(fl, head, telSock):
 
     return data, flhead, RA, DEC, cresult
 
-def centroid_finder(img, plot=False):
+def centroid_finder(img, plot=False, engine='label', widths='none'):
+    """Finds the stars in an image and returns their centroids, total flux,
+    saturation flags and widths as [centroidx, centroidy, Iarr, Isat, width].
+
+    engine selects how the bright pixels are grouped into stars: 'label'
+    labels all of the connected bright-pixel islands in one vectorized pass,
+    'explore' is the original pixel-by-pixel region walk. Both return the
+    same stars in the same order so the results can be compared.
+
+    widths selects how the star FWHMs are measured: 'none' skips them (all
+    widths are 0), 'fast' fits every star at once (fast_star_widths) and
+    'fit' runs the original curve_fit on each star (star_widths)."""
 
     imgsize = img.shape
 
@@ -621,14 +1114,59 @@ def centroid_finder(img, plot=False):
     nstd = 3.0
     #print "IMG MED: %f\nIMGSTD: %f\nCUTOFF: %f" % (imgmedian, imgstd,imgmedian+nstd*imgstd)
 
-    brightpix = np.where(img >= imgmedian + nstd*imgstd)
-    new_img = np.zeros(imgsize)
+    brightmask = img >= imgmedian + nstd*imgstd
 
-    if len(brightpix) == 0:
-        return False
+    if engine == 'explore':
+        centroidx, centroidy, Iarr, Isat = explore_centroids(img, brightmask)
+    else:
+        centroidx, centroidy, Iarr, Isat = label_centroids(img, brightmask)
+
+    if widths == 'fit':
+        width = star_widths(img, centroidx, centroidy)
+    elif widths == 'fast':
+        width = fast_star_widths(img, centroidx, centroidy)
+    else:
+        width = [0]*len(centroidx)
+
+    return [centroidx,centroidy,Iarr, Isat, width]
+
+def label_centroids(img, brightmask, minpix = 3, satlevel = 63000):
+    """Labels the 8-connected islands of bright pixels and measures the flux
+    weighted centroid, total flux and saturation of each island with array
+    reductions. Islands with fewer than minpix pixels are treated as hot pixels."""
 
-    for i in range(len(brightpix[0])):
-        new_img[brightpix[0][i],brightpix[1][i]] = 1.0
+    labels, nlabels = ndimage.label(brightmask, structure=np.ones((3,3)))
+    if nlabels == 0:
+        return [], [], [], []
+
+    #Pixel coordinates and values of every labelled pixel, in the same order
+    rows, cols = np.nonzero(labels)
+    lab = labels[rows, cols]
+    I = img[rows, cols].astype('float')
+
+    npix = np.bincount(lab, minlength=nlabels+1)[1:]
+    Isum = np.bincount(lab, weights=I, minlength=nlabels+1)[1:]
+    xsum = np.bincount(lab, weights=rows*I, minlength=nlabels+1)[1:]
+    ysum = np.bincount(lab, weights=cols*I, minlength=nlabels+1)[1:]
+    Imax = ndimage.maximum(img, labels, np.arange(1, nlabels+1))
+
+    #Check that the star is not just a hot pixel
+    star = npix >= minpix
+
+    centroidx = (xsum[star] / Isum[star]).tolist()
+    centroidy = (ysum[star] / Isum[star]).tolist()
+    Iarr = Isum[star].tolist()
+    Isat = (np.asarray(Imax)[star] >= satlevel).astype(int).tolist()
+
+    return centroidx, centroidy, Iarr, Isat
+
+def explore_centroids(img, brightmask):
+    """Original star finder which walks the image and explores each new
+    bright region pixel by pixel. Kept for comparison with label_centroids."""
+
+    imgsize = img.shape
+    new_img = np.zeros(imgsize)
+    new_img[brightmask] = 1.0
 
     stars = []
     for x in range(imgsize[0]):
@@ -638,7 +1176,7 @@ def centroid_finder(img, plot=False):
                 if len(new_star[0]) >=3: #Check that the star is not just a hot pixel
                     stars.append(new_star)
     
-    centroidx, centroidy, Iarr, Isat, width = [],[],[],[],[]
+    centroidx, centroidy, Iarr, Isat = [],[],[],[]
     for star in stars:
         xsum, ysum, Isum = 0.,0.,0.
         sat = False
@@ -661,23 +1199,32 @@ def centroid_finder(img, plot=False):
         centroidy.append(ysum/Isum)
         Iarr.append(Isum)
 
-        gx0 = centroidx[-1] - 10
-        gx1 = centroidx[-1] + 10
-        gy0 = centroidy[-1] - 10
-        gy1 = centroidy[-1] + 10
+    return centroidx, centroidy, Iarr, Isat
+
+def star_widths(img, centroidx, centroidy):
+    """Fits gaussians to cuts through each centroid and returns the FWHMs"""
+
+    imgsize = img.shape
 
-        if centroidx[-1] < 10:
+    width = []
+    for i in range(len(centroidx)):
+        gx0 = centroidx[i] - 10
+        gx1 = centroidx[i] + 10
+        gy0 = centroidy[i] - 10
+        gy1 = centroidy[i] + 10
+
+        if centroidx[i] < 10:
             gx0 = 0
-        if centroidx[-1] > imgsize[0]-11:
+        if centroidx[i] > imgsize[0]-11:
             gx1 = imgsize[0]-1
         
-        if centroidy[-1] < 10:
+        if centroidy[i] < 10:
             gy0 = 0
-        if centroidy[-1] > imgsize[1]-11:
+        if centroidy[i] > imgsize[1]-11:
             gy1 = imgsize[1]-1
         
-        gx = img[int(gx0):int(gx1),int(centroidy[-1])]
-        gy = img[int(centroidx[-1]), int(gy0):int(gy1)]
+        gx = img[int(gx0):int(gx1),int(centroidy[i])]
+        gy = img[int(centroidx[i]), int(gy0):int(gy1)]
         xs = range(len(gx))
         ys = range(len(gy))
 
@@ -689,7 +1236,104 @@ def centroid_finder(img, plot=False):
         except:
             width.append(0)
 
-    return [centroidx,centroidy,Iarr, Isat, width]
+    return width
+
+def star_cuts(img, centroidx, centroidy, half = 10):
+    """Returns the cuts along axis 0 and along axis 1 through every centroid
+    as (nstars, 2*half+1) arrays. Pixels that fall off the image are NaN"""
+
+    cx = np.round(np.asarray(centroidx, dtype=float)).astype(int)[:,np.newaxis]
+    cy = np.round(np.asarray(centroidy, dtype=float)).astype(int)[:,np.newaxis]
+    offs = np.arange(-half, half+1)
+
+    rows = cx + offs
+    cols = cy + offs
+    rowsin = (rows >= 0) & (rows < img.shape[0])
+    colsin = (cols >= 0) & (cols < img.shape[1])
+
+    xcut = np.where(rowsin, img[np.clip(rows, 0, img.shape[0]-1), \
+            np.clip(cy, 0, img.shape[1]-1)], np.nan)
+    ycut = np.where(colsin, img[np.clip(cx, 0, img.shape[0]-1), \
+            np.clip(cols, 0, img.shape[1]-1)], np.nan)
+
+    return xcut, ycut
+
+def cut_sigmas(cuts, npoints = 5, nbkg = 3):
+    """Gaussian sigma of every cut from a least squares parabola through the
+    log of the npoints central pixels, after removing the median of the nbkg
+    pixels at each end of the cut. Cuts that can not be fit give NaN"""
+
+    half = cuts.shape[1] // 2
+    offs = np.arange(npoints) - npoints // 2
+
+    #log(I) = a*x^2 + b*x + c for a gaussian, with sigma^2 = -1/(2a)
+    design = np.transpose([offs**2, offs, np.ones(npoints)]).astype(float)
+    solver = np.linalg.pinv(design)
+
+    bkg = np.nanmedian(np.concatenate([cuts[:,:nbkg], cuts[:,-nbkg:]], axis=1), axis=1)
+    core = cuts[:, half + offs] - bkg[:,np.newaxis]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        a = np.dot(np.log(core), solver[0])
+        sigma = np.sqrt(-1. / (2.*a))
+
+    return sigma
+
+def fast_star_widths(img, centroidx, centroidy):
+    """Returns the FWHMs of all of the stars at once from the same cuts as 
+    star_widths, using cut_sigmas instead of a nonlinear fit per star.
+    Stars that can not be fit have a width of 0 like in star_widths"""
+
+    if len(centroidx) == 0:
+        return []
+
+    xcut, ycut = star_cuts(img, centroidx, centroidy)
+    width = np.mean([cut_sigmas(xcut), cut_sigmas(ycut)], axis=0) * 2.355
+    width[~np.isfinite(width)] = 0
+
+    return width.tolist()
+
+def half_flux_radii(img, centroidx, centroidy, half = 10, nbkg = 2):
+    """Returns the half flux radius of every star at once from a square stamp
+    of 2*half+1 pixels around its centroid, after removing the median of the
+    nbkg pixel wide border of the stamp. Stars whose stamp falls off the image
+    give NaN"""
+
+    n = len(centroidx)
+    if n == 0:
+        return np.array([])
+
+    fx = np.asarray(centroidx, dtype=float)
+    fy = np.asarray(centroidy, dtype=float)
+    cx = np.round(fx).astype(int)
+    cy = np.round(fy).astype(int)
+    offs = np.arange(-half, half+1)
+
+    rows = np.clip(cx[:,np.newaxis,np.newaxis] + offs[np.newaxis,:,np.newaxis], 0, img.shape[0]-1)
+    cols = np.clip(cy[:,np.newaxis,np.newaxis] + offs[np.newaxis,np.newaxis,:], 0, img.shape[1]-1)
+    stamps = img[rows, cols].astype(float)
+
+    border = np.ones((2*half+1, 2*half+1), dtype=bool)
+    border[nbkg:-nbkg, nbkg:-nbkg] = False
+    bkg = np.median(stamps[:, border], axis=1)
+    flux = np.clip(stamps - bkg[:,np.newaxis,np.newaxis], 0, None).reshape(n, -1)
+
+    #Distance of every pixel from the centroid, in increasing order per star
+    dx = (cx - fx)[:,np.newaxis,np.newaxis] + offs[np.newaxis,:,np.newaxis]
+    dy = (cy - fy)[:,np.newaxis,np.newaxis] + offs[np.newaxis,np.newaxis,:]
+    r = np.sqrt(dx**2 + dy**2).reshape(n, -1)
+    order = np.argsort(r, axis=1)
+    idx = np.arange(n)[:,np.newaxis]
+    r, cumflux = r[idx, order], np.cumsum(flux[idx, order], axis=1)
+
+    total = cumflux[:,-1]
+    ihalf = np.argmax(cumflux >= 0.5 * total[:,np.newaxis], axis=1)
+    radii = r[np.arange(n), ihalf]
+
+    inside = (cx >= half) & (cx < img.shape[0] - half) & (cy >= half) & (cy < img.shape[1] - half)
+    radii[~inside | (total <= 0)] = np.nan
+
+    return radii
 
 def explore_region(x,y, img):
  
@@ -896,6 +1540,85 @@ def get_rotation_solution_offset(rotangle, guideroffsets, DEC, reverse=False):
 
     return offsets
 
+class CatalogPrefetchThread(QThread):
+    """Fills the catalog cache for the guider field of the next target in the
+    background so the astrometry after acquisition does not wait on VizieR.
+    Fields are queued with request() and fetched one at a time"""
+
+    updateText = pyqtSignal(str)
+
+    def __init__(self, catalogs = ['unso'], fov_am = 5):
+
+        QThread.__init__(self)
+
+        self.catalogs = catalogs
+        self.fov_am = fov_am
+        self.requests = Queue.Queue()
+        self.lastrequest = None
+        self.stopthread = False
+
+    def __del__(self):
+        self.wait()
+
+    def stop(self):
+        self.stopthread = True
+
+    def request(self, RA, DEC, rotangle = None):
+        """Queues the guider field of a telescope pointing given as 'HH MM SS.S',
+        '+DD MM SS.S'. rotangle is the expected IIS value, if None the whole
+        circle the guider field can fall in is fetched"""
+
+        self.requests.put((RA, DEC, rotangle))
+
+    def run(self):
+
+        while not self.stopthread:
+            try:
+                req = self.requests.get(timeout=1)
+            except Queue.Empty:
+                continue
+
+            #Only the latest pointing matters if several were queued
+            while not self.requests.empty():
+                req = self.requests.get()
+            if req == self.lastrequest:
+                continue
+
+            try:
+                ntiles = self.prefetch(*req)
+                self.lastrequest = req
+                if ntiles > 0:
+                    self.updateText.emit("CATALOG PREFETCHED FOR %s %s (%i TILES)" % (req[0], req[1], ntiles))
+            except Exception as e:
+                print e
+                print traceback.print_exc()
+                self.updateText.emit("### CATALOG PREFETCH FAILED FOR %s %s" % (req[0], req[1]))
+
+    def prefetch(self, RA, DEC, rotangle):
+        """Makes sure the catalog tiles around the expected guider field are
+        cached and returns the number of tiles that were fetched"""
+
+        coord = SkyCoord(RA, DEC, unit=(u.hourangle, u.deg))
+        ra_deg = coord.ra.deg
+        dec_deg = coord.dec.deg
+
+        valuesdict = read_defaults()
+        guider_offsets = [float(valuesdict['GuideRA']), float(valuesdict['GuideDEC'])]
+
+        if rotangle is None:
+            radius = (np.hypot(guider_offsets[0], guider_offsets[1]) / 3600.) + (self.fov_am / 60.)
+        else:
+            offsets = get_rotation_solution_offset(rotangle, guider_offsets, dec_deg)
+            ra_deg -= (offsets[0]/3600. / np.cos(dec_deg * np.pi / 180.))
+            dec_deg -= offsets[1]/3600.
+            radius = self.fov_am / 60.
+
+        ntiles = 0
+        for catalog in self.catalogs:
+            ntiles += get_catalog_cache(catalog).prefetch(ra_deg, dec_deg, radius)
+
+        return ntiles
+
 class AstrometryThread(QThread):
 
     updateText = pyqtSignal(str)
@@ -930,7 +1653,7 @@ class AstrometryThread(QThread):
             self.updateText.emit("STARTING ASTROMETRIC DERIVATION")
             try:
                 results = getAstrometricSoln(img, self.telSock, \
-                        self.head, self.rotangle, catalog='unso')
+                        self.head, self.rotangle, catalog='unso', learndistortion = True)
                 if len(results) < 3:
                     self.updateText.emit("NO ASTROMETRIC SOLUTION...NOT ENOUGH STARS? >=3")
                     self.updateText.emit("Try increasing exp time, or moving to a different field?")
@@ -1095,5 +1818,5 @@ class AstrometryThread(QThread):
         hdr['FOffDEC'] = (FOffsetdms, '//Arcsec from Telescope to WIFIS')
         hdr['GRAOff'] = (str(guideroffsets[0]), '//Guider RA Offset')
         hdr['GDECOff'] = (str(guideroffsets[1]), '//Guider DEC Offset')
-        fits.writeto('/Data/WIFISGuider/astrometry/'+todaydate+'T'+\
-                        time.strftime('%H%M%S')+'.fits', image, hdr, clobber=True)
+        WAR.archive('/Data/WIFISGuider/astrometry/'+todaydate+'T'+\
+                        time.strftime('%H%M%S')+'.fits', image, hdr)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFISbatchsolve.py
+# Purpose:          Re-solve archived guider frames in parallel
+#------------------------------------------------------------------------------
+
+"""
+Runs the guider astrometry on archived guider frames after a night to measure
+the drift of the guider offsets and the flexure. Frames are solved in a pool
+of processes and every result is appended to one table as soon as it is done,
+so an interrupted run picks up where it stopped. Frames already in the table
+are skipped (frames that failed are retried with --retry).
+
+    python WIFISbatchsolve.py [-o table] [-n nproc] [--catalog unso]
+                              [--solver translation] [--retry] [frames ...]
+
+frames are FITS files, directories or glob patterns and default to every frame
+in /Data/WIFISGuider/*/.
+"""
+
+import numpy as np
+import os, sys, time, traceback
+import argparse
+import multiprocessing
+from glob import glob
+
+homedir = os.path.dirname(os.path.realpath(__file__))
+
+guiderdir = '/Data/WIFISGuider/'
+resultsfile = homedir + '/log/guidersolutions.txt'
+
+rad2arcsec = 180. / np.pi * 3600.
+
+columns = ['filename', 'status', 'ra', 'dec', 'rotation', 'scale', 'nmatch', 'rms',\
+        'iis', 'raoffset', 'decoffset']
+rowformat = '%s\t%s\t%.7f\t%.7f\t%.4f\t%.5f\t%i\t%.3f\t%.2f\t%.2f\t%.2f\n'
+
+def plate_parameters(platesolve):
+    '''Returns the rotation (deg) and the pixel scale ("/pixel) of a plate
+    solution from solvePlateRobust'''
+
+    xsolve, ysolve = platesolve[0], platesolve[1]
+    scale = np.sqrt(np.abs(xsolve[0]*ysolve[1] - xsolve[1]*ysolve[0])) * rad2arcsec
+    rotation = np.arctan2(ysolve[0], xsolve[0]) * 180. / np.pi
+
+    return rotation, scale
+
+def solve_frame(args):
+    '''Solves one frame and returns its row of the results table. Runs in the
+    pool processes so it never raises. The plate is solved without the stored
+    distortion so the workers never touch the shared distortion file and the
+    results do not depend on the order the frames are solved in'''
+
+    fl, catalog, solver = args
+    empty = [np.nan]*4 + [0, np.nan, np.nan, np.nan, np.nan]
+
+    import WIFISastrometry as WA
+
+    try:
+        results = WA.getAstrometricSoln(fl, None, None, 0, catalog = catalog,\
+                solver = solver, distortion = False)
+    except Exception:
+        traceback.print_exc()
+        return [fl, 'error'] + empty
+
+    if len(results) == 1:
+        return [fl, 'nosolve'] + empty
+    elif len(results) == 2:
+        return [fl, 'offsets'] + empty
+
+    platesolve, fieldoffset, realcenter, solvecenter, guideroffsets, plotting = results[:6]
+    head = plotting[6]
+
+    rotation, scale = plate_parameters(platesolve)
+    nmatch = np.sum(platesolve[4])
+    rms = platesolve[3]
+
+    try:
+        iis = float(head['IIS'])
+    except (KeyError, ValueError, TypeError):
+        iis = np.nan
+
+    return [fl, 'ok', realcenter[0], realcenter[1], rotation, scale, nmatch, rms, iis,\
+            fieldoffset[0].to('arcsec').value, fieldoffset[1].to('arcsec').value]
+
+def quiet_worker():
+    '''Pool initializer that hides the astrometry printouts of the workers'''
+
+    sys.stdout = open(os.devnull, 'w')
+
+def find_frames(paths):
+    '''Returns the sorted FITS frames given as files, directories or globs'''
+
+    if not paths:
+        paths = [guiderdir + '*/*.fits']
+
+    frames = set()
+    for path in paths:
+        if os.path.isdir(path):
+            frames.update(glob(os.path.join(path, '*.fits')))
+        elif os.path.exists(path):
+            frames.add(path)
+        else:
+            frames.update(glob(path))
+
+    return sorted([os.path.realpath(fl) for fl in frames])
+
+def read_results(tablefile):
+    '''Returns a dict of filename: status for the frames already in the table'''
+
+    done = {}
+    if not os.path.exists(tablefile):
+        return done
+
+    f = open(tablefile, 'r')
+    for line in f:
+        if line.startswith('#'):
+            continue
+        spl = line.split('\t')
+        if len(spl) >= 2:
+            done[spl[0]] = spl[1]
+    f.close()
+
+    return done
+
+def batch_solve(frames, tablefile = resultsfile, nproc = None, catalog = 'unso',\
+        solver = 'translation', retry = False, quiet = True):
+    '''Solves all frames not yet in tablefile across nproc processes, appending
+    each result to the table as it finishes'''
+
+    done = read_results(tablefile)
+    if retry:
+        todo = [fl for fl in frames if done.get(fl) != 'ok']
+    else:
+        todo = [fl for fl in frames if fl not in done]
+
+    print "%i frames, %i already in %s, %i to solve" % (len(frames), len(frames) - len(todo),\
+            tablefile, len(todo))
+    if not todo:
+        return
+
+    newtable = not os.path.exists(tablefile)
+    f = open(tablefile, 'a')
+    if newtable:
+        f.write('# ' + '\t'.join(columns) + '\n')
+        f.flush()
+
+    if nproc == None:
+        nproc = multiprocessing.cpu_count()
+    if quiet:
+        pool = multiprocessing.Pool(nproc, quiet_worker)
+    else:
+        pool = multiprocessing.Pool(nproc)
+
+    t0 = time.time()
+    nsolved = 0
+    try:
+        for i, row in enumerate(pool.imap_unordered(solve_frame, \
+                [(fl, catalog, solver) for fl in todo])):
+            f.write(rowformat % tuple(row))
+            f.flush()
+            if row[1] == 'ok':
+                nsolved += 1
+            print "[%i/%i] %s %s (%.1f s)" % (i+1, len(todo), os.path.basename(row[0]), row[1],\
+                    time.time() - t0)
+        pool.close()
+    except KeyboardInterrupt:
+        print "### Stopping, rerun to continue where this run stopped"
+        pool.terminate()
+    finally:
+        pool.join()
+        f.close()
+
+    print "Solved %i of %i frames in %.1f s" % (nsolved, len(todo), time.time() - t0)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Re-solve archived guider frames')
+    parser.add_argument('frames', nargs='*', help='FITS files, directories or globs')
+    parser.add_argument('-o', '--output', default=resultsfile, help='results table')
+    parser.add_argument('-n', '--nproc', type=int, default=None, help='number of processes')
+    parser.add_argument('--catalog', default='unso', help='unso or sdss')
+    parser.add_argument('--solver', default='translation', help='translation or asterism')
+    parser.add_argument('--retry', action='store_true', help='retry frames that failed')
+    parser.add_argument('--verbose', action='store_true', help='show the astrometry output')
+    args = parser.parse_args()
+
+    batch_solve(find_frames(args.frames), tablefile = args.output, nproc = args.nproc,\
+            catalog = args.catalog, solver = args.solver, retry = args.retry,\
+            quiet = not args.verbose)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFISbenchmark.py
+# Purpose:          Speed and accuracy benchmark of the guider astrometry
+#------------------------------------------------------------------------------
+
+"""
+Times each stage of the guider astrometry on synthetic fields (WIFISsynthetic)
+over a range of star densities and measures the results against the known
+solution. The results are written as JSON together with the git revision so
+runs of different versions can be compared.
+
+    python WIFISbenchmark.py [-o results.json] [--densities 50,100,200,400]
+                             [--trials 3] [--repeats 3]
+
+Stages:
+    centroid    centroid_finder on the bias subtracted frame
+    match_loop  compareFields3
+    match_kd    compareFieldsKD
+    match_ast   compareFieldsAsterism
+    plate       solvePlate
+    plate_rob   solvePlateRobust
+    full        getAstrometricSoln
+"""
+
+import numpy as np
+import os, sys, time, json, subprocess
+import argparse
+
+import WIFISastrometry as WA
+import WIFISsynthetic as WS
+import WIFISframestore as WF
+
+homedir = os.path.dirname(os.path.realpath(__file__))
+
+rad2arcsec = 180. / np.pi * 3600.
+
+class quiet(object):
+    '''Hides the printouts of the astrometry while a stage is timed'''
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def timed(f, repeats, *args, **kwargs):
+    '''Returns the result of f and its fastest run time of repeats runs'''
+
+    times = []
+    for i in range(repeats):
+        with quiet():
+            t0 = time.time()
+            result = f(*args, **kwargs)
+            times.append(time.time() - t0)
+
+    return result, min(times)
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=homedir).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def match_truth(cx, cy, truth, tol = 1.5):
+    '''Returns for every detection the catalog index of the true star within
+    tol pixels, or -1, and the distance to it'''
+
+    if len(cx) == 0 or len(truth['x']) == 0:
+        return np.zeros(len(cx), dtype=int) - 1, np.zeros(len(cx)) + np.inf
+
+    dist = np.hypot(np.asarray(cx)[:,np.newaxis] - truth['x'], np.asarray(cy)[:,np.newaxis] - truth['y'])
+    nearest = np.argmin(dist, axis=1)
+    mindist = dist[np.arange(len(cx)), nearest]
+    index = np.where(mindist < tol, truth['index'][nearest], -1)
+
+    return index, mindist
+
+def centre_error(platesolve, ra_deg, dec_deg, truth):
+    '''Distance in arcsec between the field centre of a plate solution and the
+    true field centre'''
+
+    Xcen, Ycen = WA.returnXY(platesolve, 512, 512)
+    ra_cen, dec_cen = WA.returnRADEC(Xcen, Ycen, ra_deg, dec_deg)
+
+    dra = (ra_cen - truth['center'][0]) * np.cos(truth['center'][1] * np.pi / 180.)
+    ddec = dec_cen - truth['center'][1]
+
+    return np.hypot(dra, ddec) * 3600.
+
+def benchmark_field(nstars, seed, repeats = 3, rotangle = 90.):
+    '''Runs every stage on one synthetic field and returns a list of result
+    dicts, one per stage'''
+
+    img, head, stars, truth = WS.synthetic_field(150., 30., rotangle, nstars = nstars, seed = seed,\
+            pointing_error = (4., -3.))
+    data = WF.get_framestore().calibrate(img)
+    results = []
+
+    #Centroiding
+    centroids, t = timed(WA.centroid_finder, repeats, data)
+    cx, cy, Iarr = np.array(centroids[0]), np.array(centroids[1]), np.array(centroids[2])
+    index, dist = match_truth(cx, cy, truth)
+    noise = np.std(data[data < np.median(data) + 50])
+    detectable = np.sum(truth['peak'] > 10 * noise)
+    results.append({'stage': 'centroid', 'time': t, 'ndetected': len(cx),\
+            'ntrue': int(np.sum(index >= 0)), 'ndetectable': int(detectable),\
+            'median_error_pix': float(np.median(dist[index >= 0])) if np.any(index >= 0) else None})
+
+    #The inputs of the matchers as in getAstrometricSoln
+    valuesdict = WA.read_defaults()
+    guider_offsets = [float(valuesdict['GuideRA']), float(valuesdict['GuideDEC'])]
+    RA = head['RA'][0:2] + ' ' + head['RA'][2:4] + ' ' + head['RA'][4:]
+    DEC = head['DEC'][0:3] + ' ' + head['DEC'][3:5] + ' ' + head['DEC'][5:]
+    offsets = WA.get_rotation_solution_offset(rotangle, guider_offsets, 30.)
+    with quiet():
+        name, rad, ded, rmag, ra_deg, dec_deg, fov_am, coord, newcoord, catalog = \
+                WA.grabUNSOfield(RA, DEC, offsets = offsets, catalog = 'synthetic')
+    xorig, yorig = cx, cy
+    yorigflip = -1*(yorig - 1024)
+    cxrot, cyrot, cxrotneg, cyrotneg = WA.rotate_points(rotangle, xorig, yorig)
+    x = np.array(cxrotneg)
+    y = -1*(np.array(cyrotneg) - 1024)
+    xproj, yproj, X, Y = WA.projected_coords(rad, ded, ra_deg, dec_deg)
+    k = rmag < WA.catalogs['synthetic']['maglimit']
+    catindex = np.array([int(n[3:]) for n in name[k]])
+
+    matchers = [('match_loop', WA.compareFields3, (x, y, xproj, yproj, rad, ded, k, Iarr)),\
+            ('match_kd', WA.compareFieldsKD, (x, y, xproj, yproj, rad, ded, k, Iarr)),\
+            ('match_ast', WA.compareFieldsAsterism, (xorig, yorigflip, xproj, yproj, rad, ded, k,\
+            Iarr, rmag))]
+    posi, disti = [], []
+    for stage, matcher, args in matchers:
+        match, t = timed(matcher, repeats, *args)
+        if match is None:
+            results.append({'stage': stage, 'time': t, 'nmatch': 0, 'ncorrect': 0})
+            continue
+        mposi = np.array(match[9], dtype=int)
+        mdisti = np.array(match[8], dtype=int)
+        correct = np.sum(index[mposi] == catindex[mdisti])
+        results.append({'stage': stage, 'time': t, 'nmatch': len(mposi), 'ncorrect': int(correct)})
+        if stage == 'match_kd':
+            posi, disti = mposi, mdisti
+
+    #Plate solutions from the KD-tree matches
+    if len(posi) >= 3:
+        args = (xorig[posi], yorigflip[posi], X[k][disti], Y[k][disti])
+        for stage, solver, kwargs in [('plate', WA.solvePlate, {}),\
+                ('plate_rob', WA.solvePlateRobust, {'weights': Iarr[posi]})]:
+            platesolve, t = timed(solver, repeats, *args, **kwargs)
+            results.append({'stage': stage, 'time': t,\
+                    'centre_error_arcsec': float(centre_error(platesolve, ra_deg, dec_deg, truth))})
+
+    #The whole solution
+    soln, t = timed(WA.getAstrometricSoln, 1, img, None, head.copy(), rotangle,\
+            catalog = 'synthetic', distortion = False)
+    result = {'stage': 'full', 'time': t, 'solved': len(soln) > 2}
+    if len(soln) > 2:
+        realcenter = soln[2]
+        dra = (realcenter[0] - truth['center'][0]) * np.cos(truth['center'][1] * np.pi / 180.)
+        result['centre_error_arcsec'] = float(np.hypot(dra, realcenter[1] - truth['center'][1]) * 3600.)
+        result['rms_arcsec'] = float(soln[0][3])
+        result['nused'] = int(np.sum(soln[0][4]))
+    results.append(result)
+
+    for r in results:
+        r['nstars'] = nstars
+        r['seed'] = seed
+
+    return results
+
+def summarize(results):
+    '''Median of every numeric result per stage and star density'''
+
+    summary = {}
+    for r in results:
+        key = '%s_%i' % (r['stage'], r['nstars'])
+        summary.setdefault(key, []).append(r)
+
+    out = {}
+    for key, rs in sorted(summary.items()):
+        out[key] = {}
+        for field in rs[0]:
+            vals = [r[field] for r in rs if isinstance(r.get(field), (int, float, bool)) \
+                    and r.get(field) is not None]
+            if field not in ['nstars', 'seed', 'stage'] and vals:
+                out[key][field] = float(np.median(vals))
+
+    return out
+
+def run_benchmark(densities = [50, 100, 200, 400], trials = 3, repeats = 3):
+
+    results = []
+    for nstars in densities:
+        for trial in range(trials):
+            results += benchmark_field(nstars, seed = trial, repeats = repeats)
+
+    return {'revision': git_revision(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),\
+            'numpy': np.__version__, 'densities': densities, 'trials': trials,\
+            'summary': summarize(results), 'results': results}
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the guider astrometry')
+    parser.add_argument('-o', '--output', default=homedir + '/log/astrometrybenchmark_' + \
+            time.strftime('%Y%m%dT%H%M%S') + '.json', help='JSON results file')
+    parser.add_argument('--densities', default='50,100,200,400',\
+            help='comma separated numbers of stars in the 9\' synthetic field')
+    parser.add_argument('--trials', type=int, default=3, help='fields per density')
+    parser.add_argument('--repeats', type=int, default=3, help='timing repeats per stage')
+    args = parser.parse_args()
+
+    report = run_benchmark([int(n) for n in args.densities.split(',')], args.trials, args.repeats)
+
+    f = open(args.output, 'w')
+    json.dump(report, f, indent=1, sort_keys=True)
+    f.close()
+
+    for key, vals in sorted(report['summary'].items()):
+        print key.ljust(16), '  '.join(['%s=%.4g' % (k, v) for k, v in sorted(vals.items())])
+    print "Results written to %s" % (args.output)
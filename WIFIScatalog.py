@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFIScatalog.py
+# Purpose:          Offline star catalog cache for the WIFIS guider astrometry
+#------------------------------------------------------------------------------
+
+"""
+Local on-disk store for the VizieR star catalogs used to solve the guider
+field. The sky is split into declination bands which are cut into RA cells of
+roughly equal size on the sky. Each cell (tile) is fetched from VizieR once,
+stored as a binary numpy file and afterwards read from disk. Tiles are
+evicted least recently used first when the cache grows past its size cap.
+
+Run as a script to fill the cache for a night's target list:
+
+    python WIFIScatalog.py [targetlist] [catalog]
+"""
+
+import numpy as np
+import os, sys, time, thread
+
+homedir = os.path.dirname(os.path.realpath(__file__))
+
+cachedir = homedir + '/data/catalogcache/'
+tilesize = 0.5                      #Height of the declination bands in deg
+maxcachesize = 500 * 1024 * 1024    #Cache size cap in bytes
+
+catalogdtype = [('name', 'S24'), ('ra', 'f8'), ('dec', 'f8'), ('mag', 'f4')]
+
+def band_cells(band):
+    '''Returns the number of RA cells in a declination band. Cells are sized so
+    they are at most tilesize wide on the sky anywhere in the band'''
+
+    decmin = -90. + band*tilesize
+    decmax = decmin + tilesize
+    if (decmin < 0) and (decmax > 0):
+        mindec = 0.
+    else:
+        mindec = min(abs(decmin), abs(decmax))
+
+    return max(1, int(np.ceil(360. * np.cos(mindec * np.pi / 180.) / tilesize)))
+
+def tile_bounds(band, cell):
+    '''Returns the RA and DEC limits of a tile in degrees'''
+
+    ncells = band_cells(band)
+    decmin = -90. + band*tilesize
+    ramin = 360. * cell / ncells
+
+    return ramin, ramin + 360./ncells, decmin, decmin + tilesize
+
+def tile_query_size(band, cell, margin = 1.1, nedge = 16):
+    '''Returns the side in arcmin of a query box centred on the tile that covers
+    all of it. The extent is measured on the tile edges both in the tangent
+    plane at the centre and as RA offset times cos(dec) of the centre (the box
+    of in_box), so it holds for wide cells near the poles'''
+
+    ramin, ramax, decmin, decmax = tile_bounds(band, cell)
+    rac = (ramin + ramax) / 2. * np.pi / 180.
+    decc = (decmin + decmax) / 2. * np.pi / 180.
+
+    edge = np.linspace(0., 1., nedge)
+    ra = np.concatenate([ramin + (ramax - ramin) * edge] * 2 + [[ramin] * 2, [ramax] * 2])
+    dec = np.concatenate([[decmin] * nedge, [decmax] * nedge, [decmin, decmax] * 2])
+    ra, dec = ra * np.pi / 180., dec * np.pi / 180.
+
+    cosc = np.sin(decc) * np.sin(dec) + np.cos(decc) * np.cos(dec) * np.cos(ra - rac)
+    xi = np.cos(dec) * np.sin(ra - rac) / cosc
+    eta = (np.cos(decc) * np.sin(dec) - np.sin(decc) * np.cos(dec) * np.cos(ra - rac)) / cosc
+    tangent = np.max(np.abs(np.concatenate([xi, eta]))) * 180. / np.pi
+
+    rahalf = (ramax - ramin) / 2. * np.cos(decc)
+    dechalf = (decmax - decmin) / 2.
+
+    return 2. * max(tangent, rahalf, dechalf) * 60. * margin
+
+def tile_index(ra, dec):
+    '''Returns the (band, cell) of the tile containing ra, dec in degrees'''
+
+    band = min(int((dec + 90.) / tilesize), int(180. / tilesize) - 1)
+    ncells = band_cells(band)
+    cell = int((ra % 360.) / 360. * ncells) % ncells
+
+    return band, cell
+
+def tiles_in_box(ra, dec, halfwidth):
+    '''Returns the tiles overlapping a box of +/- halfwidth degrees on the sky
+    around ra, dec'''
+
+    decmin = max(dec - halfwidth, -90.)
+    decmax = min(dec + halfwidth, 90. - 1e-9)
+    maxdec = min(max(abs(decmin), abs(decmax)), 89.9)
+    rahalf = halfwidth / np.cos(maxdec * np.pi / 180.)
+
+    tiles = []
+    for band in range(tile_index(0., decmin)[0], tile_index(0., decmax)[0] + 1):
+        ncells = band_cells(band)
+        if rahalf >= 180.:
+            cells = range(ncells)
+        else:
+            cell0 = int(np.floor((ra - rahalf) / 360. * ncells))
+            cell1 = int(np.floor((ra + rahalf) / 360. * ncells))
+            cells = sorted(set([c % ncells for c in range(cell0, cell1 + 1)]))
+        for cell in cells:
+            tiles.append((band, cell))
+
+    return tiles
+
+def in_box(ra, dec, ra0, dec0, halfwidth):
+    '''Boolean mask of the catalog positions inside the box around ra0, dec0'''
+
+    dra = (ra - ra0 + 180.) % 360. - 180.
+    return (np.abs(dec - dec0) <= halfwidth) & \
+            (np.abs(dra * np.cos(dec0 * np.pi / 180.)) <= halfwidth)
+
+class CatalogCache(object):
+    '''Tiled on-disk cache for one catalog. fetch is the function that queries
+    the catalog over the network. It takes (radeg, decdeg, fovam) and returns
+    a record array with catalogdtype fields like WIFISastrometry.unso_records'''
+
+    def __init__(self, catalog, fetch, directory = cachedir, maxsize = maxcachesize):
+
+        self.catalog = catalog
+        self.fetch = fetch
+        self.rootdir = directory
+        self.directory = os.path.join(directory, catalog)
+        self.maxsize = maxsize
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def tilepath(self, band, cell):
+        return os.path.join(self.directory, '%03i_%05i.npy' % (band, cell))
+
+    def has_tile(self, band, cell):
+        return os.path.exists(self.tilepath(band, cell))
+
+    def get_tile(self, band, cell):
+        '''Returns the catalog stars in a tile, querying the catalog and storing
+        the tile if it is not already cached. A failed query raises and stores
+        nothing, so the tile is queried again next time'''
+
+        path = self.tilepath(band, cell)
+        if os.path.exists(path):
+            try:
+                tile = np.load(path)
+                #Mark the tile as recently used
+                os.utime(path, None)
+                return tile
+            except (IOError, ValueError):
+                print "### Catalog tile %s is unreadable, fetching again" % (path)
+
+        tile = self.fetch_tile(band, cell)
+        self.save_tile(path, tile)
+        self.evict()
+
+        return tile
+
+    def fetch_tile(self, band, cell):
+        '''Queries the catalog for a box covering the tile and keeps only the stars
+        inside the tile limits so that neighbouring tiles do not overlap'''
+
+        ramin, ramax, decmin, decmax = tile_bounds(band, cell)
+        rac = (ramin + ramax) / 2.
+        decc = (decmin + decmax) / 2.
+
+        stars = self.fetch(rac, decc, tile_query_size(band, cell))
+
+        inside = (stars['ra'] >= ramin) & (stars['ra'] < ramax) & \
+                (stars['dec'] >= decmin) & (stars['dec'] < decmax)
+
+        return np.asarray(stars[inside], dtype=catalogdtype)
+
+    def save_tile(self, path, tile):
+        '''Writes the tile to a temporary file and renames it so that readers
+        never see a partially written tile. The temporary name is unique per
+        process and thread since tiles are also fetched in the background'''
+
+        tmppath = path + '.%i.%i.tmp' % (os.getpid(), thread.get_ident())
+        f = open(tmppath, 'wb')
+        np.save(f, tile)
+        f.close()
+        os.rename(tmppath, path)
+
+    def get_records(self, radeg, decdeg, fovam):
+        '''Returns a record array of the stars in the fovam x fovam arcmin box
+        around radeg, decdeg using the cached tiles'''
+
+        halfwidth = fovam / 60. / 2.
+        tiles = [self.get_tile(band, cell) for band, cell in \
+                tiles_in_box(radeg, decdeg, halfwidth)]
+        stars = np.concatenate(tiles)
+
+        return stars[in_box(stars['ra'], stars['dec'], radeg, decdeg, halfwidth)].view(np.recarray)
+
+    def get_field(self, radeg, decdeg, fovam):
+        '''Returns name, ra, dec, mag for the fovam x fovam arcmin box around
+        radeg, decdeg using the cached tiles'''
+
+        stars = self.get_records(radeg, decdeg, fovam)
+
+        return stars['name'], stars['ra'], stars['dec'], stars['mag'].astype(float)
+
+    def prefetch(self, radeg, decdeg, radius):
+        '''Makes sure all tiles within radius degrees of radeg, decdeg are in
+        the cache. Returns the number of tiles that had to be fetched'''
+
+        nfetched = 0
+        for band, cell in tiles_in_box(radeg, decdeg, radius):
+            if not self.has_tile(band, cell):
+                self.get_tile(band, cell)
+                nfetched += 1
+
+        return nfetched
+
+    def evict(self):
+        '''Removes the least recently used tiles of all catalogs until the cache
+        is below its size cap'''
+
+        tiles = []
+        for root, dirs, files in os.walk(self.rootdir):
+            for fl in files:
+                if fl.endswith('.npy'):
+                    path = os.path.join(root, fl)
+                    st = os.stat(path)
+                    tiles.append((st.st_mtime, st.st_size, path))
+
+        total = sum([t[1] for t in tiles])
+        for mtime, size, path in sorted(tiles):
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+def read_targetlist(tarlistfile = homedir + '/data/targetlist.txt'):
+    '''Reads the target list as Name, RA (HHMMSS.S), DEC (+DDMMSS.S) lines and
+    returns a list of (name, radeg, decdeg)'''
+
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+
+    targets = []
+    f = open(tarlistfile, 'r')
+    for line in f:
+        spl = line.split()
+        if (len(spl) < 3) or spl[0].startswith('#'):
+            continue
+        RA = spl[1][0:2] + ' ' + spl[1][2:4] + ' ' + spl[1][4:]
+        DEC = spl[2][0:3] + ' ' + spl[2][3:5] + ' ' + spl[2][5:]
+        coord = SkyCoord(RA, DEC, unit=(u.hourangle, u.deg))
+        targets.append((spl[0], coord.ra.deg, coord.dec.deg))
+    f.close()
+
+    return targets
+
+def prefetch_targets(tarlistfile = homedir + '/data/targetlist.txt', catalogs = ['unso']):
+    '''Fills the catalog cache for every target in the target list. The guider
+    field sits at the guider offset from the target at an unknown rotator
+    angle, so the whole circle the guider field can fall in is fetched'''
+
+    import WIFISastrometry as WA
+
+    valuesdict = WA.read_defaults()
+    guider_offsets = [float(valuesdict['GuideRA']), float(valuesdict['GuideDEC'])]
+    radius = (np.hypot(guider_offsets[0], guider_offsets[1]) / 3600.) + (5. / 60.)
+
+    for catalog in catalogs:
+        cache = WA.get_catalog_cache(catalog)
+        for name, radeg, decdeg in read_targetlist(tarlistfile):
+            t0 = time.time()
+            nfetched = cache.prefetch(radeg, decdeg, radius)
+            print "%s %s: fetched %i tiles in %.1f s" % (catalog, name, nfetched, time.time() - t0)
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1:
+        tarlistfile = sys.argv[1]
+    else:
+        tarlistfile = homedir + '/data/targetlist.txt'
+    if len(sys.argv) > 2:
+        catalogs = sys.argv[2].split(',')
+    else:
+        catalogs = ['unso']
+
+    prefetch_targets(tarlistfile, catalogs)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFISdisplay.py
+# Purpose:          Persistent blitted image display for the plot windows
+#------------------------------------------------------------------------------
+
+"""
+Image display for the detector and guider plots that keeps its axes, image,
+colorbar and overlays between frames. A new frame only replaces the pixel
+data of the image (set_data) and is blitted over the background saved at the
+last full draw, instead of clearing the figure and drawing everything again.
+
+    display = WD.ImageDisplay(figure, canvas)
+    display.show(image, title, percentile = 98.5)
+
+Arrows and labels drawn over the image are made by an overlays(ax) function
+returning the artists, called again only when overlaykey changes.
+
+The display limits are percentiles of a subsample of about nsample pixels and
+are kept until the new ones move by more than limittol of the range, so the
+colorbar (which needs a full draw) only changes when the field does. Frames
+larger than maxsize pixels are binned down (block mean) for the display; the
+axes and the coordinate readout stay in the pixels of the full frame.
+
+The figure is set up again with a full draw when another plot has used it
+(for example the astrometric field), when the frame size changes or when the
+limits change. The background is saved again after every draw of the canvas,
+so zooming, panning and resizing the window keep working.
+"""
+
+import numpy as np
+
+class ImageDisplay(object):
+    '''Image with a colorbar in figure, updated in place by show()'''
+
+    def __init__(self, figure, canvas, maxsize = 1024, nsample = 20000, limittol = 0.1, cmap = None):
+
+        self.figure = figure
+        self.canvas = canvas
+        self.maxsize = maxsize
+        self.nsample = nsample
+        self.limittol = limittol
+        self.cmap = cmap
+
+        self.ax = None
+        self.im = None
+        self.image = None
+        self.shape = None
+        self.limits = None
+        self.overlays = []
+        self.overlaykey = None
+        self.background = None
+
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def decimate(self, image):
+        '''Binning factor and the image binned by it to at most maxsize pixels
+        on a side'''
+
+        factor = int(np.ceil(max(image.shape) / float(self.maxsize)))
+        if factor <= 1:
+            return 1, image
+
+        #Summing the strided views is several times faster than a reshaped mean
+        ny, nx = (image.shape[0] // factor) * factor, (image.shape[1] // factor) * factor
+        binned = np.zeros((ny // factor, nx // factor), dtype=np.float32)
+        for i in range(factor):
+            for j in range(factor):
+                binned += image[i:ny:factor, j:nx:factor]
+        binned /= factor**2
+
+        return factor, binned
+
+    def percentile_limits(self, image, percentile):
+        '''Display limits keeping the central percentile of a subsample'''
+
+        step = max(int(np.sqrt(image.size / float(self.nsample))), 1)
+        sample = image[::step, ::step].ravel()
+        sample = sample[np.isfinite(sample)]
+        if sample.size == 0:
+            return 0., 1.
+        lo, hi = np.percentile(sample, [50. - percentile / 2., 50. + percentile / 2.])
+        if hi <= lo:
+            hi = lo + 1.
+
+        return float(lo), float(hi)
+
+    def format_coord(self, x, y):
+        '''Mouseover readout with the value of the full frame pixel'''
+
+        row, col = int(round(y)), int(round(x))
+        if (self.image is not None) and (0 <= row < self.image.shape[0]) and (0 <= col < self.image.shape[1]):
+            return 'x={:.01f}, y={:.01f}, z={:.01f}'.format(x, y, self.image[row, col])
+        return 'x={:.01f}, y={:.01f}'.format(x, y)
+
+    def needs_setup(self, shape):
+
+        return (self.ax is None) or (self.ax not in self.figure.axes) or (shape != self.shape)
+
+    def setup(self, shown, factor, title):
+        '''Clears the figure and builds the axes, image and colorbar'''
+
+        self.figure.clear()
+        self.overlays = []
+        self.overlaykey = None
+        self.background = None
+
+        ny, nx = shown.shape[0] * factor, shown.shape[1] * factor
+        self.ax = self.figure.add_subplot(1,1,1)
+        self.im = self.ax.imshow(shown, origin='lower', interpolation='none', cmap=self.cmap,\
+                vmin=self.limits[0], vmax=self.limits[1], extent=(-0.5, nx - 0.5, -0.5, ny - 0.5))
+        self.ax.format_coord = self.format_coord
+        self.ax.set_title(title)
+        self.figure.colorbar(self.im)
+        self.figure.tight_layout()
+
+        #Drawn by blit() over the saved background
+        self.im.set_animated(True)
+        self.ax.title.set_animated(True)
+        self.shape = shown.shape
+
+    def add_overlay(self, artist):
+        '''Keeps artist (an arrow or label on the image) drawn over every
+        frame'''
+
+        artist.set_animated(True)
+        self.overlays.append(artist)
+
+        return artist
+
+    def clear_overlays(self):
+
+        for artist in self.overlays:
+            artist.remove()
+        self.overlays = []
+        self.overlaykey = None
+
+    def show(self, image, title = '', percentile = 99.5, overlays = None, overlaykey = None):
+        '''Displays image, with the artists made by overlays(ax) over it.
+        Returns True when the figure was drawn in full and False when only the
+        frame was blitted'''
+
+        self.image = image
+        factor, shown = self.decimate(image)
+        limits = self.percentile_limits(shown, percentile)
+
+        full = False
+        if self.needs_setup(shown.shape):
+            self.limits = limits
+            self.setup(shown, factor, title)
+            full = True
+        else:
+            self.im.set_data(shown)
+            self.ax.title.set_text(title)
+            span = self.limits[1] - self.limits[0]
+            if (abs(limits[0] - self.limits[0]) > self.limittol * span) or \
+                    (abs(limits[1] - self.limits[1]) > self.limittol * span):
+                self.limits = limits
+                self.im.set_clim(*limits)
+                full = True
+
+        if overlays is None:
+            self.clear_overlays()
+        elif (not self.overlays) or (overlaykey != self.overlaykey):
+            self.clear_overlays()
+            for artist in overlays(self.ax):
+                self.add_overlay(artist)
+            self.overlaykey = overlaykey
+
+        if full or (self.background is None):
+            self.canvas.draw()
+            return True
+
+        self.blit()
+        return False
+
+    def draw_animated(self):
+
+        self.ax.draw_artist(self.im)
+        for artist in self.overlays:
+            self.ax.draw_artist(artist)
+        self.ax.draw_artist(self.ax.title)
+
+    def blit(self):
+
+        self.canvas.restore_region(self.background)
+        self.draw_animated()
+        self.canvas.blit(self.figure.bbox)
+
+    def on_draw(self, event):
+        '''Saves the background after a full draw of the canvas'''
+
+        if (self.ax is None) or (self.ax not in self.figure.axes):
+            self.background = None
+            return
+
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.draw_animated()
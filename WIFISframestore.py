@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFISframestore.py
+# Purpose:          Shared guider bias and dark calibration frames
+#------------------------------------------------------------------------------
+
+"""
+Calibration frames for the WIFIS guider camera. The master bias and the master
+darks are read from FITS once, written as float32 numpy files to
+data/calibcache/ and from then on opened as read-only memory maps. Every
+consumer (guider, astrometry, GUI) gets a view of the same mapped pages, so
+subtracting the bias from a frame costs no file I/O and the memory used does
+not grow with the number of consumers.
+
+Master darks go in data/guiderdarks/ as FITS files with EXPTIME (ms, as in the
+guider image headers) and CCDTEMP (C) header keywords. They are stored bias
+subtracted and interpolated linearly in exposure time and CCD temperature.
+"""
+
+import numpy as np
+import os, threading
+from glob import glob
+from astropy.io import fits
+
+homedir = os.path.dirname(os.path.realpath(__file__))
+
+biasfile = homedir + '/data/GuiderBias.fits'
+darkdir = homedir + '/data/guiderdarks/'
+mapdir = homedir + '/data/calibcache/'
+
+class FrameStore(object):
+    '''Loads the guider calibration frames once and hands out read-only float32
+    views of them. Use get_framestore() to get the shared instance'''
+
+    def __init__(self, biasfile = biasfile, darkdir = darkdir, mapdir = mapdir):
+
+        self.biasfile = biasfile
+        self.darkdir = darkdir
+        self.mapdir = mapdir
+        self.lock = threading.Lock()
+
+        self.biasframe = None
+        self.darks = None
+        self.lastdark = (None, None)
+
+        if not os.path.exists(self.mapdir):
+            os.makedirs(self.mapdir)
+
+    def mapped_frame(self, fitsfile, name, subtract = None, depends = []):
+        '''Returns a read-only float32 memory map of the frame in fitsfile. The
+        float32 copy is only written when it is missing or older than the FITS
+        file or any of the files in depends. subtract is an optional frame
+        removed before storing (its FITS file belongs in depends)'''
+
+        path = os.path.join(self.mapdir, name + '.npy')
+        newest = max([os.path.getmtime(fl) for fl in [fitsfile] + list(depends)])
+        if (not os.path.exists(path)) or (os.path.getmtime(path) < newest):
+            data = fits.getdata(fitsfile).astype(np.float32)
+            if subtract is not None:
+                data -= subtract
+
+            #Write to a temporary file and rename so other processes never map
+            #a partially written frame
+            tmppath = path + '.%i.tmp' % (os.getpid())
+            f = open(tmppath, 'wb')
+            np.save(f, data)
+            f.close()
+            os.rename(tmppath, path)
+
+        return np.load(path, mmap_mode='r')
+
+    def bias(self):
+        '''Returns the master bias as a read-only float32 array'''
+
+        with self.lock:
+            if self.biasframe is None:
+                self.biasframe = self.mapped_frame(self.biasfile, 'bias')
+
+        return self.biasframe
+
+    def load_darks(self):
+        '''Maps all of the master darks in darkdir. Returns a list of
+        (exptime, ccdtemp, frame) sorted by exposure time'''
+
+        bias = self.bias()
+
+        with self.lock:
+            if self.darks is not None:
+                return self.darks
+
+            darks = []
+            for fl in sorted(glob(os.path.join(self.darkdir, '*.fits'))):
+                try:
+                    head = fits.getheader(fl)
+                    exptime = float(head['EXPTIME'])
+                    ccdtemp = float(head.get('CCDTEMP', np.nan))
+                    name = 'dark_' + os.path.splitext(os.path.basename(fl))[0]
+                    #Stored bias subtracted, so a new bias also rewrites them
+                    darks.append((exptime, ccdtemp, self.mapped_frame(fl, name, subtract = bias,\
+                            depends = [self.biasfile])))
+                except (IOError, KeyError, ValueError) as e:
+                    print "### Could not load guider dark %s: %s" % (fl, e)
+
+            darks.sort(key = lambda d: d[0])
+            self.darks = darks
+
+        return self.darks
+
+    def reload(self):
+        '''Forgets the mapped frames so that new or updated calibrations are
+        picked up on the next request'''
+
+        with self.lock:
+            self.biasframe = None
+            self.darks = None
+            self.lastdark = (None, None)
+
+    def dark_at_temperature(self, darks, exptime):
+        '''Interpolates the darks taken at one temperature to exptime. Outside
+        the range of exposure times the nearest dark is scaled linearly'''
+
+        exptimes = np.array([d[0] for d in darks])
+        above = np.where(exptimes >= exptime)[0]
+        below = np.where(exptimes <= exptime)[0]
+
+        if len(above) and len(below):
+            lo = darks[below[-1]]
+            hi = darks[above[0]]
+            if hi[0] == lo[0]:
+                return lo[2]
+            w = (exptime - lo[0]) / (hi[0] - lo[0])
+            return (1. - w) * lo[2] + w * hi[2]
+
+        if len(above):
+            nearest = darks[above[0]]
+        else:
+            nearest = darks[below[-1]]
+        if nearest[0] <= 0:
+            return nearest[2]
+
+        return nearest[2] * np.float32(exptime / nearest[0])
+
+    def dark(self, exptime, ccdtemp = None):
+        '''Returns the bias subtracted dark for exptime (ms) and ccdtemp (C),
+        interpolated between the master darks. Returns None if there are no
+        darks. Without a temperature the darks of the coldest temperature are
+        used'''
+
+        darks = self.load_darks()
+        if not darks:
+            return None
+
+        key = (float(exptime), ccdtemp)
+        if self.lastdark[0] == key:
+            return self.lastdark[1]
+
+        groups = {}
+        for d in darks:
+            if np.isfinite(d[1]):
+                groups.setdefault(d[1], []).append(d)
+            else:
+                groups.setdefault(None, []).append(d)
+        temps = sorted([t for t in groups if t is not None])
+
+        if not temps:
+            dark = self.dark_at_temperature(groups[None], exptime)
+        elif (ccdtemp is None) or (len(temps) == 1):
+            dark = self.dark_at_temperature(groups[temps[0]], exptime)
+        else:
+            hi = min(max(np.searchsorted(temps, ccdtemp), 1), len(temps) - 1)
+            t0, t1 = temps[hi - 1], temps[hi]
+            d0 = self.dark_at_temperature(groups[t0], exptime)
+            d1 = self.dark_at_temperature(groups[t1], exptime)
+            w = np.clip((ccdtemp - t0) / (t1 - t0), 0., 1.)
+            dark = (1. - w) * d0 + w * d1
+
+        self.lastdark = (key, dark)
+
+        return dark
+
+    def calibrate(self, img, exptime = None, ccdtemp = None):
+        '''Returns img as float with the bias and, when exptime is given and
+        darks are available, the dark current removed'''
+
+        data = img.astype('float') - self.bias()
+        if exptime is not None:
+            dark = self.dark(exptime, ccdtemp)
+            if dark is not None:
+                data -= dark
+
+        return data
+
+framestore = None
+framestorelock = threading.Lock()
+
+def get_framestore():
+    '''Returns the FrameStore shared by everything in this process'''
+
+    global framestore
+    with framestorelock:
+        if framestore is None:
+            framestore = FrameStore()
+
+    return framestore
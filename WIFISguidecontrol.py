@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFISguidecontrol.py
+# Purpose:          Guide controllers turning guide star offsets into TCS moves
+#------------------------------------------------------------------------------
+
+"""
+Controllers for the guide loop. Every guide frame the offset of the guide star
+from its reference position (arcsec, RA and DEC) goes in and the correction to
+send to the TCS comes out. Three controllers are available:
+
+    proportional    correction = -Kp * offset, as the original guide loop
+    pi              adds -Ki times the sum of the past offsets, removing a
+                    steady drift the proportional term always lags behind
+    kalman          tracks the position and the drift rate of the star with a
+                    constant drift model, so seeing noise is averaged out and
+                    the drift during the next cycle is corrected in advance
+
+No correction is sent on an axis whose estimated offset is inside the
+deadband. The gains and the deadband are scheduled per axis by telescope
+elevation and rotator (IIS) angle from data/guidegains.txt, which also selects
+the controller. Each update stores the full controller state in
+controller.state for logging.
+"""
+
+import numpy as np
+import os, time
+
+homedir = os.path.dirname(os.path.realpath(__file__))
+
+gainfile = homedir + '/data/guidegains.txt'
+
+schedulecolumns = ['elmin', 'elmax', 'iismin', 'iismax', 'kp_ra', 'kp_dec', 'ki_ra', 'ki_dec',\
+        'deadband']
+
+statecolumns = ['time', 'offset_ra', 'offset_dec', 'estimate_ra', 'estimate_dec', 'memory_ra',\
+        'memory_dec', 'correction_ra', 'correction_dec', 'kp_ra', 'kp_dec', 'ki_ra', 'ki_dec',\
+        'deadband']
+
+defaultgains = {'kp': np.array([0.9, 0.9]), 'ki': np.array([0., 0.]), 'deadband': 0.6}
+
+class GainSchedule(object):
+    '''Gains by elevation and rotator angle. Rows are (elmin, elmax, iismin,
+    iismax, kp_ra, kp_dec, ki_ra, ki_dec, deadband) and the first row
+    containing the current elevation and IIS is used'''
+
+    def __init__(self, rows = [], settings = {}):
+
+        self.rows = [np.array(r, dtype=float) for r in rows]
+        self.settings = settings
+
+    def gains(self, elevation = None, iis = None):
+        '''Returns the dict of kp, ki (RA, DEC arrays) and deadband. A missing
+        elevation or IIS matches every row'''
+
+        for r in self.rows:
+            if (elevation is not None) and not (r[0] <= elevation <= r[1]):
+                continue
+            if (iis is not None) and not (r[2] <= iis <= r[3]):
+                continue
+            return {'kp': r[4:6], 'ki': r[6:8], 'deadband': r[8]}
+
+        return defaultgains
+
+def read_gain_schedule(fl = gainfile):
+    '''Reads the gain schedule. Lines of two words are settings (controller,
+    and the parameters of the controllers), lines of nine numbers are rows of
+    the schedule'''
+
+    rows, settings = [], {}
+    if not os.path.exists(fl):
+        print "### No guide gain schedule %s, using default gains" % (fl)
+        return GainSchedule(rows, settings)
+
+    f = open(fl, 'r')
+    for line in f:
+        spl = line.split('#')[0].split()
+        if len(spl) == 2:
+            settings[spl[0]] = spl[1]
+        elif len(spl) == len(schedulecolumns):
+            rows.append([float(v) for v in spl])
+        elif len(spl) > 0:
+            print "### Could not read guide gain line: %s" % (line.strip())
+    f.close()
+
+    return GainSchedule(rows, settings)
+
+class GuideController(object):
+    '''Base guide controller. update() takes the time (s) and the measured
+    offset (RA, DEC arcsec) of one guide frame and returns the correction'''
+
+    name = 'proportional'
+
+    def __init__(self, schedule = None):
+
+        if schedule is None:
+            schedule = GainSchedule()
+        self.schedule = schedule
+        self.state = None
+        self.reset()
+
+    def reset(self):
+        self.lasttime = None
+        self.memory = np.zeros(2)
+
+    def estimate(self, t, offset, gains):
+        '''Returns the estimated offset the correction acts on and the
+        correction before the deadband'''
+
+        return offset, -gains['kp'] * offset
+
+    def update(self, t, offset, elevation = None, iis = None):
+
+        offset = np.asarray(offset, dtype=float)
+        gains = self.schedule.gains(elevation, iis)
+
+        estimate, correction = self.estimate(t, offset, gains)
+        correction = np.where(np.abs(estimate) < gains['deadband'], 0., correction)
+        self.applied(correction)
+        self.lasttime = t
+
+        self.state = dict(zip(statecolumns, [t, offset[0], offset[1], estimate[0], estimate[1],\
+                self.memory[0], self.memory[1], correction[0], correction[1], gains['kp'][0],\
+                gains['kp'][1], gains['ki'][0], gains['ki'][1], gains['deadband']]))
+
+        return correction
+
+    def applied(self, correction):
+        '''Called with the correction that is sent'''
+
+        pass
+
+class PIController(GuideController):
+    '''Proportional plus integral control. The integral is the sum of the
+    offsets of past frames (arcsec), limited to +-maxintegral'''
+
+    name = 'pi'
+
+    def __init__(self, schedule = None, maxintegral = 5.):
+
+        self.maxintegral = maxintegral
+        GuideController.__init__(self, schedule)
+
+    def estimate(self, t, offset, gains):
+
+        self.memory = np.clip(self.memory + offset, -self.maxintegral, self.maxintegral)
+        correction = -(gains['kp'] * offset + gains['ki'] * self.memory)
+
+        kp = np.where(gains['kp'] > 0, gains['kp'], 1.)
+        return -correction / kp, correction
+
+class KalmanController(GuideController):
+    '''Kalman filter of the position and drift rate of the star on each axis.
+    measurenoise is the centroid scatter from seeing (arcsec), drift the
+    random walk of the drift rate (arcsec/s/sqrt(s)). The correction is for
+    the position predicted lead seconds ahead (default one frame interval)'''
+
+    name = 'kalman'
+
+    def __init__(self, schedule = None, measurenoise = 0.3, drift = 0.002, lead = None):
+
+        self.measurenoise = measurenoise
+        self.drift = drift
+        self.lead = lead
+        GuideController.__init__(self, schedule)
+
+    def reset(self):
+        GuideController.reset(self)
+        self.x = np.zeros((2, 2))                      #[axis, (position, rate)]
+        self.P = np.array([np.diag([10., 0.1])] * 2)   #[axis, 2x2]
+        self.lastcorrection = np.zeros(2)
+        self.lastdt = 0.
+
+    def estimate(self, t, offset, gains):
+
+        if self.lasttime is None:
+            self.x[:, 0] = offset
+            self.x[:, 1] = 0.
+        else:
+            dt = max(t - self.lasttime, 1e-3)
+            self.lastdt = dt
+            F = np.array([[1., dt], [0., 1.]])
+            Q = self.drift**2 * np.array([[dt**3 / 3., dt**2 / 2.], [dt**2 / 2., dt]])
+            R = self.measurenoise**2
+
+            for axis in range(2):
+                #Predict, including the last correction sent to the telescope
+                x = np.dot(F, self.x[axis])
+                x[0] += self.lastcorrection[axis]
+                P = np.dot(F, np.dot(self.P[axis], F.T)) + Q
+
+                #Update with the measured offset
+                S = P[0, 0] + R
+                K = P[:, 0] / S
+                x = x + K * (offset[axis] - x[0])
+                P = P - np.outer(K, P[0, :])
+
+                self.x[axis] = x
+                self.P[axis] = P
+
+        self.memory = self.x[:, 1].copy()
+        lead = self.lead if self.lead is not None else self.lastdt
+        predicted = self.x[:, 0] + self.x[:, 1] * lead
+
+        return predicted, -gains['kp'] * predicted
+
+    def applied(self, correction):
+        self.lastcorrection = np.array(correction, dtype=float)
+
+controllers = {'proportional': GuideController, 'pi': PIController, 'kalman': KalmanController}
+
+def make_controller(fl = gainfile):
+    '''Returns the controller selected in the gain schedule file with its
+    schedule and parameters'''
+
+    schedule = read_gain_schedule(fl)
+    settings = dict(schedule.settings)
+    kind = settings.pop('controller', 'proportional')
+    if kind not in controllers:
+        print "### Unknown guide controller %s, using proportional" % (kind)
+        kind = 'proportional'
+
+    params = {}
+    for key, val in settings.items():
+        try:
+            params[key] = float(val)
+        except ValueError:
+            print "### Could not read guide controller setting %s %s" % (key, val)
+
+    try:
+        return controllers[kind](schedule, **params)
+    except TypeError as e:
+        print "### Bad %s controller settings %s: %s" % (kind, params, e)
+        return controllers[kind](schedule)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFISguideexposure.py
+# Purpose:          Exposure time search for guide star acquisition
+#------------------------------------------------------------------------------
+
+"""
+Finds the guide exposure time from the stars measured in the last acquisition
+image instead of stepping it by fixed amounts. The counts of a star scale
+linearly with the exposure time above the bias and sky level, so the exposure
+time is predicted directly from the background subtracted peak and flux of the
+stars in the centre of the field (ExposureSearch.predict), which usually takes
+one or two exposures: a faint star is taken to minflux, a saturated one to
+targetpeak (half of saturation by default).
+
+minflux is a cut on the flux of label_centroids (Iarr), the sum of the raw
+pixels above the detection threshold. Most of that sum is the bias and sky
+level of the pixels, so for a faint star it mostly counts the pixels above
+the threshold. island_flux models how it grows with the exposure time.
+
+When no prediction is possible (no star found in the centre) or a predicted
+exposure fails anyway, the exposure times known to
+be too short and too long bracket the search and the next one is their
+geometric mean, or a factor step beyond the one bound known so far.
+
+    search = WGE.ExposureSearch(exptime)
+    while not found:
+        exptime = search.next(exptime, result, img, fieldinfo)
+
+result is the guide star found with the last exposure (None when too faint,
+False when saturated, 'NoStar' when off centre) and fieldinfo the centroid
+finder output [centroidx, centroidy, Iarr, Isat, width] of the image.
+"""
+
+import numpy as np
+import WIFISframestore as WF
+
+#Limits used by RunGuiding.findguidestar and WIFISastrometry.label_centroids
+minflux = 9000.
+satlevel = 63000.
+central = (50, 950)
+minpix = 3
+
+def bias_level():
+    '''Median level of the guider bias (ADU), or None if there is no bias'''
+
+    try:
+        return float(np.median(WF.get_framestore().bias()))
+    except (IOError, OSError, ValueError) as e:
+        print "### No guider bias for the exposure search: %s" % (e)
+        return None
+
+def star_photometry(img, rows, cols, background, halfbox = 4):
+    '''Peak and total counts above background in a box of 2*halfbox+1 pixels
+    around each star'''
+
+    peaks, fluxes = np.zeros(len(rows)), np.zeros(len(rows))
+    for i in range(len(rows)):
+        r, c = int(round(rows[i])), int(round(cols[i]))
+        box = img[max(r - halfbox, 0):r + halfbox + 1, max(c - halfbox, 0):c + halfbox + 1]
+        if box.size > 0:
+            peaks[i] = box.max() - background
+            fluxes[i] = np.sum(box - background)
+
+    return peaks, fluxes
+
+class ExposureSearch(object):
+    '''Exposure time search (ms) between minexp and maxexp. next() returns the
+    next exposure time to try or None when the search has failed'''
+
+    def __init__(self, exptime, minexp = 10, maxexp = 9000, targetpeak = 0.5, margin = 0.2,\
+            step = 3., detection = 3., bias = None, maxtries = 8):
+
+        self.minexp = minexp
+        self.maxexp = maxexp
+        self.targetpeak = targetpeak * satlevel
+        self.margin = margin
+        self.step = step
+        self.detection = detection      #Detection threshold of centroid_finder in sigma
+        self.bias = bias                #Bias level, the rest of the background is sky
+        self.maxtries = maxtries
+
+        self.lo = None          #Longest exposure time found too faint
+        self.hi = None          #Shortest exposure time found saturated
+        self.tried = [exptime]
+        self.reason = ''
+
+    def update(self, exptime, result, brightcentre = False):
+        '''Narrows the bracket with the result of an exposure. brightcentre
+        is True when only saturated stars are usable in the centre'''
+
+        if (result is False) or brightcentre:
+            if (self.hi is None) or (exptime < self.hi):
+                self.hi = exptime
+            self.reason = "GUIDE STARS SATURATED"
+        else:
+            if (self.lo is None) or (exptime > self.lo):
+                self.lo = exptime
+            self.reason = "GUIDE STARS TOO FAINT"
+
+    def star_area(self, peaks, fluxes, sat, noise):
+        '''Effective area (flux / peak) of the well exposed unsaturated stars,
+        or of a 3 pixel FWHM star'''
+
+        good = (sat != 1) & (peaks > 10. * max(noise, 1.))
+        if np.any(good):
+            return np.median(fluxes[good] / peaks[good])
+
+        return 2 * np.pi * (3. / 2.355)**2
+
+    def island_flux(self, scale, iarr, peak, flux, area, background, noise):
+        '''Predicted Iarr of a star (now iarr, with background subtracted peak
+        and flux) with the exposure time scaled by scale.
+
+        For a star of effective area A the pixels above the threshold t (the
+        detection level above the background) grow by A ln(scale), and the
+        star counts inside them are scale * flux - t * A. The background level
+        of the pixels is the bias plus the sky, which scales'''
+
+        threshold = self.detection * noise
+        sky = background - self.bias if self.bias is not None else 0.
+        inside = max(flux - threshold * area, 0.)
+        npix = max((iarr - inside) / max(background, 1.), minpix)
+
+        level = background + (scale - 1) * sky
+        npix += area * np.log(scale)
+        inside = max(scale * flux - threshold * area, 0.)
+
+        return level * npix + inside
+
+    def faint_scale(self, iarr, peak, flux, area, background, noise, maxscale):
+        '''Exposure time scale taking Iarr to minflux (plus margin), found by
+        bisection in log(scale). None if the star is already there'''
+
+        target = minflux * (1 + self.margin)
+        if self.island_flux(1., iarr, peak, flux, area, background, noise) >= target:
+            return None
+        if self.island_flux(maxscale, iarr, peak, flux, area, background, noise) < target:
+            return maxscale
+
+        lo, hi = 0., np.log(maxscale)
+        for i in range(40):
+            mid = (lo + hi) / 2.
+            if self.island_flux(np.exp(mid), iarr, peak, flux, area, background, noise) < target:
+                lo = mid
+            else:
+                hi = mid
+
+        return np.exp(hi)
+
+    def predict(self, exptime, img, fieldinfo):
+        '''Predicted exposure time (ms), or None, and whether the central stars
+        that can be used are all saturated.
+
+        With an unsaturated star in the centre (peak above the detection
+        threshold) the exposure time is the one taking the brightest to
+        minflux (island_flux), as long as its peak stays below saturation.
+        With only saturated stars the true peak of the brightest is its flux
+        over the effective area of the stars (star_area), and the exposure
+        time is the one taking that peak to targetpeak'''
+
+        if (fieldinfo is None) or (fieldinfo[0] is False) or (len(fieldinfo[0]) == 0):
+            return None, False
+
+        rows, cols = np.asarray(fieldinfo[0], dtype=float), np.asarray(fieldinfo[1], dtype=float)
+        Iarr, sat = np.asarray(fieldinfo[2], dtype=float), np.asarray(fieldinfo[3])
+        centre = (rows > central[0]) & (rows < central[1]) & (cols > central[0]) & (cols < central[1])
+        if not np.any(centre):
+            return None, False
+
+        #Noise estimated like centroid_finder does for its threshold
+        sample = img[::4, ::4]
+        background = np.median(sample)
+        noise = np.std(sample[sample < background + 50])
+        peaks, fluxes = star_photometry(img, rows, cols, background)
+        area = self.star_area(peaks, fluxes, sat, noise)
+
+        usable = centre & (sat != 1) & (peaks > max(self.detection * noise, 0))
+        if np.any(usable):
+            star = np.where(usable)[0][np.argmax(Iarr[usable])]
+            scale = self.faint_scale(Iarr[star], peaks[star], max(fluxes[star], 0.), area,\
+                    background, noise, self.maxexp / float(exptime))
+            if scale is None:
+                return None, False
+            satscale = (satlevel * (1 - self.margin) - background) / peaks[star]
+            return exptime * min(scale, satscale), False
+
+        saturated = centre & (sat == 1)
+        if not np.any(saturated):
+            return None, False
+
+        star = np.where(saturated)[0][np.argmax(fluxes[saturated])]
+        truepeak = max(fluxes[star] / area, satlevel - background)
+
+        return exptime * (self.targetpeak - background) / truepeak, True
+
+    def next(self, exptime, result, img, fieldinfo):
+
+        if len(self.tried) > self.maxtries:
+            return None
+
+        prediction, brightcentre = self.predict(exptime, img, fieldinfo)
+        self.update(exptime, result, brightcentre)
+
+        lo = self.lo if self.lo is not None else self.minexp
+        hi = self.hi if self.hi is not None else self.maxexp
+        if lo >= hi:
+            return None
+
+        if (prediction is not None) and ((self.lo is None) or (prediction > self.lo)) and \
+                ((self.hi is None) or (prediction < self.hi)):
+            newexp = prediction
+        elif self.hi is None:
+            newexp = lo * self.step
+        elif self.lo is None:
+            newexp = hi / self.step
+        else:
+            newexp = np.sqrt(lo * hi)
+
+        newexp = int(round(min(max(newexp, self.minexp), self.maxexp)))
+        if (newexp in self.tried) or (newexp <= lo and self.lo is not None) or \
+                (newexp >= hi and self.hi is not None):
+            return None
+
+        self.tried.append(newexp)
+        return newexp
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFISguidefocus.py
+# Purpose:          V-curve autofocus of the guide camera and its focus model
+#------------------------------------------------------------------------------
+
+"""
+Autofocus of the guide camera from a V-curve. The star width is measured at a
+few focuser positions spread around the expected focus, all approached from
+the same side to take out the backlash, and
+
+    width**2 = a + b * (position - best)**2
+
+(the hyperbola of a defocused star, a parabola in width squared) is fit to
+them. The focuser then goes straight to the best position, so focusing takes
+a fixed number of exposures instead of a hill climb. If the minimum is outside
+the sampled positions a few more are added on that side.
+
+The best positions found are kept in data/focusmodel.txt by filter and
+temperature. The next focus run starts at the position predicted for the
+filter and temperature, with a narrower range of positions.
+"""
+
+import numpy as np
+import os, time
+
+homedir = os.path.dirname(os.path.realpath(__file__))
+
+focusmodelfile = homedir + '/data/focusmodel.txt'
+
+def fit_vcurve(positions, widths, nsigma = 3.):
+    '''Fits the V-curve and returns (best position, width at best), or
+    (None, None) if the widths do not have a minimum. With five or more
+    points the worst point is rejected if it is off by more than nsigma'''
+
+    x = np.asarray(positions, dtype=float)
+    w = np.abs(np.asarray(widths, dtype=float))
+    good = np.isfinite(x) & np.isfinite(w) & (w > 0)
+    if np.sum(good) < 3:
+        return None, None
+    x, w2 = x[good], w[good]**2
+
+    xm = np.mean(x)
+    coeffs = np.polyfit(x - xm, w2, 2)
+    if len(x) >= 5:
+        resid = w2 - np.polyval(coeffs, x - xm)
+        worst = np.argmax(np.abs(resid))
+        if np.abs(resid[worst]) > nsigma * np.std(np.delete(resid, worst)):
+            keep = np.arange(len(x)) != worst
+            coeffs = np.polyfit(x[keep] - xm, w2[keep], 2)
+
+    if coeffs[0] <= 0:
+        return None, None
+
+    best = xm - coeffs[1] / (2 * coeffs[0])
+    minw2 = coeffs[2] - coeffs[1]**2 / (4 * coeffs[0])
+
+    return best, np.sqrt(max(minw2, 0.))
+
+def focus_temperature(cam, foc):
+    '''Temperature for the focus model: the focuser's external or internal
+    sensor when it has one, otherwise the camera temperature. NaN if none
+    can be read'''
+
+    for dev, method in [(foc, 'read_external_temperature'), (foc, 'read_internal_temperature'),\
+            (cam, 'get_temperature')]:
+        read = getattr(dev, method, None)
+        if read is None:
+            continue
+        try:
+            return float(read())
+        except Exception:
+            continue
+
+    return np.nan
+
+class FocusModel(object):
+    '''Best focuser positions by filter and temperature. The model file has
+    one focus run per line: time, filter, temperature, position'''
+
+    def __init__(self, fl = focusmodelfile, nrecent = 20):
+
+        self.fl = fl
+        self.nrecent = nrecent
+        self.entries = []
+
+        if not os.path.exists(fl):
+            return
+        f = open(fl, 'r')
+        for line in f:
+            spl = line.split('#')[0].split()
+            if len(spl) != 4:
+                continue
+            try:
+                self.entries.append((float(spl[0]), spl[1], float(spl[2]), float(spl[3])))
+            except ValueError:
+                print "### Could not read focus model line: %s" % (line.strip())
+        f.close()
+
+    def predict(self, filtername, temperature, mintrange = 2.):
+        '''Predicted best position for filtername at temperature, or None.
+        The recent runs with the filter are fit linearly against temperature
+        when they span at least mintrange degrees, otherwise their median is
+        used'''
+
+        entries = [e for e in self.entries if e[1] == str(filtername)][-self.nrecent:]
+        if not entries:
+            return None
+
+        temps = np.array([e[2] for e in entries])
+        positions = np.array([e[3] for e in entries])
+        withtemp = np.isfinite(temps)
+        if np.isfinite(temperature) and (np.sum(withtemp) >= 3) and \
+                (np.ptp(temps[withtemp]) >= mintrange):
+            slope, offset = np.polyfit(temps[withtemp], positions[withtemp], 1)
+            return slope * temperature + offset
+
+        return np.median(positions[-5:])
+
+    def add(self, filtername, temperature, position):
+        '''Records a focus run'''
+
+        entry = (time.time(), str(filtername), float(temperature), float(position))
+        self.entries.append(entry)
+        try:
+            new = not os.path.exists(self.fl)
+            f = open(self.fl, 'a')
+            if new:
+                f.write("#Time\tFilter\tTemperature\tPosition\n")
+            f.write("%.0f\t%s\t%.2f\t%.0f\n" % entry)
+            f.close()
+        except IOError as e:
+            print "### Could not write focus model %s: %s" % (self.fl, e)
+
+class VCurveFocuser(object):
+    '''Runs the V-curve. measure() exposes at the current focuser position and
+    returns the star width; report is called with status strings and stop()
+    returning True aborts the run. Every position is approached moving
+    forward, from at least backlash steps below'''
+
+    def __init__(self, foc, measure, report = None, stop = None, backlash = 50, minposition = 0):
+
+        self.foc = foc
+        self.measure = measure
+        self.report = report if report is not None else (lambda text: None)
+        self.stop = stop if stop is not None else (lambda: False)
+        self.backlash = backlash
+        self.minposition = minposition
+
+        self.positions = []
+        self.widths = []
+
+    def move_to(self, position):
+
+        position = int(round(max(position, self.minposition)))
+        current = self.foc.get_stepper_position()
+        if position < current:
+            below = max(position - self.backlash, self.minposition)
+            self.foc.step_motor(below - current)
+            current = below
+        if position != current:
+            self.foc.step_motor(position - current)
+
+        return position
+
+    def sample(self, positions):
+
+        for position in sorted(positions):
+            if self.stop():
+                return False
+            position = self.move_to(position)
+            width = self.measure()
+            self.positions.append(position)
+            self.widths.append(width)
+            self.report("FOCUS %i: WIDTH %.2f" % (position, width))
+
+        return True
+
+    def focus(self, start, halfwidth = 300, npoints = 7, nextend = 3, maxextend = 2):
+        '''Samples npoints positions from start - halfwidth to start +
+        halfwidth, adds nextend more beyond the end nearest the minimum (at
+        most maxextend times) while the fit minimum is outside them, and moves
+        to the best position. Returns (best, width at best), or (None, None)
+        if the run was stopped or the fit failed (the focuser goes back to
+        start)'''
+
+        spacing = 2. * halfwidth / (npoints - 1)
+        if not self.sample(start - halfwidth + spacing * np.arange(npoints)):
+            return None, None
+
+        best, minwidth = fit_vcurve(self.positions, self.widths)
+        for i in range(maxextend):
+            lo, hi = min(self.positions), max(self.positions)
+            if (best is not None) and (lo <= best <= hi):
+                break
+
+            #Extend towards the narrower end of the curve
+            if (best is not None and best < lo) or (best is None and \
+                    self.widths[np.argmin(self.positions)] < self.widths[np.argmax(self.positions)]):
+                if lo - spacing < self.minposition:
+                    break
+                newpos = lo - spacing * np.arange(1, nextend + 1)
+            else:
+                newpos = hi + spacing * np.arange(1, nextend + 1)
+            newpos = newpos[newpos >= self.minposition]
+            self.report("FOCUS MINIMUM OUTSIDE RANGE, ADDING %i POSITIONS" % (len(newpos)))
+            if not self.sample(newpos):
+                return None, None
+            best, minwidth = fit_vcurve(self.positions, self.widths)
+
+        if (best is None) or not (min(self.positions) <= best <= max(self.positions)):
+            self.move_to(start)
+            return None, None
+
+        self.move_to(best)
+        return best, minwidth
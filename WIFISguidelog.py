@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFISguidelog.py
+# Purpose:          Binary guide telemetry log and its reader
+#------------------------------------------------------------------------------
+
+"""
+Guide telemetry is kept as fixed size numpy records (guidedtype), one per guide
+frame. The guide thread fills a preallocated ring of records in memory and the
+ring is appended to the night's log file in batches, so the guide loop does not
+open a file every frame. A night of guiding is read back with one np.fromfile.
+
+Files are log/guidinglog/<night>.glog, with night the date at the start of the
+night. A file starts with the 8 byte magic 'WIFISGLG', a 4 byte little endian
+header length and a JSON header holding the record dtype, followed by the raw
+records.
+
+    python WIFISguidelog.py [night or file] [--plot]
+
+prints a summary of a night of guiding (tonight by default) and optionally
+plots it.
+"""
+
+import numpy as np
+import os, sys, time, json, struct
+import argparse
+from glob import glob
+
+homedir = os.path.dirname(os.path.realpath(__file__))
+
+logdir = homedir + '/log/guidinglog/'
+magic = 'WIFISGLG'
+version = 2
+
+guidedtype = np.dtype([('time', '<f8'), ('frame', '<i4'), ('exptime', '<f4'),\
+        ('target', 'S24'), ('controller', 'S12'),\
+        ('x', '<f4'), ('y', '<f4'), ('dx', '<f4'), ('dy', '<f4'),\
+        ('offset_ra', '<f4'), ('offset_dec', '<f4'),\
+        ('flux', '<f4'), ('fwhm', '<f4'), ('snr', '<f4'), ('peak', '<f4'),\
+        ('nstars', 'u1'), ('rotation', '<f4'),\
+        ('estimate_ra', '<f4'), ('estimate_dec', '<f4'), ('memory_ra', '<f4'), ('memory_dec', '<f4'),\
+        ('correction_ra', '<f4'), ('correction_dec', '<f4'), ('moved', 'u1'),\
+        ('latency', '<f4')])
+
+def night_name(t = None):
+    '''Date of the start of the night of time t as YYYYMMDD'''
+
+    if t is None:
+        t = time.time()
+    return time.strftime('%Y%m%d', time.localtime(t - 12 * 3600))
+
+def night_file(night = None):
+    if night is None:
+        night = night_name()
+    return os.path.join(logdir, night + '.glog')
+
+def write_header(f, dtype = guidedtype):
+
+    header = json.dumps({'version': version, 'dtype': dtype.descr,\
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S')})
+    f.write(magic + struct.pack('<I', len(header)) + header)
+
+def read_header(f):
+    '''Reads the header of an open log file and returns the header dict and
+    the record dtype'''
+
+    if f.read(len(magic)) != magic:
+        raise IOError("%s is not a guide log" % (f.name))
+    n = struct.unpack('<I', f.read(4))[0]
+    header = json.loads(f.read(n))
+    dtype = np.dtype([tuple([str(field[0])] + [str(v) for v in field[1:]]) for field in header['dtype']])
+
+    return header, dtype
+
+class GuideRecorder(object):
+    '''Ring of capacity guide records flushed to the log file every flushevery
+    records or flushinterval seconds and when the ring is full'''
+
+    def __init__(self, path = None, capacity = 512, flushevery = 32, flushinterval = 30.):
+
+        self.path = path
+        self.capacity = capacity
+        self.flushevery = flushevery
+        self.flushinterval = flushinterval
+
+        self.ring = np.zeros(capacity, dtype=guidedtype)
+        self.count = 0
+        self.flushed = 0
+        self.ndropped = 0
+        self.lastflush = time.time()
+
+    def record(self, **fields):
+        '''Adds a record. Fields not given are NaN (or 0 for integers and
+        strings)'''
+
+        if self.count - self.flushed >= self.capacity:
+            self.flush()
+
+            #If the log cannot be written the oldest record is overwritten,
+            #so it counts as flushed to keep the ring in order
+            if self.count - self.flushed >= self.capacity:
+                self.flushed += 1
+                self.ndropped += 1
+                print "### Guide log ring full, dropped %i records" % (self.ndropped)
+
+        rec = self.ring[self.count % self.capacity]
+        for name in guidedtype.names:
+            if name in fields:
+                rec[name] = fields[name]
+            elif guidedtype[name].kind == 'f':
+                rec[name] = np.nan
+            else:
+                rec[name] = 0
+        self.count += 1
+
+        if (self.count - self.flushed >= self.flushevery) or \
+                (time.time() - self.lastflush > self.flushinterval):
+            self.flush()
+
+    def unflushed(self):
+        '''The records not yet written, in order'''
+
+        start = self.flushed % self.capacity
+        n = self.count - self.flushed
+        if start + n <= self.capacity:
+            return [self.ring[start:start+n]]
+        return [self.ring[start:], self.ring[:start + n - self.capacity]]
+
+    def flush(self):
+        '''Appends the new records to the log file'''
+
+        self.lastflush = time.time()
+        if self.count == self.flushed:
+            return
+
+        path = self.path if self.path is not None else night_file()
+        try:
+            if os.path.exists(path):
+                f = open(path, 'r+b')
+                try:
+                    header, dtype = read_header(f)
+                except (IOError, struct.error, ValueError, KeyError, TypeError) as e:
+                    #Keep the bad file for inspection and start a new log
+                    f.close()
+                    print "### Guide log %s has a bad header (%s), moving it to %s.corrupt" % (path, e, path)
+                    os.rename(path, path + '.corrupt')
+                    f = self.open_new(path)
+                    dtype = guidedtype
+                if dtype != guidedtype:
+                    f.close()
+                    path = os.path.splitext(path)[0] + '_v%i.glog' % (version)
+                    f = self.open_new(path) if not os.path.exists(path) else open(path, 'ab')
+                else:
+                    f.seek(0, 2)
+            else:
+                f = self.open_new(path)
+
+            for records in self.unflushed():
+                records.tofile(f)
+            f.close()
+        except (IOError, OSError, struct.error, ValueError) as e:
+            #Never stop guiding for the log, the records are kept for the next try
+            print "### Could not write guide log %s: %s" % (path, e)
+            return
+
+        self.flushed = self.count
+
+    def open_new(self, path):
+        f = open(path, 'wb')
+        write_header(f)
+        return f
+
+    def recent(self, n = None):
+        '''The last n records (at most capacity) in order'''
+
+        if n is None:
+            n = self.capacity
+        n = min(n, self.count, self.capacity)
+        idx = np.arange(self.count - n, self.count) % self.capacity
+
+        return self.ring[idx]
+
+def read_guidelog(fl):
+    '''Returns the records of a guide log file as a numpy record array'''
+
+    f = open(fl, 'rb')
+    header, dtype = read_header(f)
+
+    #Ignore a record cut short by a crash
+    nrec = (os.path.getsize(fl) - f.tell()) // dtype.itemsize
+    records = np.fromfile(f, dtype=dtype, count=nrec)
+    f.close()
+
+    return records.view(np.recarray)
+
+def convert_records(records, dtype = guidedtype):
+    '''Copies records of an older log version into dtype, leaving the new
+    fields NaN or 0'''
+
+    out = np.zeros(len(records), dtype=dtype)
+    for name in dtype.names:
+        if name in records.dtype.names:
+            out[name] = records[name]
+        elif dtype[name].kind == 'f':
+            out[name] = np.nan
+
+    return out
+
+def read_night(night = None):
+    '''Returns all guide records of a night (YYYYMMDD, default tonight),
+    including those in files of older log versions'''
+
+    fl = night_file(night)
+    files = [f for f in [fl] + sorted(glob(os.path.splitext(fl)[0] + '_v*.glog')) if os.path.exists(f)]
+    if not files:
+        return np.zeros(0, dtype=guidedtype).view(np.recarray)
+
+    records = [convert_records(read_guidelog(f)) for f in files]
+    records = np.concatenate(records)
+
+    return records[np.argsort(records['time'], kind='mergesort')].view(np.recarray)
+
+def summarize(records):
+    '''Prints the number of frames, moves and offset scatter per target'''
+
+    print "%i guide frames from %s to %s" % (len(records), \
+            time.strftime('%H:%M:%S', time.localtime(records['time'][0])),\
+            time.strftime('%H:%M:%S', time.localtime(records['time'][-1])))
+    for target in np.unique(records['target']):
+        r = records[records['target'] == target]
+        found = np.isfinite(r['offset_ra'])
+        print "%s: %i frames, %i lost, %i moves, RMS offset RA %.2f\" DEC %.2f\", "\
+                "median FWHM %.2f pix, median TCS latency %.2f s" % (target, len(r),\
+                np.sum(~found), np.sum(r['moved']), np.sqrt(np.mean(r['offset_ra'][found]**2)),\
+                np.sqrt(np.mean(r['offset_dec'][found]**2)), np.median(r['fwhm'][found]),\
+                np.nanmedian(r['latency']) if np.any(np.isfinite(r['latency'])) else np.nan)
+
+def plot_guiding(records):
+
+    import matplotlib.pyplot as mpl
+
+    t = (records['time'] - records['time'][0]) / 60.
+    fig, axes = mpl.subplots(3, 1, sharex=True, figsize=(10, 8))
+    axes[0].plot(t, records['offset_ra'], '.', label='RA offset')
+    axes[0].plot(t, records['offset_dec'], '.', label='DEC offset')
+    axes[0].set_ylabel('Offset (")')
+    axes[0].legend()
+    axes[1].plot(t, records['correction_ra'], '.', label='RA correction')
+    axes[1].plot(t, records['correction_dec'], '.', label='DEC correction')
+    axes[1].set_ylabel('Correction (")')
+    axes[1].legend()
+    axes[2].plot(t, records['fwhm'], '.')
+    axes[2].set_ylabel('FWHM (pix)')
+    axes[2].set_xlabel('Time (min)')
+    mpl.show()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Summarize a night of guiding')
+    parser.add_argument('log', nargs='?', default=None, help='night (YYYYMMDD) or guide log file')
+    parser.add_argument('--plot', action='store_true', help='plot the guiding')
+    args = parser.parse_args()
+
+    if (args.log is not None) and os.path.exists(args.log):
+        records = read_guidelog(args.log)
+    else:
+        records = read_night(args.log)
+
+    if len(records) == 0:
+        print "No guide records"
+        sys.exit()
+
+    summarize(records)
+    if args.plot:
+        plot_guiding(records)
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFISguidepipeline.py
+# Purpose:          Pipelined guide loop: exposing, measuring and moving at once
+#------------------------------------------------------------------------------
+
+"""
+Runs the three stages of a guide cycle in parallel instead of one after the
+other:
+
+    camera thread       exposes continuously into a small ring of
+                        preallocated frame buffers
+    processing          the guide thread (RunGuiding) takes the newest frame
+                        from the ring and measures the star
+    actuator thread     sends the corrections to the TCS
+
+so a new exposure is already running while the last one is measured and the
+telescope is moved, and the guide cadence is set by the exposure time.
+
+Frames are dropped rather than queued: when the processing falls behind, the
+older frames waiting in the ring are discarded, and frames exposed while a
+correction was pending or being sent (so before the telescope settled) are
+never measured. Only the latest correction is kept if the TCS is slower than
+the measurements.
+"""
+
+import numpy as np
+import threading, time
+
+class FrameRing(object):
+    '''Preallocated frame buffers shared by the camera and the processing
+    thread. put() copies a frame into a free buffer, overwriting the oldest
+    unprocessed frame if there is none. get() returns the newest frame and
+    discards the others; the buffer belongs to the caller until release()'''
+
+    def __init__(self, nbuf = 3, shape = (1024, 1024), dtype = np.uint16):
+
+        if nbuf < 2:
+            raise ValueError("The frame ring needs at least two buffers")
+
+        self.buffers = [np.zeros(shape, dtype=dtype) for i in range(nbuf)]
+        self.cond = threading.Condition()
+        self.free = range(nbuf)
+        self.ready = []
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, img, info):
+        '''Stores a copy of img with its info dict'''
+
+        with self.cond:
+            if self.free:
+                slot = self.free.pop(0)
+            else:
+                slot, old = self.ready.pop(0)
+                self.dropped += 1
+
+            buf = self.buffers[slot]
+            if (img.shape[0] > buf.shape[0]) or (img.shape[1] > buf.shape[1]) or \
+                    (img.dtype != buf.dtype):
+                buf = np.zeros((max(img.shape[0], buf.shape[0]), max(img.shape[1], buf.shape[1])),\
+                        dtype=img.dtype)
+                self.buffers[slot] = buf
+            view = buf[:img.shape[0], :img.shape[1]]
+            view[...] = img
+
+            self.ready.append((slot, info))
+            self.cond.notify_all()
+
+    def get(self, timeout = None):
+        '''Waits for a frame and returns (slot, frame, info) for the newest one,
+        or None on timeout or when the ring is closed'''
+
+        tend = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while (not self.ready) and (not self.closed):
+                if tend is None:
+                    self.cond.wait(1.)
+                    continue
+                remaining = tend - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+            if not self.ready:
+                return None
+
+            for slot, info in self.ready[:-1]:
+                self.free.append(slot)
+                self.dropped += 1
+            slot, info = self.ready[-1]
+            self.ready = []
+
+        shape = info['shape']
+        return slot, self.buffers[slot][:shape[0], :shape[1]], info
+
+    def release(self, slot):
+        '''Gives the buffer of a frame from get() back to the camera'''
+
+        with self.cond:
+            self.free.append(slot)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class GuidePipeline(object):
+    '''Camera and actuator threads around the guide thread.
+
+    take_photo() returns (img, origin) with origin the full frame position of
+    the first pixel (GuideWindow.take_photo). move(ra, dec) sends a correction
+    in arcsec to the telescope. settle is an extra wait (s) after each move
+    before exposures count as settled'''
+
+    def __init__(self, take_photo, move, nbuf = 3, shape = (1024, 1024), settle = 0.):
+
+        self.take_photo = take_photo
+        self.move = move
+        self.settle = settle
+
+        self.ring = FrameRing(nbuf, shape)
+        self.stopevent = threading.Event()
+        self.movecond = threading.Condition()
+        self.pendingmove = None
+        self.moving = False
+        self.movedone = 0.
+        self.latency = np.nan
+        self.error = None
+
+        self.nframes = 0
+        self.nstale = 0
+        self.nmoves = 0
+        self.nreplaced = 0
+
+        self.camthread = threading.Thread(target=self.camera_loop, name='guidecamera')
+        self.movethread = threading.Thread(target=self.actuator_loop, name='guideactuator')
+        self.camthread.daemon = True
+        self.movethread.daemon = True
+
+    def start(self):
+        self.camthread.start()
+        self.movethread.start()
+
+    def stop(self, timeout = 15.):
+        '''Stops both threads, waiting up to timeout for the exposure and the
+        move in progress to finish'''
+
+        self.stopevent.set()
+        self.ring.close()
+        with self.movecond:
+            self.movecond.notify_all()
+
+        self.camthread.join(timeout)
+        self.movethread.join(timeout)
+
+    def camera_loop(self):
+
+        while not self.stopevent.is_set():
+            tstart = time.time()
+            try:
+                img, origin = self.take_photo()
+            except Exception as e:
+                #Hand the error to the guide thread and keep trying
+                self.error = e
+                self.stopevent.wait(1.)
+                continue
+
+            self.nframes += 1
+            self.ring.put(img, {'origin': origin, 'shape': img.shape, 'tstart': tstart,\
+                    'tend': time.time(), 'number': self.nframes})
+
+    def actuator_loop(self):
+
+        while True:
+            with self.movecond:
+                while (self.pendingmove is None) and (not self.stopevent.is_set()):
+                    self.movecond.wait(1.)
+                if self.stopevent.is_set():
+                    return
+                ra, dec = self.pendingmove
+                self.pendingmove = None
+                self.moving = True
+
+            try:
+                tmove = time.time()
+                self.move(ra, dec)
+                self.latency = time.time() - tmove
+                self.nmoves += 1
+            except Exception as e:
+                self.error = e
+
+            if self.settle > 0:
+                self.stopevent.wait(self.settle)
+
+            with self.movecond:
+                self.moving = False
+                self.movedone = time.time()
+                self.movecond.notify_all()
+
+    def correct(self, ra, dec):
+        '''Queues a correction, replacing one that has not been sent yet'''
+
+        with self.movecond:
+            if self.pendingmove is not None:
+                self.nreplaced += 1
+            self.pendingmove = (ra, dec)
+            self.movecond.notify_all()
+
+    def settled(self, info):
+        '''True if the exposure of a frame started after the last move finished
+        and no move is waiting'''
+
+        with self.movecond:
+            return (self.pendingmove is None) and (not self.moving) and \
+                    (info['tstart'] >= self.movedone)
+
+    def next_frame(self, timeout = None):
+        '''Returns (slot, frame, info) for the newest settled frame, or None on
+        timeout or stop. Frames exposed during a move are skipped. Errors from
+        the camera and actuator threads are raised here'''
+
+        tend = None if timeout is None else time.time() + timeout
+        while not self.stopevent.is_set():
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+
+            remaining = None if tend is None else tend - time.time()
+            if (remaining is not None) and (remaining <= 0):
+                return None
+
+            frame = self.ring.get(remaining)
+            if frame is None:
+                continue
+            if self.settled(frame[2]):
+                return frame
+
+            self.nstale += 1
+            self.ring.release(frame[0])
+
+        return None
+
+    def release(self, slot):
+        self.ring.release(slot)
+
+    def stats(self):
+        return {'frames': self.nframes, 'dropped': self.ring.dropped, 'stale': self.nstale,\
+                'moves': self.nmoves, 'replaced': self.nreplaced}
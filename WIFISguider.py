@@ -15,6 +15,16 @@ import matplotlib.pyplot as mpl
 import Tkinter as _tk
 import WIFISastrometry as WA
 import WIFIStelescope as WG
+import WIFISguidepipeline as WGP
+import WIFISguidecentroid as WGC
+import WIFISguidecontrol as WGCTL
+import WIFISguidelog as WGL
+import WIFISguidestars as WGS
+import WIFIStiming as WT
+import WIFISguideexposure as WGE
+import WIFISguidefocus as WGF
+import WIFISsimulator as WSIM
+import WIFISarchiver as WAR
 
 from sys import exit
 import os, time, threading, Queue
@@ -47,8 +57,13 @@ class Formatter(object):
 ###########################################################
 def load_FLIDevices():
     '''Loads the FLI devices into variables and sets the 
-    default parameters'''
+    default parameters. Returns simulated devices when the simulator is
+    switched on in data/guidersim.txt'''
     
+    if WSIM.enabled():
+        print "### USING SIMULATED GUIDER DEVICES"
+        return WSIM.sim_devices()
+
     camSN = 'ML0240613'
     focSN = 'PDF0184509'
     fltSN = 'CFW-1-5-001'
@@ -73,58 +88,80 @@ def load_FLIDevices():
    
     return [cam, foc, flt]
 
-def measure_focus(img, sideregions = 3, fitwidth = 10, plot=False, verbose=False):
-
-    imgshape = img.shape
+def measure_focus(img, sideregions = 3, fitwidth = 10, plot=False, verbose=False, maps=False):
+    '''Measures the focus from one star detection over the whole image. The
+    stars are split into a sideregions x sideregions grid afterwards and each
+    region gets the median FWHM and half flux radius (HFR) of its stars.
 
-    regionx = imgshape[0]/sideregions
-    regiony = imgshape[1]/sideregions
-
-    starsx = np.array([])
-    starsy = np.array([])
-    brightestx = 0
-    brightesty = 0
-    bright = 0
-    for i in range(sideregions):
-        for j in range(sideregions):
-            imgregion = img[regionx*i:regionx*(i+1),regiony*j:regiony*(j+1)]
-            centroids = WA.centroid_finder(imgregion, plot=False)
-            imgregionshape = imgregion.shape
-            brightstar = WA.bright_star(centroids, imgregionshape)
-            if brightstar != None:
-                if centroids[3][brightstar] == 1:
-                    continue
-                if verbose:
-                    print "BRIGHTSTAR: %f %f %f" % (centroids[0][brightstar], \
-                        centroids[1][brightstar], centroids[2][brightstar])
-                cx = int(centroids[0][brightstar])
-                cy = int(centroids[1][brightstar])
-                if centroids[2] > bright:
-                    bright = centroids[2]
-                    brightestx = cx+regionx*i
-                    brightesty = cy+regiony*j
-                star_x = imgregion[cx-fitwidth:cx+fitwidth+1, cy]
-                star_y = imgregion[cx, cy-fitwidth:cy+fitwidth+1]
-                xs = np.arange(len(star_x)) 
-
-                if plot: 
-                    mpl.imshow(imgregion, origin='lower')
-                    mpl.plot(cy,cx, 'rx')
-                    mpl.show()
-                    mpl.pause(0.0001)
+    Returns [focus, bx, by] with focus the median over the regions of twice the
+    HFR (the FWHM for a gaussian star, but still meaningful out of focus) and
+    (bx, by) the brightest unsaturated star. With maps=True a dict of the
+    region maps (fwhm, hfr, nstars) and of the tilt (change of the focus from
+    the centre to the edge along axis 0 and 1) and curvature (change from the
+    centre to the corner) of the focal plane, in pixels, is appended'''
 
-                try:
-                    popt, pcov = WA.gaussian_fit(xs, star_x, [30000., 3.0, 10.0])
-                    starsx = np.append(starsx,popt[1])
-                    popt, pcov = WA.gaussian_fit(xs, star_y, [30000., 3.0, 10.0])
-                    starsy = np.append(starsy,popt[1])
-                except:
-                    continue
-
-    xavg = np.mean(starsx)
-    yavg = np.mean(starsy)
+    imgshape = img.shape
 
-    return [np.mean([xavg, yavg]), brightestx, brightesty]
+    centroids = WA.centroid_finder(img, plot=False, widths='fast')
+    rows, cols = np.array(centroids[0]), np.array(centroids[1])
+    Iarr, Isat = np.array(centroids[2]), np.array(centroids[3])
+    width = np.array(centroids[4])
+
+    #Unsaturated stars, bright enough and far enough from the edge to measure
+    good = (Isat != 1) & (Iarr > 3000) & (rows >= fitwidth) & (rows < imgshape[0] - fitwidth) & \
+            (cols >= fitwidth) & (cols < imgshape[1] - fitwidth)
+    rows, cols, Iarr, width = rows[good], cols[good], Iarr[good], width[good]
+    hfr = WA.half_flux_radii(img, rows, cols, half = fitwidth)
+
+    fwhmmap = np.zeros((sideregions, sideregions)) * np.nan
+    hfrmap = np.zeros((sideregions, sideregions)) * np.nan
+    nstars = np.zeros((sideregions, sideregions), dtype=int)
+    if len(rows) > 0:
+        ri = np.minimum((rows * sideregions / imgshape[0]).astype(int), sideregions - 1)
+        ci = np.minimum((cols * sideregions / imgshape[1]).astype(int), sideregions - 1)
+        for i in range(sideregions):
+            for j in range(sideregions):
+                inregion = (ri == i) & (ci == j)
+                nstars[i,j] = np.sum(inregion)
+                w, h = width[inregion], hfr[inregion]
+                if np.any(w > 0):
+                    fwhmmap[i,j] = np.median(w[w > 0])
+                if np.any(np.isfinite(h)):
+                    hfrmap[i,j] = np.median(h[np.isfinite(h)])
+
+        brightest = np.argmax(Iarr)
+        bx, by = int(rows[brightest]), int(cols[brightest])
+    else:
+        bx, by = 0, 0
+
+    measured = np.isfinite(hfrmap)
+    focus = 2 * np.median(hfrmap[measured]) if np.any(measured) else np.nan
+
+    if verbose:
+        print "FOCUS: %f FROM %i STARS" % (focus, len(rows))
+        print "HFR MAP:\n%s" % (hfrmap)
+
+    if plot:
+        mpl.imshow(img, origin='lower')
+        mpl.plot(cols, rows, 'rx')
+        mpl.show()
+        mpl.pause(0.0001)
+
+    if not maps:
+        return [focus, bx, by]
+
+    #Focal plane: 2*HFR = c + tilt0*u + tilt1*v + curvature*(u**2 + v**2)/2 with
+    #(u, v) the region centres from -1 to 1
+    u, v = np.meshgrid(np.linspace(-1, 1, sideregions), np.linspace(-1, 1, sideregions), indexing='ij')
+    tilt, curvature = (np.nan, np.nan), np.nan
+    if np.sum(measured) >= 4:
+        design = np.transpose([np.ones(np.sum(measured)), u[measured], v[measured],\
+                (u[measured]**2 + v[measured]**2) / 2.])
+        coeffs = np.linalg.lstsq(design, 2 * hfrmap[measured], rcond=None)[0]
+        tilt, curvature = (coeffs[1], coeffs[2]), coeffs[3]
+
+    return [focus, bx, by, {'fwhm': fwhmmap, 'hfr': hfrmap, 'nstars': nstars, 'tilt': tilt,\
+            'curvature': curvature}]
 
 ################################################################################
 class WIFISGuider(QObject): 
@@ -337,16 +374,17 @@ class WIFISGuider(QObject):
             telemDict['IIS'] = self.rotangle.text()
             hduhdr = self.makeHeader(telemDict)
 
+            #Written compressed in the background
             if objtextval == "":
                 self.updateText.emit("Writing to: "+self.direc+self.todaydate+'T'+time.strftime('%H%M%S')+'.fits')
-                fits.writeto(self.direc+self.todaydate+'T'+\
-                        time.strftime('%H%M%S')+'.fits', img, hduhdr,clobber=True)
+                WAR.archive(self.direc+self.todaydate+'T'+\
+                        time.strftime('%H%M%S')+'.fits', img, hduhdr)
             else:
                 self.updateText.emit("Writing to: "+self.direc+self.todaydate+'T'+\
                         time.strftime('%H%M%S')+'_'+objtextval+".fits")
-                fits.writeto(self.direc+self.todaydate+'T'+\
+                WAR.archive(self.direc+self.todaydate+'T'+\
                         time.strftime('%H%M%S')+'_'+objtextval+".fits",\
-                        img, hduhdr,clobber=True)
+                        img, hduhdr)
 
             self.plotSignal.emit(img, objtextval)
 
@@ -390,6 +428,10 @@ class WIFISGuider(QObject):
         hdr['Filter'] = self.getFilterType()
         hdr['FocPos'] = self.foc.get_stepper_position()
         hdr['AM'] = telemDict['SECZ']
+        try:
+            hdr['CCDTemp'] = self.cam.get_temperature()
+        except Exception:
+            pass
 
         return hdr
 
@@ -480,7 +522,7 @@ class WIFISGuider(QObject):
             self.plotSignal.emit(img, 'Astrometry')
             self.updateText.emit("STARTING ASTROMETRIC DERIVATION")
             try:
-                results = WA.getAstrometricSoln(img, self.telSock, self.rotangle.text())
+                results = WA.getAstrometricSoln(img, self.telSock, self.rotangle.text(), learndistortion = True)
                 if len(results) < 3:
                     self.updateText.emit("NO ASTROMETRIC SOLUTION...NOT ENOUGH STARS? >=3")
                     self.updateText.emit("Try increasing exp time, or moving to a different field")
@@ -504,7 +546,7 @@ class WIFISGuider(QObject):
 
     def focusCamera(self):
 
-        focusthread = FocusCamera(self.cam, self.foc,self.expTime)
+        focusthread = FocusCamera(self.cam, self.foc,self.expTime, self.getFilterType())
         focusthread.start()
 
     def startGuiding(self):
@@ -538,11 +580,12 @@ class FocusCamera(QThread):
     updateText = pyqtSignal(str)
     plotSignal = pyqtSignal(np.ndarray, str)
     
-    def __init__(self, cam, foc, expTime):
+    def __init__(self, cam, foc, expTime, filtername = None):
         QThread.__init__(self)
         self.cam = cam
         self.foc = foc
         self.expTime = int(expTime.text())
+        self.filtername = filtername
         self.stopThread = False
 
     def __del__(self):
@@ -551,48 +594,158 @@ class FocusCamera(QThread):
     def stop(self):
         self.stopThread = True
 
+    def measure(self):
+        '''Exposes and returns the star width'''
+
+        img = self.cam.take_photo()
+        focus, bx, by = measure_focus(img)
+
+        #plotting
+        self.plotSignal.emit(img[bx-20:bx+20,by-20:by+20], "Focusing")
+
+        return focus
+
     def run(self):
         self.updateText.emit("STARTING GUIDE CAMERA FOCUSING...")
         current_focus = self.foc.get_stepper_position() 
-        step = 200
 
         if self.expTime > 4000:
             self.updateText.emit("EXPTIME TOO LONG, FIND BRIGHTER FIELD OR CHANGE TIME")
             return
 
-        #self.cam.set_exposure(3000)
+        #Start from the focus found before with this filter and temperature
+        temperature = WGF.focus_temperature(self.cam, self.foc)
+        model = WGF.FocusModel()
+        predicted = model.predict(self.filtername, temperature)
+        if predicted is None:
+            start, halfwidth = current_focus, 300
+        else:
+            start, halfwidth = int(round(predicted)), 100
+            self.updateText.emit("FOCUS MODEL: %i FOR FILTER %s AT %.1f C" % (start, self.filtername,\
+                    temperature))
+
         self.cam.set_exposure(self.expTime)
-        img = self.cam.take_photo()
-        focus_check1, bx, by = measure_focus(img)
-        direc = 1 #forward
+        focuser = WGF.VCurveFocuser(self.foc, self.measure, report = self.updateText.emit,\
+                stop = lambda: self.stopThread)
+        best, width = focuser.focus(start, halfwidth)
 
-        #plotting
-        self.plotSignal.emit(img[bx-20:bx+20,by-20:by+20], "Focusing")
+        if best is None:
+            self.updateText.emit("### FOCUS FIT FAILED AFTER %i EXPOSURES" % (len(focuser.positions)))
+            return
 
-        while step > 5:
-            self.foc.step_motor(direc*step)
-            img = self.cam.take_photo()
+        model.add(self.filtername, temperature, best)
+        self.updateText.emit("BEST FOCUS: %i, WIDTH %.2f, %i EXPOSURES" % (best, width,\
+                len(focuser.positions)))
+        self.updateText.emit("### FINISHED FOCUSING")
 
+class GuideWindow(object):
+    '''Camera sub-frame (region of interest) readout around the guide star.
+    The window is the guide box plus a margin that grows with the drift of the
+    star measured in the last few guide cycles. Positions are always given in
+    full frame pixels (axis 0, axis 1); the camera image area is given as
+    (ul_x, ul_y, lr_x, lr_y) with x along axis 1. Cameras without
+    set_image_area are always read out in full. The window can be changed from
+    another thread than the one exposing; the change waits for the exposure'''
 
-            #plotting
-            self.plotSignal.emit(img[bx-20:bx+20,by-20:by+20], "Focusing")
+    def __init__(self, cam, fullshape = (1024, 1024), minmargin = 20, maxmargin = 200,\
+            nsigma = 4., ndrift = 10):
 
-            focus_check2,bx2,by2 = measure_focus(img)
-            
-            self.updateText.emit("STEP IS: %i\nPOS IS: %i" % (step,current_focus))
-            self.updateText.emit("Old Focus: %f, New Focus: %f" % (focus_check1, focus_check2))
-
-            #if focus gets go back to beginning, change direction and reduce step
-            if (focus_check2 > focus_check1) or (focus_check2 == np.NaN):
-                direc = direc*-1
-                self.foc.step_motor(direc*step)
-                step = int(step / 2)
-                self.updateText.emit("Focus is worse: changing direction!\n")
-            
-            focus_check1 = focus_check2
-            current_focus = self.foc.get_stepper_position() 
-        
-        self.updateText.emit("### FINISHED FOCUSING")
+        self.cam = cam
+        self.fullshape = fullshape
+        self.minmargin = minmargin
+        self.maxmargin = maxmargin
+        self.nsigma = nsigma
+        self.ndrift = ndrift
+
+        self.enabled = hasattr(cam, 'set_image_area')
+        self.active = False
+        self.area = (0, 0, fullshape[0], fullshape[1])
+        self.margin = maxmargin
+        self.drifts = []
+        self.lock = threading.RLock()
+
+    def record_drift(self, dx, dy):
+        '''Adds the offset of the star from the box centre in this cycle and
+        returns the margin needed for the recent drift'''
+
+        self.drifts = (self.drifts + [max(abs(dx), abs(dy))])[-self.ndrift:]
+        if len(self.drifts) < 3:
+            return self.maxmargin
+
+        drift = np.array(self.drifts)
+        margin = np.max(drift) + self.nsigma * np.std(drift)
+
+        return int(np.clip(margin, self.minmargin, self.maxmargin))
+
+    def set_window(self, row, col, boxsize, margin = None):
+        '''Reads out only the guide box around row, col plus the margin'''
+
+        return self.set_bounds((int(row) - boxsize, int(col) - boxsize, int(row) + boxsize,\
+                int(col) + boxsize), margin)
+
+    def set_bounds(self, bounds, margin = None):
+        '''Reads out only the rows and columns in bounds (row0, col0, row1,
+        col1) plus the margin, e.g. the bounding box of several guide boxes'''
+
+        if not self.enabled:
+            return False
+        if margin is None:
+            margin = self.margin
+
+        row0 = max(int(bounds[0]) - margin, 0)
+        col0 = max(int(bounds[1]) - margin, 0)
+        row1 = min(int(bounds[2]) + margin, self.fullshape[0])
+        col1 = min(int(bounds[3]) + margin, self.fullshape[1])
+
+        with self.lock:
+            if self.active and (self.area == (row0, col0, row1, col1)):
+                return True
+
+            try:
+                self.cam.set_image_area(col0, row0, col1, row1)
+            except Exception as e:
+                print e
+                print "### CAMERA SUB-FRAME READOUT FAILED, USING FULL FRAMES"
+                self.enabled = False
+                self.full_frame()
+                return False
+
+            self.area = (row0, col0, row1, col1)
+            self.margin = margin
+            self.active = True
+
+        return True
+
+    def full_frame(self):
+        '''Goes back to reading out the whole detector'''
+
+        with self.lock:
+            if hasattr(self.cam, 'set_image_area') and (self.active or not self.enabled):
+                try:
+                    self.cam.set_image_area(0, 0, self.fullshape[1], self.fullshape[0])
+                except Exception as e:
+                    print e
+            self.area = (0, 0, self.fullshape[0], self.fullshape[1])
+            self.active = False
+
+    def take_photo(self):
+        '''Takes an image of the current window. Returns the image and the
+        full frame position of its first pixel'''
+
+        with self.lock:
+            img = self.cam.take_photo(shutter='open')
+
+            expected = (self.area[2] - self.area[0], self.area[3] - self.area[1])
+            if img.shape == expected:
+                return img, (self.area[0], self.area[1])
+            elif img.shape == tuple(self.fullshape):
+                #The camera ignored the window
+                self.active = False
+                self.area = (0, 0, self.fullshape[0], self.fullshape[1])
+                return img, (0, 0)
+            else:
+                raise ValueError("Guide image shape %s does not match the window %s" % \
+                        (str(img.shape), str(self.area)))
 
 class RunGuiding(QThread):
 
@@ -601,7 +754,8 @@ class RunGuiding(QThread):
     plotSignal = pyqtSignal(np.ndarray, str)
     endNodding = pyqtSignal(bool)
 
-    def __init__(self, telsock, cam, guideTargetVar, rotangle, guideexp, overguidestar, coords, sky=False):
+    def __init__(self, telsock, cam, guideTargetVar, rotangle, guideexp, overguidestar, coords, sky=False,\
+            nstars=5):
         QThread.__init__(self)
         self.telsock = telsock
         self.guideTargetVar = guideTargetVar
@@ -615,6 +769,15 @@ class RunGuiding(QThread):
         self.overguidestar = overguidestar
         self.coords = coords
         self.guidevals = WA.read_defaults()
+        self.window = GuideWindow(cam)
+        self.pipeline = None
+        self.centroider = WGC.GuideCentroider(method = 'iwc')
+        self.controller = WGCTL.make_controller()
+        self.recorder = WGL.GuideRecorder()
+        self.nstars = nstars
+        self.ensemble = None
+        self.timingreport = 60.
+        self.lastreport = time.time()
 
     def __del__(self):
         self.wait()
@@ -634,6 +797,16 @@ class RunGuiding(QThread):
 
         return currentcoord
 
+    def getElevation(self):
+        '''Telescope elevation from the telemetry label or None'''
+
+        if len(self.coords) < 3:
+            return None
+        try:
+            return float(self.coords[2].text())
+        except ValueError:
+            return None
+
     def run(self):
     
         if self.stopThread: #Re-initializing hack?
@@ -645,55 +818,26 @@ class RunGuiding(QThread):
             self.guideTargetText = self.guideTargetVar.text()
 
         self.updateText.emit("### STARTING GUIDING ON %s" % (self.guideTargetText))
-        gfls = self.checkGuideVariable()
+        guidestar = self.checkGuideVariable()
 
-        guidingstuff = self.wifis_simple_guiding_setup(gfls)
-        #guidingstuff = [offsets, x_rot, y_rot, stary1, starx1, boxsize, img1, fieldinfo]
+        #Guide star acquisition needs the whole field
+        self.window.full_frame()
 
-        if (guidingstuff[3] == 'NoStar') or (guidingstuff[4] == 'NoStar'):
-            self.updateText.emit("NO STARS IN CENTER FIELD...INCREASING GUIDE TIME...")
-            self.exptime += 1000
-
-            while (guidingstuff[3] == 'NoStar') and (self.exptime < 9000):
-                self.updateText.emit("TRYING GUIDE EXPTIME: %i" % (self.exptime))
-                guidingstuff = self.wifis_simple_guiding_setup(gfls)
-                self.exptime += 1000
-
-            #if guidingstuff[3] == 'NoStar':
-            #    self.updateText.emit("NO STARS TO GUIDE ON AT 9s, QUITTING")
-            #    self.endNodding.emit(True)
-            #    return 
-
-        if (guidingstuff[3] == None) or (guidingstuff[4] == None):
-            self.updateText.emit("NO STARS TO GUIDE ON...INCREASING GUIDE TIME...")
-            self.exptime += 1000
-
-            while (guidingstuff[3] == None) and (self.exptime < 9000):
-                self.updateText.emit("TRYING GUIDE EXPTIME: %i" % (self.exptime))
-                guidingstuff = self.wifis_simple_guiding_setup(gfls)
-                self.exptime += 1000
-
-            #if guidingstuff[3] == None:
-            #    self.updateText.emit("NO STARS TO GUIDE ON AT 9s, QUITTING")
-            #    self.endNodding.emit(True)
-            #    return 
-
-        elif guidingstuff[3] == False:
-            self.updateText.emit("ALL STARS IN FIELD SATURATED..DECREASING GUIDE TIME...")
-            self.exptime -= 100
-
-            while (guidingstuff[3] == False) and (self.exptime > 0):
-                self.updateText.emit("TRYING GUIDE EXPTIME: %i" % (self.exptime))
-                guidingstuff = self.wifis_simple_guiding_setup(gfls)
-                if self.exptime < 150:
-                    self.exptime -= 10
-                else:
-                    self.exptime -= 100
+        guidingstuff = self.wifis_simple_guiding_setup(guidestar)
+        #guidingstuff = [offsets, x_rot, y_rot, stary1, starx1, boxsize, img1, fieldinfo]
 
-            if guidingstuff[3] == False:
-                self.updateText.emit("ALL STARS IN FIELD SATURATED AT ALL EXPTIME, QUITTING")
-                self.endNodding.emit(True)
-                return 
+        #Predict the exposure time from the stars found instead of stepping it
+        if guidingstuff[3] in [False, None, 'NoStar']:
+            search = WGE.ExposureSearch(self.exptime, bias = WGE.bias_level())
+            while guidingstuff[3] in [False, None, 'NoStar']:
+                exptime = search.next(self.exptime, guidingstuff[3], guidingstuff[6], guidingstuff[7])
+                if exptime is None:
+                    self.updateText.emit("COULD NOT FIND A GUIDE EXPTIME, TRIED %s" % \
+                            (', '.join([str(t) for t in search.tried])))
+                    break
+                self.updateText.emit("%s...TRYING GUIDE EXPTIME: %i" % (search.reason, exptime))
+                self.exptime = exptime
+                guidingstuff = self.wifis_simple_guiding_setup(guidestar)
 
         if guidingstuff[3] in [False, None, 'NoStar']:
             self.updateText.emit("SOMETHING WENT WRONG WITH GUIDE STAR ASSIGNMENT...")
@@ -726,9 +870,19 @@ class RunGuiding(QThread):
 
         guidingstuff = guidingstuff[:7]
         something_wrong_count = 0
+
+        #Timing of this guiding run only, written out when it stops
+        WT.tracker.reset()
+
+        #Expose, measure and move the telescope in parallel
+        self.pipeline = WGP.GuidePipeline(WT.tracker.wrap('guide expose', self.window.take_photo),\
+                self.moveTelescope, shape = self.window.fullshape)
+        self.pipeline.start()
+        self.lastreport = time.time()
+
         while True:
             if self.stopThread:
-                self.cam.end_exposure()
+                self.stopPipeline()
                 self.updateText.emit("### FINISHED GUIDING")
                 break
             else:
@@ -748,9 +902,45 @@ class RunGuiding(QThread):
                     #    self.exptime += 1000
                         #self.cam.set_exposure(self.exptime, frametype="normal")
                     if something_wrong_count > 15:
+                        self.stopPipeline()
                         self.updateText.emit("GUIDING NOT WORKING...QUITTING")
                         break
 
+    def stopPipeline(self):
+        '''Stops the camera and actuator threads, returns the camera to full
+        frames and writes out the guide log'''
+
+        self.pipeline.stop(timeout = self.exptime / 1000. + 10.)
+        self.recorder.flush()
+        WT.tracker.write()
+        self.cam.end_exposure()
+        self.window.full_frame()
+        print "Guide pipeline: %(frames)i frames, %(dropped)i dropped, %(stale)i during moves, "\
+                "%(moves)i moves" % self.pipeline.stats()
+
+    @WT.timed('guide move')
+    def moveTelescope(self, ra, dec):
+        '''Sends a guide correction (arcsec), called from the actuator thread'''
+
+        WG.move_telescope(self.telsock, ra, dec, verbose=False)
+
+    def reportLatency(self):
+        '''Shows the guide cycle latency, the time waiting for the exposure and
+        the slowest stage over the last timingreport seconds'''
+
+        if time.time() - self.lastreport < self.timingreport:
+            return
+        self.lastreport = time.time()
+
+        p50, p99 = WT.tracker.percentiles('guide cycle', recent = True)
+        wait50 = WT.tracker.percentiles('guide wait', ps = (50,), recent = True)[0]
+        stages = [row for row in WT.tracker.summary('guide ', recent = True) if WT.overhead_stage(row[0])]
+        WT.tracker.roll()
+        if stages:
+            self.updateText.emit("GUIDE CYCLE P50: %.0f ms, P99: %.0f ms, WAIT P50: %.0f ms, "\
+                    "SLOWEST STAGE: %s (P50 %.0f ms)" % (p50*1e3, p99*1e3, wait50*1e3,\
+                    stages[0][0].upper(), stages[0][2]*1e3))
+
     def setSky(self):
         self.setSkySignal.emit("True")
         self.sky = True
@@ -763,23 +953,43 @@ class RunGuiding(QThread):
             self.sky=False
 
     def checkGuideVariable(self):
-        gfl = homedir+'/data/guidefiles/'+time.strftime('%Y%m%d')+'_'+self.guideTargetText+'.txt'
-        guidefls = glob(homedir+'/data/guidefiles/*.txt')
+        '''Returns the guide star registered for this target at this IIS, or None
+        to select a new one'''
+
         if self.guideTargetText == '':
-            return '', False
-        if (gfl in guidefls) and (self.overguidestar.isChecked()):
+            return None
+        try:
+            registry = WGS.GuideStarRegistry()
+            entry = registry.lookup(self.guideTargetText, self.rotangle)
+        except Exception as e:
+            print e
+            self.updateText.emit("### GUIDE STAR REGISTRY UNAVAILABLE, INITIALIZING GUIDE STAR")
+            return None
+
+        if (entry is not None) and (self.overguidestar.isChecked()):
+            #The new guide star replaces this one as the most recent
             self.updateText.emit("OVERWRITING GUIDE STAR...UNCHECKING")
-            os.remove(gfl)
             self.overguidestar.setChecked(False)
-            return gfl, False
-        elif gfl not in guidefls:
-            self.updateText.emit("OBJECT NOT OBSERVED, INITIALIZING GUIDE STAR")
-            return gfl, False
+            return None
+        elif entry is None:
+            self.updateText.emit("OBJECT NOT OBSERVED AT THIS IIS, INITIALIZING GUIDE STAR")
+            return None
         else:
-            self.updateText.emit("OBJECT ALREADY OBSERVED, USING ORIGINAL GUIDE STAR")
-            return gfl, True
+            self.updateText.emit("OBJECT ALREADY OBSERVED ON %s, USING ORIGINAL GUIDE STAR" % (entry.night))
+            return entry
+
+    def saveGuideStar(self, starx1, stary1, gs, centroidx, centroidy, Iarr):
+        '''Registers the new guide star and the other stars in the field'''
+
+        neighbours = [(centroidy[j], centroidx[j], Iarr[j]) for j in range(len(centroidx)) if j != gs]
+        try:
+            WGS.GuideStarRegistry().save(self.guideTargetText, self.rotangle,\
+                    (starx1, stary1, Iarr[gs]), neighbours, self.exptime)
+        except Exception as e:
+            print e
+            self.updateText.emit("### COULD NOT SAVE GUIDE STAR")
 
-    def wifis_simple_guiding_setup(self, gfls):
+    def wifis_simple_guiding_setup(self, guidestar):
 
         #Gets the rotation solution so that we can guide at any instrument rotation angle
         currentcoord = self.getSkyCoord()
@@ -799,28 +1009,22 @@ class RunGuiding(QThread):
         boxsize = 30
 
         #Checks to see if there exists a guiding star for this target
-        if gfls[1] and (gfls[0] != ''):
+        if guidestar is not None:
             #Sets the larger boxsize for guiding setup
             boxsize_f = 50
             
             #Get the original guidestar coordinates.
-            f = open(gfls[0], 'r')
-            lines = f.readlines()
-
-            spl = lines[0].split()
-            starx1old, stary1old = int(spl[0]), int(spl[1])
+            starx1old, stary1old = int(guidestar.x), int(guidestar.y)
 
             centroidxold, centroidyold = [], []
             diffxold, diffyold = [], []
-            if len(lines) > 1:
-                for l in range(1, len(lines)):
-                    spl = lines[l].split()
-                    centroidxold.append(int(spl[0]))
-                    centroidyold.append(int(spl[1]))
-                    diffxold.append(int(spl[0]) - starx1old)
-                    diffyold.append(int(spl[1]) - stary1old)
-
-            if len(lines) > 1:
+            for nx, ny, nexptime, nflux in guidestar.neighbours:
+                centroidxold.append(int(nx))
+                centroidyold.append(int(ny))
+                diffxold.append(int(nx) - starx1old)
+                diffyold.append(int(ny) - stary1old)
+
+            if len(guidestar.neighbours) > 0:
                 inbox = self.numstarsinbox(centroidxold, centroidyold, starx1old, stary1old, boxsize_f)
             else:
                 inbox = []
@@ -843,26 +1047,32 @@ class RunGuiding(QThread):
             else:
                 #If we could not move a star to the right coordinates, then restart guiding for this object
                 self.updateText.emit("COULD NOT FIND OLD GUIDESTAR IN IMAGE...SELECTING NEW GUIDESTAR")
-                starx1, stary1, centroidx,centroidy,Iarr,Isat,width, gs = self.findguidestar(img1, gfls)
+                starx1, stary1, centroidx,centroidy,Iarr,Isat,width, gs = self.findguidestar(img1, guidestar)
                 fieldinfo = [centroidx,centroidy,Iarr,Isat, width]
         else:
             #restart guiding by selecting a new guide star in the image 
-            starx1, stary1, centroidx,centroidy,Iarr,Isat,width,gs = self.findguidestar(img1,gfls)
+            starx1, stary1, centroidx,centroidy,Iarr,Isat,width,gs = self.findguidestar(img1,guidestar)
             fieldinfo = [centroidx,centroidy,Iarr,Isat, width]
             worked = False
         
         #Make sure were guiding on an actual star. If not maybe change the exptime for guiding.
         print starx1, stary1
-        #Record this initial setup in the file
-        if (gfls[0] != '') and (starx1 not in [None, False, "NoStar"]) and (not worked):
-            f = open(gfls[0], 'w')
-            f.write('%i\t%i\t%i\t%i\n' % (starx1, stary1, self.exptime, Iarr[gs]))
-            for j in range(len(centroidx)):
-                if j == gs:
-                    continue
-                f.write('%i\t%i\t%i\t%i\n' % (centroidy[j], centroidx[j], self.exptime, Iarr[j]))
-            f.close()
-        
+        #Record this initial setup in the guide star registry
+        if (self.guideTargetText != '') and (starx1 not in [None, False, "NoStar"]) and (not worked):
+            self.saveGuideStar(starx1, stary1, gs, centroidx, centroidy, Iarr)
+
+        #Other stars to guide on together with the guide star
+        if starx1 not in [None, False, "NoStar"]:
+            if worked:
+                rows = [stary1] + [n[1] for n in guidestar.neighbours]
+                cols = [starx1] + [n[0] for n in guidestar.neighbours]
+                fluxes = [np.inf] + [n[3] for n in guidestar.neighbours]
+                ensemble = WGC.select_ensemble(rows, cols, fluxes, [0]*len(rows), 0, self.nstars, img1size)
+            else:
+                ensemble = WGC.select_ensemble(centroidx, centroidy, Iarr, Isat, gs, self.nstars, img1size)
+            self.ensemble = WGC.GuideEnsemble(ensemble[0], ensemble[1], boxsize)
+            if len(self.ensemble) > 1:
+                self.updateText.emit("GUIDING ON %i STARS" % (len(self.ensemble)))
 
         return [offsets, x_rot, y_rot, stary1, starx1, boxsize, img1, fieldinfo]
 
@@ -876,7 +1086,7 @@ class RunGuiding(QThread):
         
         return inbox
 
-    def findguidestar(self, img1, gfls):
+    def findguidestar(self, img1, guidestar):
         #check positions of stars    
         CFReturns = WA.centroid_finder(img1, plot=False)
 
@@ -929,12 +1139,12 @@ class RunGuiding(QThread):
         offsets, x_rot, y_rot = WG.get_rotation_solution(self.rotangle, guideroffsets)
         
         #Try centroiding
-        CFReturns = WA.centroid_finder(imgbox, plot=False)
+        star = self.centroider.measure(imgbox)
 
-        if CFReturns == False:
+        if star is None:
             return False, False
 
-        centroidx, centroidy, Iarr, Isat, width = CFReturns
+        centroidx, centroidy, Iarr, width = [star.x], [star.y], [star.flux], [star.fwhm]
 
         if not multistar:
             try:
@@ -1028,72 +1238,107 @@ class RunGuiding(QThread):
 
     def run_guiding(self, inputguiding):
        
-        #Get all the parameters from the guiding input
+        #Newest settled image from the camera thread, only the window around the
+        #star once it is found
+        tcycle = time.time()
+        with WT.tracker.time('guide wait'):
+            frame = self.pipeline.next_frame(timeout = self.exptime / 1000. * 2 + 10.)
+        if frame is None:
+            return
+        slot, img, frameinfo = frame
+        try:
+            return self.measure_guide_frame(img, frameinfo, inputguiding)
+        finally:
+            self.pipeline.release(slot)
+            WT.tracker.add('guide cycle', time.time() - tcycle)
+            self.reportLatency()
+
+    def measure_guide_frame(self, img, frameinfo, inputguiding):
+        '''Measures the guide star in one frame and queues the correction.
+        Returns the correction in RA and DEC'''
+
         offsets, x_rot, y_rot, stary1, starx1, boxsize, img1  = inputguiding
+        origin = frameinfo['origin']
+        frametime = (frameinfo['tstart'] + frameinfo['tend']) / 2.
 
-        #Take an image
-        img = self.cam.take_photo(shutter='open')
-        starx_box = int(starx1)
-        stary_box = int(stary1)
+        starx_box = int(starx1) - origin[1]
+        stary_box = int(stary1) - origin[0]
         imgbox = img[stary_box-boxsize:stary_box+boxsize, starx_box-boxsize:starx_box+boxsize]
 
-        #FInd the star in the box
-        CFReturns = WA.centroid_finder(imgbox, plot=False)
-        if CFReturns == False:
+        #FInd the guide stars in their boxes
+        if self.ensemble is None:
+            self.ensemble = WGC.GuideEnsemble([stary1], [starx1], boxsize)
+        with WT.tracker.time('guide centroid'):
+            stars = self.ensemble.measure(img, origin)
+        if stars is None:
+            #Stars lost, look for them in the full frame next time
+            if self.window.active:
+                self.updateText.emit("GUIDE STAR LOST...READING FULL FRAME")
+            self.window.full_frame()
+            self.recorder.record(time = frametime, frame = frameinfo['number'], exptime = self.exptime,\
+                    target = self.guideTargetText, controller = self.controller.name, moved = 0,\
+                    nstars = 0)
             return
-        
-        centroidx, centroidy, Iarr, Isat, width = CFReturns
 
-        try:
-            new_loc = np.argmax(Iarr)
-        except:
-            return
+        #Determine rotation solution 
+        dx = stars.dx
+        dy = stars.dy
 
-        newx = centroidx[new_loc]
-        newy = centroidy[new_loc]
+        #Window the next readout with a margin that covers the recent drift
+        margin = self.window.record_drift(dx, dy)
+        if (not self.window.active) or (abs(margin - self.window.margin) > 10):
+            self.window.set_bounds(self.ensemble.bounds(), margin)
 
-        #Determine rotation solution 
-        dx = newx - boxsize 
-        dy = newy - boxsize
         d_ra = dx * x_rot
         d_dec = dy * y_rot
         radec = d_ra + d_dec
 
-        self.updateText.emit("X Offset:\t%f\nY Offset:\t%f\nRA ADJ:\t%f\nDEC ADJ:\t%f\nPix Width:\t%f\nSEEING:\t%f" \
-           % (dx,dy,radec[1],radec[0],width[0], width[0]*plate_scale))
+        self.updateText.emit("X Offset:\t%f\nY Offset:\t%f\nRA ADJ:\t%f\nDEC ADJ:\t%f\nPix Width:\t%f\nSEEING:\t%f\nSNR:\t%.1f" \
+           % (dx,dy,radec[1],radec[0],stars.fwhm, stars.fwhm*plate_scale, stars.snr))
+        if len(self.ensemble) > 1:
+            self.updateText.emit("STARS:\t%i/%i\nROTATION:\t%.1f\"" % (stars.nused, len(self.ensemble),\
+                    stars.rotation * 180. / np.pi * 3600.))
 
         ##### IMPORTANT GUIDING PARAMETERS #####
-        lim = 0.6 #Changes the absolute limit at which point the guider moves the telescope
-        d = -0.9 #Affects how much the guider corrects by. I was playing around with -0.8 but the default is -1. Keep this negative.
+        #The controller, gains and deadband are set in data/guidegains.txt
         #######################################
 
-        deltRA = 0
-        deltDEC = 0
+        with WT.tracker.time('guide control'):
+            correction = self.controller.update(frametime, [radec[1], radec[0]],\
+                    elevation = self.getElevation(), iis = self.rotangle)
+        deltRA, deltDEC = correction
 
         guidingon=True
         if guidingon:
-            if (abs(radec[1]) < lim) and (abs(radec[0]) < lim):
+            if (deltRA == 0) and (deltDEC == 0):
                 self.updateText.emit("NOT MOVING, TOO SMALL SHIFT\n")
-            elif abs(radec[1]) < lim:
-                self.updateText.emit("MOVING DEC ONLY\n")
-                deltDEC = d*radec[0]
-                WG.move_telescope(self.telsock, 0.0, d*radec[0], verbose=False)
-            elif abs(radec[0]) < lim:
-                self.updateText.emit("MOVING RA ONLY\n")
-                deltRA = d*radec[1]
-                WG.move_telescope(self.telsock, d*radec[1], 0.0, verbose=False)
             else:
-                deltRA = d*radec[1]
-                deltDEC = d*radec[0]
-                WG.move_telescope(self.telsock,d*radec[1],d*radec[0], verbose=False)
-                self.updateText.emit("\n")
-
-        #Record for guiding checking later
-        f = open(homedir+'/log/guidinglog/'+time.strftime('%Y%m%dT%H')+'.txt', 'a')
-        f.write("%f\t%f\n" % (radec[1],radec[0]))
-        f.close()
-
-        self.plotSignal.emit(imgbox,self.guideTargetText + ' GuideStar')
+                if deltRA == 0:
+                    self.updateText.emit("MOVING DEC ONLY\n")
+                elif deltDEC == 0:
+                    self.updateText.emit("MOVING RA ONLY\n")
+                else:
+                    self.updateText.emit("\n")
+                self.pipeline.correct(deltRA, deltDEC)
+
+        #Record for guiding checking later (WIFISguidelog.py reads the logs)
+        state = self.controller.state
+        tlog = time.time()
+        self.recorder.record(time = frametime, frame = frameinfo['number'], exptime = self.exptime,\
+                target = self.guideTargetText, controller = self.controller.name,\
+                x = int(stary1) + dx, y = int(starx1) + dy, dx = dx, dy = dy,\
+                offset_ra = radec[1], offset_dec = radec[0], flux = stars.flux, fwhm = stars.fwhm,\
+                snr = stars.snr, nstars = stars.nused, rotation = stars.rotation,\
+                peak = stars.stars[0].peak if stars.stars[0] is not None else np.nan,\
+                estimate_ra = state['estimate_ra'],\
+                estimate_dec = state['estimate_dec'], memory_ra = state['memory_ra'],\
+                memory_dec = state['memory_dec'], correction_ra = deltRA, correction_dec = deltDEC,\
+                moved = int((deltRA != 0) or (deltDEC != 0)), latency = self.pipeline.latency)
+        WT.tracker.add('guide log', time.time() - tlog)
+
+        #The frame buffer goes back to the camera thread, so plot a copy
+        with WT.tracker.time('guide plot emit'):
+            self.plotSignal.emit(imgbox.copy(),self.guideTargetText + ' GuideStar')
 
         return deltRA, deltDEC
 
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFISguidestars.py
+# Purpose:          Registry of the guide stars used for each target
+#------------------------------------------------------------------------------
+
+"""
+SQLite registry of guide stars, replacing the per target text files in
+data/guidefiles/. Every guide star is stored with its target, night and
+rotator (IIS) angle, the exposure time and flux, and the other stars found in
+the field (the neighbours), which are used to recognise the field when the
+guide star is reacquired. Lookups go through an index on target and IIS, and
+each guide star is written in a single transaction.
+
+A guide star is reused on any later night when the IIS matches. The old text
+files have no IIS; after importing they are only reused on their own night, as
+before.
+
+    python WIFISguidestars.py [--import dir] [target]
+
+imports the old guide files (done automatically when the registry is created)
+or lists the guide stars of a target.
+"""
+
+import numpy as np
+import os, time, sqlite3
+import argparse
+from glob import glob
+from collections import namedtuple
+
+homedir = os.path.dirname(os.path.realpath(__file__))
+
+dbfile = homedir + '/data/guidestars.db'
+guidefiledir = homedir + '/data/guidefiles/'
+
+GuideStarEntry = namedtuple('GuideStarEntry', ['id', 'target', 'night', 'iis', 'exptime', 'x', 'y',\
+        'flux', 'neighbours'])
+
+schema = '''
+CREATE TABLE IF NOT EXISTS guidestars (
+    id INTEGER PRIMARY KEY,
+    target TEXT NOT NULL,
+    night TEXT NOT NULL,
+    iiskey INTEGER,
+    iis REAL,
+    created REAL,
+    exptime INTEGER,
+    x REAL,
+    y REAL,
+    flux REAL);
+CREATE UNIQUE INDEX IF NOT EXISTS guidestarkey ON guidestars (target, iiskey, night);
+CREATE TABLE IF NOT EXISTS neighbours (
+    guidestar INTEGER NOT NULL REFERENCES guidestars(id) ON DELETE CASCADE,
+    x REAL,
+    y REAL,
+    exptime INTEGER,
+    flux REAL);
+CREATE INDEX IF NOT EXISTS neighbourstar ON neighbours (guidestar);
+'''
+
+def night_name(t = None):
+    '''Date of the start of the night of time t as YYYYMMDD'''
+
+    if t is None:
+        t = time.time()
+    return time.strftime('%Y%m%d', time.localtime(t - 12 * 3600))
+
+def guidefile_night(fl):
+    '''Night of an old YYYYMMDD_target.txt guide file. The name has the
+    calendar date it was written on, so files written after midnight carry the
+    next day; the night is taken from the modification time like night_name,
+    unless the file was copied and its time no longer matches the name'''
+
+    date = os.path.basename(fl)[:8]
+    mtime = os.path.getmtime(fl)
+    if time.strftime('%Y%m%d', time.localtime(mtime)) == date:
+        return night_name(mtime)
+    return date
+
+def iis_key(iis):
+    '''IIS angles are matched in 0.1 degree steps, from 0 to 359.9'''
+
+    if iis is None:
+        return None
+    return int(round((float(iis) % 360.) * 10)) % 3600
+
+class GuideStarRegistry(object):
+    '''Guide star registry in dbfile. A connection is opened for each call so
+    the registry can be used from any thread'''
+
+    def __init__(self, dbfile = dbfile, importdir = guidefiledir):
+
+        self.dbfile = dbfile
+        new = not os.path.exists(dbfile)
+
+        conn = self.connect()
+        with conn:
+            conn.executescript(schema)
+        conn.close()
+
+        if new and importdir and os.path.isdir(importdir):
+            n = self.import_guidefiles(importdir)
+            if n > 0:
+                print "Imported %i guide files from %s" % (n, importdir)
+
+    def connect(self):
+        conn = sqlite3.connect(self.dbfile, timeout = 10.)
+        conn.execute('PRAGMA foreign_keys = ON')
+        return conn
+
+    def save(self, target, iis, star, neighbours, exptime, night = None):
+        '''Stores the guide star (x, y, flux) of target at iis with the
+        neighbours [(x, y, flux), ...], replacing the one of the same night and
+        IIS. Returns the id of the guide star'''
+
+        if night is None:
+            night = night_name()
+
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM guidestars WHERE target = ? AND night = ? AND '\
+                        'iiskey IS ?', (target, night, iis_key(iis)))
+                cur = conn.execute('INSERT INTO guidestars (target, night, iiskey, iis, created, '\
+                        'exptime, x, y, flux) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (target, night,\
+                        iis_key(iis), iis, time.time(), int(exptime), float(star[0]), float(star[1]),\
+                        float(star[2])))
+                starid = cur.lastrowid
+                conn.executemany('INSERT INTO neighbours (guidestar, x, y, exptime, flux) VALUES '\
+                        '(?, ?, ?, ?, ?)', [(starid, float(n[0]), float(n[1]), int(exptime),\
+                        float(n[2])) for n in neighbours])
+        finally:
+            conn.close()
+
+        return starid
+
+    def lookup(self, target, iis, night = None, tol = 0.5):
+        '''Returns the most recent GuideStarEntry of target with an IIS within
+        tol degrees of iis, or None. Entries without an IIS only match on their
+        own night. night restricts the search to one night'''
+
+        thisnight = night_name() if night is None else night
+        lo, hi = iis_key(iis - tol), iis_key(iis + tol)
+
+        #Near 0/360 the IIS range is split in two
+        if lo <= hi:
+            ranges = [lo, hi, lo, hi]
+        else:
+            ranges = [lo, 3599, 0, hi]
+
+        conn = self.connect()
+        try:
+            query = 'SELECT id, target, night, iis, exptime, x, y, flux FROM guidestars '\
+                    'WHERE target = ? AND ((iiskey BETWEEN ? AND ?) OR (iiskey BETWEEN ? AND ?) OR '\
+                    '(iiskey IS NULL AND night = ?))'
+            args = [target] + ranges + [thisnight]
+            if night is not None:
+                query += ' AND night = ?'
+                args.append(night)
+            row = conn.execute(query + ' ORDER BY night DESC, created DESC LIMIT 1', args).fetchone()
+            if row is None:
+                return None
+
+            neighbours = conn.execute('SELECT x, y, exptime, flux FROM neighbours WHERE '\
+                    'guidestar = ?', (row[0],)).fetchall()
+        finally:
+            conn.close()
+
+        return GuideStarEntry(*(list(row) + [neighbours]))
+
+    def history(self, target):
+        '''All guide stars of target as (night, iis, exptime, x, y, flux)'''
+
+        conn = self.connect()
+        try:
+            rows = conn.execute('SELECT night, iis, exptime, x, y, flux FROM guidestars WHERE '\
+                    'target = ? ORDER BY night, iis', (target,)).fetchall()
+        finally:
+            conn.close()
+
+        return rows
+
+    def remove(self, target, iis = None, night = None):
+        '''Removes the guide stars of target, optionally only at one IIS or
+        night. Returns the number removed'''
+
+        query = 'DELETE FROM guidestars WHERE target = ?'
+        args = [target]
+        if iis is not None:
+            query += ' AND iiskey = ?'
+            args.append(iis_key(iis))
+        if night is not None:
+            query += ' AND night = ?'
+            args.append(night)
+
+        conn = self.connect()
+        try:
+            with conn:
+                n = conn.execute(query, args).rowcount
+        finally:
+            conn.close()
+
+        return n
+
+    def import_guidefiles(self, directory = guidefiledir):
+        '''Imports the old YYYYMMDD_target.txt guide files. Their first line is
+        the guide star (x, y, exptime, flux) and the rest the neighbours'''
+
+        n = 0
+        for fl in sorted(glob(os.path.join(directory, '*.txt'))):
+            name = os.path.splitext(os.path.basename(fl))[0]
+            if (len(name) < 10) or (name[8] != '_') or (not name[:8].isdigit()):
+                continue
+            try:
+                data = np.atleast_2d(np.loadtxt(fl))
+            except (IOError, ValueError) as e:
+                print "### Could not import guide file %s: %s" % (fl, e)
+                continue
+            if (data.size == 0) or (data.shape[1] < 4):
+                continue
+
+            self.save(name[9:], None, data[0, [0, 1, 3]], data[1:, [0, 1, 3]], data[0, 2],\
+                    night = guidefile_night(fl))
+            n += 1
+
+        return n
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='WIFIS guide star registry')
+    parser.add_argument('target', nargs='?', default=None, help='list the guide stars of target')
+    parser.add_argument('--import', dest='importdir', default=None, help='import old guide files')
+    args = parser.parse_args()
+
+    registry = GuideStarRegistry()
+    if args.importdir:
+        print "Imported %i guide files" % (registry.import_guidefiles(args.importdir))
+    if args.target:
+        for night, iis, exptime, x, y, flux in registry.history(args.target):
+            print "%s  IIS %s  %6i ms  %7.1f %7.1f  %10.0f" % (night, '%.1f' % iis if iis is not None \
+                    else '  -  ', exptime, x, y, flux)
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFISsimulator.py
+# Purpose:          Simulated FLI guider devices and telescope for testing
+#------------------------------------------------------------------------------
+
+"""
+Stand-ins for the FLI guide camera, focuser and filter wheel and for the TCS
+socket, so the guider (WIFISGuider, RunGuiding, FocusCamera and the
+astrometry) can be run and timed without the hardware. They have the methods
+of FLI.USBCamera, FLI.USBFocuser and FLI.USBFilterWheel that the guider uses,
+and the simulated telescope answers REQUEST ALL and RADECGUIDE like the TCS.
+
+All of the devices share one simulated sky (get_sky()). Frames are rendered
+by WIFISsynthetic.synthetic_field, so the astrometry can solve them against
+the 'synthetic' catalog, with
+
+    - the seeing FWHM plus a defocus growing with the distance of the focuser
+      from bestfocus, and the filter throughput
+    - the star positions moved by a constant drift, random seeing jitter and
+      the guide corrections sent to the telescope
+    - counts proportional to the exposure time, saturating at 65535
+    - the exposure time and a readout time proportional to the pixels read
+      spent waiting, like the camera (times timescale, 0 for no waiting)
+
+The simulator is switched on with 'simulate 1' in data/guidersim.txt, which
+also holds the settings of the sky and devices. load_FLIDevices and
+connect_to_telescope then return the simulated devices.
+
+Run as a script to take a run of simulated frames while the field is moved
+across the chip, so stars drift over every edge:
+
+    python WIFISsimulator.py [nframes]
+"""
+
+import numpy as np
+import os, sys, time, socket, threading
+import WIFISsynthetic as WS
+import WIFIStelescope as WG
+
+homedir = os.path.dirname(os.path.realpath(__file__))
+
+simfile = homedir + '/data/guidersim.txt'
+
+defaults = {'simulate': 0., 'ra': 150., 'dec': 30., 'iis': 90., 'el': 60., 'nstars': 100.,\
+        'seeing': 1.2, 'peakflux': 40000., 'sky': 300., 'readnoise': 8., 'drift_ra': 0.02,\
+        'drift_dec': -0.01, 'jitter': 0.15, 'bestfocus': 5000., 'defocus': 0.01, 'temperature': 10.,\
+        'readout': 0.7, 'tcslatency': 0.5, 'timescale': 1., 'seed': 1.}
+
+filternames = ['Z', 'I', 'R', 'G', 'H-Alpha']
+throughput = [0.5, 0.8, 1.0, 0.8, 0.05]
+
+def read_settings(fl = simfile):
+    '''Reads the simulator settings, lines of a name and a number, over the
+    defaults'''
+
+    settings = dict(defaults)
+    if not os.path.exists(fl):
+        return settings
+
+    f = open(fl, 'r')
+    for line in f:
+        spl = line.split('#')[0].split()
+        if len(spl) == 0:
+            continue
+        try:
+            settings[spl[0]] = float(spl[1])
+        except (IndexError, ValueError):
+            print "### Could not read simulator setting: %s" % (line.strip())
+    f.close()
+
+    return settings
+
+def enabled(fl = simfile):
+    '''True if the simulator is switched on in the settings file'''
+
+    return read_settings(fl)['simulate'] != 0
+
+class SimSky(object):
+    '''The simulated sky and telescope. The pointing error (arcsec RA, DEC) is
+    the drift since the start plus the corrections sent; guiding holds it near
+    zero'''
+
+    def __init__(self, settings = None):
+
+        if settings is None:
+            settings = read_settings()
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.tstart = time.time()
+        self.moves = np.zeros(2)
+        self.focus = int(settings['bestfocus'] - 300)
+        self.filterpos = 0
+        self.nframes = 0
+
+    def wait(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds * self.settings['timescale'])
+
+    def move(self, ra, dec):
+        with self.lock:
+            self.moves += [ra, dec]
+
+    def pointing_error(self):
+        s = self.settings
+        with self.lock:
+            drift = np.array([s['drift_ra'], s['drift_dec']]) * (time.time() - self.tstart)
+            return drift + self.moves
+
+    def fwhm(self):
+        '''Star FWHM in pixels at the current focus'''
+
+        s = self.settings
+        return np.sqrt((s['seeing'] / WG.plate_scale)**2 + (s['defocus'] * (self.focus - s['bestfocus']))**2)
+
+    def render(self, exptime, dark = False):
+        '''Full frame image of an exposure of exptime ms'''
+
+        s = self.settings
+        scale = exptime / 1000.
+        with self.lock:
+            self.nframes += 1
+            noiseseed = self.nframes
+
+        #The pointing error and the seeing jitter move the field on the sky
+        error = self.pointing_error() + np.random.normal(0., s['jitter'], 2)
+        peak = 0. if dark else s['peakflux'] * scale * throughput[self.filterpos]
+        sky = 0. if dark else s['sky'] * scale
+
+        img, head, stars, truth = WS.synthetic_field(s['ra'], s['dec'], s['iis'], nstars = int(s['nstars']),\
+                fwhm = self.fwhm(), peakflux = peak, sky = sky, readnoise = s['readnoise'],\
+                fieldshift = tuple(error), exptime = exptime, seed = int(s['seed']),\
+                noiseseed = noiseseed)
+
+        return img
+
+    def telemetry(self):
+        '''The REQUEST ALL answer of the TCS'''
+
+        s = self.settings
+        RA, DEC = WS.pointing_strings(s['ra'], s['dec'])
+        ut = time.strftime('%H:%M:%S', time.gmtime())
+        values = [WG.TELID, 'TCS', str(WG.REF_NUM), '0', RA, DEC, '+00:00:00.0', ut, '%.2f' % (s['el']),\
+                '180.00', '%.3f' % (1. / np.sin(s['el'] * np.pi / 180.)), '2000.0',\
+                '%.5f' % (time.time() / 86400. + 2440587.5), '0', '180.0', ut, '%.1f' % (s['iis'])]
+
+        #get_telemetry cuts out characters 74 to 87 of the answer
+        head = ''
+        while values and (len(head) + len(values[0]) + 1 < 74):
+            head += values.pop(0) + ' '
+        return head.ljust(74) + ' ' * 13 + ' '.join(values) + '\n'
+
+class SimCamera(object):
+    '''Simulated FLI.USBCamera'''
+
+    def __init__(self, sky, shape = (1024, 1024)):
+
+        self.sky = sky
+        self.shape = shape
+        self.exptime = 1000
+        self.frametype = 'normal'
+        self.area = (0, 0, shape[1], shape[0])
+        self.temperature = 20.
+        self.setpoint = 20.
+
+    def set_exposure(self, exptime, frametype = 'normal'):
+        self.exptime = int(exptime)
+        self.frametype = frametype
+
+    def end_exposure(self):
+        pass
+
+    def set_image_area(self, ul_x, ul_y, lr_x, lr_y):
+        if not ((0 <= ul_x < lr_x <= self.shape[1]) and (0 <= ul_y < lr_y <= self.shape[0])):
+            raise ValueError("Bad image area %s" % (str((ul_x, ul_y, lr_x, lr_y))))
+        self.area = (ul_x, ul_y, lr_x, lr_y)
+
+    def set_temperature(self, temperature):
+        self.setpoint = float(temperature)
+
+    def get_temperature(self):
+        #The cooler reaches the set point after a few minutes
+        self.temperature += (self.setpoint - self.temperature) * 0.2
+        return self.temperature
+
+    def take_photo(self, shutter = 'open'):
+
+        ul_x, ul_y, lr_x, lr_y = self.area
+        self.sky.wait(self.exptime / 1000.)
+        dark = (self.frametype != 'normal') or (shutter != 'open')
+        img = self.sky.render(self.exptime, dark = dark)[ul_y:lr_y, ul_x:lr_x]
+        self.sky.wait(self.sky.settings['readout'] * img.size / float(self.shape[0] * self.shape[1]))
+
+        return img
+
+class SimFocuser(object):
+    '''Simulated FLI.USBFocuser'''
+
+    def __init__(self, sky, steptime = 0.001):
+        self.sky = sky
+        self.steptime = steptime
+
+    def get_stepper_position(self):
+        return self.sky.focus
+
+    def step_motor(self, steps):
+        self.sky.wait(abs(steps) * self.steptime)
+        self.sky.focus = max(self.sky.focus + int(steps), 0)
+
+    def home_focuser(self):
+        self.step_motor(-self.sky.focus)
+
+    def read_internal_temperature(self):
+        return self.sky.settings['temperature']
+
+class SimFilterWheel(object):
+    '''Simulated FLI.USBFilterWheel'''
+
+    def __init__(self, sky, movetime = 1.):
+        self.sky = sky
+        self.movetime = movetime
+
+    def get_filter_pos(self):
+        return self.sky.filterpos
+
+    def set_filter_pos(self, pos):
+        if not (0 <= pos < len(filternames)):
+            raise ValueError("No filter position %i" % (pos))
+        self.sky.wait(self.movetime)
+        self.sky.filterpos = pos
+
+class SimTelescope(object):
+    '''Simulated TCS socket. Answers are read back with recv() until it times
+    out after tcslatency, like the real socket'''
+
+    def __init__(self, sky):
+        self.sky = sky
+        self.pending = ''
+
+    def settimeout(self, timeout):
+        pass
+
+    def connect(self, address):
+        pass
+
+    def close(self):
+        pass
+
+    def send(self, reqString):
+
+        spl = reqString.split()
+        if (len(spl) > 4) and (spl[3] == 'REQUEST') and (spl[4] == 'ALL'):
+            self.pending += self.sky.telemetry()
+        else:
+            if (len(spl) > 5) and (spl[3] == 'RADECGUIDE'):
+                self.sky.move(float(spl[4]), float(spl[5]))
+            self.pending += ' '.join(spl[:3]) + ' OK\n'
+
+        return len(reqString)
+
+    def recv(self, nbytes):
+
+        if not self.pending:
+            self.sky.wait(self.sky.settings['tcslatency'])
+            raise socket.timeout()
+        out, self.pending = self.pending[:nbytes], self.pending[nbytes:]
+
+        return out
+
+sky = None
+
+def get_sky():
+    '''The simulated sky shared by all of the simulated devices'''
+
+    global sky
+    if sky is None:
+        sky = SimSky()
+    return sky
+
+def sim_devices():
+    '''Simulated [cam, foc, flt] as returned by load_FLIDevices'''
+
+    return [SimCamera(get_sky()), SimFocuser(get_sky()), SimFilterWheel(get_sky())]
+
+def check_drift(nframes = 200, step = 2.):
+    '''Takes nframes full frames with the simulated camera while the field
+    moves step arcsec per frame, out and back along both axes, so stars cross
+    all four edges of the chip. Returns the number of frames that failed'''
+
+    settings = read_settings()
+    settings['timescale'] = 0.
+    settings['drift_ra'] = settings['drift_dec'] = 0.
+    sky = SimSky(settings)
+    sky.focus = int(settings['bestfocus'])
+    cam = SimCamera(sky)
+    cam.set_exposure(1000)
+
+    #Out to about 350 pixels and back, first in RA and then in DEC
+    quarter = max(nframes // 4, 1)
+    nfailed = 0
+    for i in range(nframes):
+        sign = 1 if (i % (2 * quarter)) < quarter else -1
+        if i < 2 * quarter:
+            sky.move(sign * step, 0.)
+        else:
+            sky.move(0., sign * step)
+        try:
+            img = cam.take_photo()
+        except Exception as e:
+            print "### Frame %i (pointing error %s) failed: %s" % (i, str(sky.pointing_error()), e)
+            nfailed += 1
+
+    return nfailed
+
+if __name__ == '__main__':
+
+    nframes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    t0 = time.time()
+    nfailed = check_drift(nframes)
+    print "%i of %i frames failed (%.1f s)" % (nfailed, nframes, time.time() - t0)
+    sys.exit(1 if nfailed else 0)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFISsynthetic.py
+# Purpose:          Synthetic guider star fields with a known astrometric solution
+#------------------------------------------------------------------------------
+
+"""
+Makes guider-like frames and the matching star catalog for testing the
+astrometry without the telescope or VizieR. Stars are drawn on the sky around
+the guider field, projected and rotated into the detector with the inverse of
+the conventions used by getAstrometricSoln (projected_coords, rotate_points
+and the flip of the detector y axis) and rendered with a gaussian PSF on top
+of the guider bias, sky, noise and hot pixels.
+
+The catalog of the last field made is served to the astrometry as the
+'synthetic' catalog, so a frame can be solved with
+
+    img, head, stars, truth = synthetic_field(150., 30., 90.)
+    WA.getAstrometricSoln(img, None, head, 90., catalog='synthetic')
+
+Run as a script to check that dense fields with stars over all of the chip
+edges render:
+
+    python WIFISsynthetic.py [nfields]
+"""
+
+import numpy as np
+import sys
+import WIFISastrometry as WA
+import WIFISframestore as WF
+import WIFIScatalog as WC
+from astropy.io import fits
+
+catalogstars = np.zeros(0, dtype=WC.catalogdtype).view(np.recarray)
+
+def synthetic_catalog(radeg, decdeg, fovam):
+    '''Catalog fetch function for the 'synthetic' catalog. Returns the stars of
+    the last synthetic field inside the fovam box around radeg, decdeg'''
+
+    inside = WC.in_box(catalogstars['ra'], catalogstars['dec'], radeg, decdeg, fovam / 60. / 2.)
+
+    return catalogstars[inside]
+
+WA.register_catalog('synthetic', synthetic_catalog, cache = False, maglimit = 17.5)
+
+def sky_to_pixels(ra, dec, ra0, dec0, rotangle):
+    '''Returns the detector positions (axis 0, axis 1) of sky positions for a
+    guider field centred on ra0, dec0 at rotator angle rotangle. This is the
+    inverse of what getAstrometricSoln does to the centroids'''
+
+    xproj, yproj, X, Y = WA.projected_coords(ra, dec, ra0, dec0)
+
+    rotangle_rad = (rotangle - 90 - 0.26) * np.pi / 180.
+    rotation_matrix = np.array([[np.cos(rotangle_rad), np.sin(rotangle_rad)],\
+        [-1*np.sin(rotangle_rad), np.cos(rotangle_rad)]])
+
+    points = np.array([xproj - 512., (1024. - yproj) - 512.])
+    pix = np.dot(rotation_matrix, points) + 512.
+
+    return pix[0], pix[1]
+
+def pointing_strings(radeg, decdeg):
+    '''Returns RA and DEC as the HHMMSS.SS and +DDMMSS.S strings of the guider
+    image headers'''
+
+    ra = (radeg % 360.) / 15.
+    h = int(ra)
+    m = int((ra - h) * 60)
+    s = ((ra - h) * 60 - m) * 60
+
+    sign = '-' if decdeg < 0 else '+'
+    dec = abs(decdeg)
+    d = int(dec)
+    dm = int((dec - d) * 60)
+    ds = ((dec - d) * 60 - dm) * 60
+
+    return '%02i%02i%05.2f' % (h, m, s), '%s%02i%02i%04.1f' % (sign, d, dm, ds)
+
+def synthetic_field(radeg, decdeg, rotangle, nstars = 100, fovam = 9., magrange = (11., 18.5),\
+        fwhm = 3.5, zeropoint = 11., peakflux = 40000., sky = 300., readnoise = 8.,\
+        nhot = 50, pointing_error = (0., 0.), fieldshift = (0., 0.), exptime = 1000, seed = None,\
+        noiseseed = None):
+    '''Makes a synthetic guider frame and catalog.
+
+    The guider field is centred where getAstrometricSoln expects it for a
+    telescope pointing at radeg, decdeg (the guider offsets rotated by
+    rotangle). nstars are drawn uniformly over a fovam box with magnitudes
+    uniform in magrange; a star of magnitude zeropoint peaks at peakflux
+    counts. Stars past 65535 counts saturate. pointing_error (arcsec RA, DEC)
+    shifts the true field from the pointing in the header. fieldshift (arcsec
+    RA, DEC) moves the field after the stars are drawn, so the same stars move
+    across the detector as when the telescope drifts. seed sets the
+    stars and hot pixels; the noise is drawn with noiseseed when it is given,
+    so frames of the same field can differ only in their noise.
+
+    Returns the uint16 image, its header, the catalog record array and a dict
+    of the true field centre, star positions and fluxes.'''
+
+    rs = np.random.RandomState(seed)
+    nrs = rs if noiseseed is None else np.random.RandomState(noiseseed)
+
+    valuesdict = WA.read_defaults()
+    guider_offsets = [float(valuesdict['GuideRA']), float(valuesdict['GuideDEC'])]
+    offsets = WA.get_rotation_solution_offset(rotangle, guider_offsets, decdeg)
+
+    cosdec = np.cos(decdeg * np.pi / 180.)
+    ra0 = radeg - offsets[0] / 3600. / cosdec + pointing_error[0] / 3600. / cosdec
+    dec0 = decdeg - offsets[1] / 3600. + pointing_error[1] / 3600.
+
+    #The catalog
+    stars = np.zeros(nstars, dtype=WC.catalogdtype).view(np.recarray)
+    stars['name'] = ['SYN%05i' % i for i in range(nstars)]
+    stars['ra'] = ra0 + rs.uniform(-0.5, 0.5, nstars) * fovam / 60. / np.cos(dec0 * np.pi / 180.)
+    stars['dec'] = dec0 + rs.uniform(-0.5, 0.5, nstars) * fovam / 60.
+    stars['mag'] = rs.uniform(magrange[0], magrange[1], nstars)
+
+    cosdec0 = np.cos(dec0 * np.pi / 180.)
+    ra0 = ra0 + fieldshift[0] / 3600. / cosdec0
+    dec0 = dec0 + fieldshift[1] / 3600.
+
+    #The image
+    bias = np.array(WF.get_framestore().bias(), dtype=float)
+    img = bias + sky + nrs.normal(0., np.sqrt(readnoise**2 + sky), bias.shape)
+
+    px, py = sky_to_pixels(stars['ra'], stars['dec'], ra0, dec0, rotangle)
+    sigma = fwhm / 2.355
+    peak = peakflux * 10**(-0.4 * (stars['mag'] - zeropoint))
+    half = int(np.ceil(5 * sigma))
+    offs = np.arange(-half, half + 1)
+
+    onchip = (px > -half) & (px < img.shape[0] + half) & (py > -half) & (py < img.shape[1] + half)
+    for i in np.where(onchip)[0]:
+        rows = int(round(px[i])) + offs
+        cols = int(round(py[i])) + offs
+        rows = rows[(rows >= 0) & (rows < img.shape[0])]
+        cols = cols[(cols >= 0) & (cols < img.shape[1])]
+        #The rounded centre can put the whole stamp off the chip
+        if (rows.size == 0) or (cols.size == 0):
+            continue
+        stamp = peak[i] * np.exp(-((rows[:,np.newaxis] - px[i])**2 + \
+                (cols[np.newaxis,:] - py[i])**2) / (2 * sigma**2))
+        img[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1] += nrs.poisson(stamp)
+
+    hotx = rs.randint(0, img.shape[0], nhot)
+    hoty = rs.randint(0, img.shape[1], nhot)
+    img[hotx, hoty] += rs.uniform(2000, 60000, nhot)
+
+    img = np.clip(img, 0, 65535).astype(np.uint16)
+
+    RA, DEC = pointing_strings(radeg, decdeg)
+    head = fits.Header()
+    head['RA'] = RA
+    head['DEC'] = DEC
+    head['IIS'] = '%.1f' % (rotangle)
+    head['EXPTIME'] = str(exptime)
+
+    use_catalog(stars)
+
+    inimage = (px >= 0) & (px < img.shape[0]) & (py >= 0) & (py < img.shape[1])
+    truth = {'center': [ra0, dec0], 'x': px[inimage], 'y': py[inimage],\
+            'peak': peak[inimage], 'index': np.where(inimage)[0], 'fwhm': fwhm}
+
+    return img, head, stars, truth
+
+def use_catalog(stars):
+    '''Makes stars the catalog served as the 'synthetic' catalog'''
+
+    global catalogstars
+    catalogstars = stars.view(np.recarray)
+
+def check_edges(nfields = 20, nstars = 300, fwhm = 6.):
+    '''Renders nfields dense fields, each shifted by a fraction of a pixel so
+    stars fall just on and off every edge of the chip. Returns the number of
+    fields that failed'''
+
+    nfailed = 0
+    for i in range(nfields):
+        shift = (0.37 * i, -0.23 * i)
+        try:
+            img, head, stars, truth = synthetic_field(150., 30., 90., nstars = nstars, fwhm = fwhm,\
+                    fieldshift = shift, seed = i + 1)
+        except Exception as e:
+            print "### Field %i (seed %i, shift %s) failed: %s" % (i, i + 1, str(shift), e)
+            nfailed += 1
+            continue
+
+        edge = (truth['x'] < 5) | (truth['x'] > img.shape[0] - 6) | (truth['y'] < 5) | \
+                (truth['y'] > img.shape[1] - 6)
+        print "Field %i: %i stars on the chip, %i within 5 pixels of an edge" % (i, len(truth['x']),\
+                np.sum(edge))
+
+    return nfailed
+
+if __name__ == '__main__':
+
+    nfields = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    nfailed = check_edges(nfields)
+    print "%i of %i fields failed" % (nfailed, nfields)
+    sys.exit(1 if nfailed else 0)
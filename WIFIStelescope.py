@@ -9,6 +9,7 @@ try:
 except:
     pass    
 import WIFISastrometry as WA
+import WIFIStiming as WT
 from glob import glob
 from astropy.io import fits
 from sys import exit
@@ -52,6 +53,11 @@ keyList = ["ID"            ,
         "IIS"]
 
 def connect_to_telescope():
+    #Simulated telescope when the guider simulator is switched on
+    import WIFISsimulator as WSIM
+    if WSIM.enabled():
+        return WSIM.SimTelescope(WSIM.get_sky())
+
     #instantiate the socket class
     telSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     telSock.settimeout(0.5)
@@ -67,6 +73,7 @@ def query_telescope(telSock, reqString, verbose=True, telem=False):
 
     if verbose:
         print("QUERYING: %s" % (reqString))
+    tquery = time.time()
    
     for i in range(10): 
         telSock.send(reqString)
@@ -115,6 +122,11 @@ def query_telescope(telSock, reqString, verbose=True, telem=False):
         elif char.endswith("\n"):
             cleanResp.append(char[:-1])
 
+    #Time each kind of TCS command separately
+    spl = reqString.split()
+    command = ' '.join(spl[3:5]) if (len(spl) > 4) and (spl[3] == 'REQUEST') else ' '.join(spl[3:4])
+    WT.tracker.add('tcs ' + command, time.time() - tquery)
+
     return cleanResp
     
 def get_telemetry(telSock, verbose=True):
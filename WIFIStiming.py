@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# Name:             WIFIStiming.py
+# Purpose:          Latency histograms of the stages of the guide loop
+#------------------------------------------------------------------------------
+
+"""
+Lightweight timing of the guide loop and the telescope and plotting calls
+around it. Every duration goes into a histogram per stage with logarithmic
+bins (20 per decade from 10 us to 1000 s), so recording costs about a
+microsecond and no memory is allocated while guiding. Percentiles are read off
+the histograms to 12% (one bin).
+
+    with WT.tracker.time('centroid'):
+        ...
+
+    @WT.timed('plot guiding')
+    def _handleGuidingPlotting(self, image, flname):
+        ...
+
+    print WT.tracker.report()
+
+All code in the process shares WT.tracker. report() lists each stage with its
+count, p50, p90, p99, maximum and total time and names the stage taking the
+most time. Stages named '... cycle', '... wait' or '... expose' time a whole
+loop or contain the exposure itself and are left out of that (see
+overhead_stage). write() appends the report to log/guidetiming.txt; the
+guider writes it once per guiding run and resets the tracker at the start of
+the next.
+
+Besides the totals since the last reset, the tracker keeps the durations
+since the last roll(), which the guider uses for the live latencies it shows
+every minute.
+"""
+
+import numpy as np
+import os, time, math, threading
+from functools import wraps
+
+homedir = os.path.dirname(os.path.realpath(__file__))
+
+timingfile = homedir + '/log/guidetiming.txt'
+
+#Suffixes of the stages timing whole loops or containing the exposure
+containerstages = (' cycle', ' wait', ' expose')
+
+def overhead_stage(stage):
+    '''True for the stages that are processing overhead, the ones the
+    slowest stage is chosen from'''
+
+    return not stage.endswith(containerstages)
+
+class LatencyHistogram(object):
+    '''Counts of durations (s) in logarithmic bins from tmin to tmax'''
+
+    def __init__(self, tmin = 1e-5, tmax = 1e3, perdecade = 20):
+
+        self.lo = math.log10(tmin)
+        self.perdecade = perdecade
+        self.nbins = int(round((math.log10(tmax) - self.lo) * perdecade))
+        self.counts = np.zeros(self.nbins, dtype=np.int64)
+        self.n = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, dt):
+
+        if dt > 0:
+            i = int((math.log10(dt) - self.lo) * self.perdecade)
+            i = min(max(i, 0), self.nbins - 1)
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.n += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+
+    def percentile(self, p):
+        '''Duration below which p percent of the durations fall (the geometric
+        centre of the bin)'''
+
+        if self.n == 0:
+            return np.nan
+        i = np.searchsorted(np.cumsum(self.counts), p / 100. * self.n)
+        i = min(i, self.nbins - 1)
+
+        return min(10**(self.lo + (i + 0.5) / self.perdecade), self.max)
+
+class LatencyTracker(object):
+    '''Latency histograms by stage name'''
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.recent = {}
+        self.started = time.time()
+        self.rolled = time.time()
+
+    def add(self, stage, dt):
+        '''Records a duration dt (s) for stage'''
+
+        with self.lock:
+            for stages in [self.stages, self.recent]:
+                hist = stages.get(stage)
+                if hist is None:
+                    hist = stages[stage] = LatencyHistogram()
+                hist.add(dt)
+
+    def time(self, stage):
+        '''Context manager timing its block as stage'''
+
+        return StageTimer(self, stage)
+
+    def wrap(self, stage, f):
+        '''Returns f timed as stage'''
+
+        @wraps(f)
+        def timedf(*args, **kwargs):
+            t0 = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.add(stage, time.time() - t0)
+
+        return timedf
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.recent = {}
+            self.started = time.time()
+            self.rolled = time.time()
+
+    def roll(self):
+        '''Starts a new set of recent durations'''
+
+        with self.lock:
+            self.recent = {}
+            self.rolled = time.time()
+
+    def summary(self, prefix = '', recent = False):
+        '''Returns a list of (stage, count, p50, p90, p99, max, total) for the
+        stages starting with prefix, the slowest in total first. With recent
+        only the durations since the last roll() are used'''
+
+        with self.lock:
+            stages = self.recent if recent else self.stages
+            rows = [(stage, h.n, h.percentile(50), h.percentile(90), h.percentile(99), h.max, h.total)\
+                    for stage, h in stages.items() if stage.startswith(prefix)]
+
+        return sorted(rows, key = lambda r: r[6], reverse = True)
+
+    def percentiles(self, stage, ps = (50, 99), recent = False):
+        with self.lock:
+            hist = (self.recent if recent else self.stages).get(stage)
+            if hist is None:
+                return [np.nan for p in ps]
+            return [hist.percentile(p) for p in ps]
+
+    def report(self, prefix = ''):
+        '''Table of the stage latencies in ms since the last reset'''
+
+        rows = self.summary(prefix)
+        if not rows:
+            return "NO TIMING DATA"
+
+        lines = ["%-22s %7s %9s %9s %9s %9s %9s" % ('STAGE', 'N', 'P50', 'P90', 'P99', 'MAX', 'TOTAL(S)')]
+        for stage, n, p50, p90, p99, tmax, total in rows:
+            lines.append("%-22s %7i %9.1f %9.1f %9.1f %9.1f %9.1f" % (stage, n, p50*1e3, p90*1e3,\
+                    p99*1e3, tmax*1e3, total))
+
+        #Loops and the exposure contain the others
+        stages = [r for r in rows if overhead_stage(r[0])]
+        if stages:
+            lines.append("SLOWEST STAGE: %s (%.0f%% OF THE TIME IN STAGES)" % (stages[0][0],\
+                    100. * stages[0][6] / max(sum([r[6] for r in stages]), 1e-9)))
+
+        return '\n'.join(lines)
+
+    def write(self, fl = timingfile, prefix = ''):
+        '''Appends the report to fl'''
+
+        try:
+            f = open(fl, 'a')
+            f.write("# %s, timing since %s\n" % (time.strftime('%Y-%m-%dT%H:%M:%S'),\
+                    time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started))))
+            f.write(self.report(prefix) + '\n\n')
+            f.close()
+        except IOError as e:
+            print "### Could not write timing log %s: %s" % (fl, e)
+
+class StageTimer(object):
+
+    def __init__(self, tracker, stage):
+        self.tracker = tracker
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.tracker.add(self.stage, time.time() - self.t0)
+
+tracker = LatencyTracker()
+
+def timed(stage):
+    '''Decorator timing a function as stage in the shared tracker'''
+
+    def decorator(f):
+        return tracker.wrap(stage, f)
+
+    return decorator
@@ -860,7 +860,7 @@ class RunGuiding(QThread):
         offsets, x_rot, y_rot = WG.get_rotation_solution(self.rotangle, guideroffsets)
         
         #Try centroiding
-        CFReturns = WA.centroid_finder(imgbox, plot=False)
+        CFReturns = WA.centroid_finder(imgbox, plot=False, widths='fast')
 
         if CFReturns == False:
             return False, False
@@ -969,7 +969,7 @@ class RunGuiding(QThread):
         imgbox = img[stary_box-boxsize:stary_box+boxsize, starx_box-boxsize:starx_box+boxsize]
 
         #FInd the star in the box
-        CFReturns = WA.centroid_finder(imgbox, plot=False)
+        CFReturns = WA.centroid_finder(imgbox, plot=False, widths='fast')
         if CFReturns == False:
             return
         
@@ -421,7 +421,7 @@ def checkstarinbox(imgbox, boxsize, telSock, rotangle, guideroffsets, multistar
     offsets, x_rot, y_rot = get_rotation_solution(telSock, rotangle, guideroffsets)
     
     #Try centroiding
-    CFReturns = WA.centroid_finder(imgbox, plot=False)
+    CFReturns = WA.centroid_finder(imgbox, plot=False, widths='fast')
 
     if CFReturns == False:
         return [False, None]
@@ -527,7 +527,7 @@ def run_guiding(inputguiding,  cam, telSock, rotangle):
     imgbox = img[stary_box-boxsize:stary_box+boxsize, starx_box-boxsize:starx_box+boxsize]
 
     #FInd the star in the box
-    CFReturns = WA.centroid_finder(imgbox, plot=False)
+    CFReturns = WA.centroid_finder(imgbox, plot=False, widths='fast')
     if CFReturns == False:
         return
     